@@ -0,0 +1,109 @@
+import argparse
+import resource
+import time
+import tracemalloc
+
+"""
+    Benchmark of the collection of subreddits (stream_submissions), offline: the API responses are replayed from a
+    cassette (see information_recovery/replay.py), optionally with latency and errors. For each subreddit it
+    reports the records collected, submissions/sec, API calls (by endpoint) and the memory used.
+
+    The cassette is recorded once with --record (it needs the credentials of the .env and network):
+        python -m benchmarks.collector --record data/cassettes/funny.jsonl.gz funny
+        python -m benchmarks.collector data/cassettes/funny.jsonl.gz funny [--latency 0.05] [--error-rate 0.01]
+"""
+
+
+def collect(subreddit: str, submissions_limit: int, deep_comments):
+    """
+    :return: the number of submissions, comments and crossposts collected.
+    """
+    from database.subreddit import RedditSubmission, RedditComment, CrossPost
+    from information_recovery.reddit_connection import stream_submissions
+    from information_recovery.seen_ids import SeenIds
+
+    counts = {RedditSubmission: 0, RedditComment: 0, CrossPost: 0}
+    # A new SeenIds, so every run does the same requests
+    for record in stream_submissions(subreddit=subreddit, submissions_limit=submissions_limit,
+                                     deep_comments=deep_comments, seen_ids=SeenIds()):
+        if type(record) in counts:
+            counts[type(record)] += 1
+    return counts[RedditSubmission], counts[RedditComment], counts[CrossPost]
+
+
+def api_calls() -> dict:
+    from information_recovery.rate_limiter import rate_limiter
+
+    return {endpoint: (stats.calls, stats.errors) for endpoint, stats in rate_limiter.endpoints.items()}
+
+
+def calls_since(before: dict) -> dict:
+    """
+    :return: the API calls and errors of each endpoint since the counts "before" (see api_calls).
+    """
+    return {endpoint: (number - before.get(endpoint, (0, 0))[0], errors - before.get(endpoint, (0, 0))[1])
+            for endpoint, (number, errors) in api_calls().items()}
+
+
+def run(subreddits: [str], submissions_limit: int, deep_comments, trace_memory: bool):
+    total_submissions, total_calls, total_time = 0, 0, 0.0
+    for subreddit in subreddits:
+        calls_before = api_calls()
+        if trace_memory:
+            tracemalloc.start()
+        time_start = time.perf_counter()
+        submissions, comments, crossposts = collect(subreddit, submissions_limit, deep_comments)
+        elapsed = time.perf_counter() - time_start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+
+        calls = calls_since(calls_before)
+        number_calls = sum(number for number, _ in calls.values())
+        print(f"[{subreddit}] {submissions} submissions, {comments} comments, {crossposts} crossposts "
+              f"in {elapsed:.2f} seconds:")
+        print(f"\t {submissions / elapsed:,.1f} submissions/s, {number_calls} API calls "
+              f"({number_calls / max(submissions, 1):.2f} per submission)")
+        for endpoint, (number, errors) in sorted(calls.items()):
+            if number:
+                print(f"\t\t {endpoint}: {number} calls, {errors} errors")
+        if peak is not None:
+            print(f"\t peak memory (traced): {peak / 2 ** 20:.1f} MiB")
+
+        total_submissions += submissions
+        total_calls += number_calls
+        total_time += elapsed
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Total: {total_submissions} submissions in {total_time:.2f} seconds "
+          f"({total_submissions / max(total_time, 1e-9):,.1f}/s), {total_calls / len(subreddits):.1f} API calls per "
+          f"subreddit, max RSS {max_rss:.0f} MiB.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmark of the collection of subreddits.")
+    parser.add_argument("cassette", help="gzipped json lines file with the recorded responses")
+    parser.add_argument("subreddits", nargs="+")
+    parser.add_argument("--record", action="store_true", help="record the cassette with the real API")
+    parser.add_argument("--submissions", type=int, default=350, help="submissions by subreddit")
+    parser.add_argument("--deep-comments", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each replayed request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximum random seconds added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a 503 response")
+    parser.add_argument("--connection-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true", help="peak memory of each subreddit (slower)")
+    arguments = parser.parse_args()
+
+    from information_recovery.reddit_connection import DeepComments
+    from information_recovery.replay import recording, replaying
+
+    deep = DeepComments() if arguments.deep_comments else None
+    if arguments.record:
+        with recording(arguments.cassette):
+            run(arguments.subreddits, arguments.submissions, deep, arguments.trace_memory)
+    else:
+        with replaying(arguments.cassette, latency=arguments.latency, jitter=arguments.jitter,
+                       error_rate=arguments.error_rate, connection_error_rate=arguments.connection_error_rate,
+                       seed=arguments.seed):
+            run(arguments.subreddits, arguments.submissions, deep, arguments.trace_memory)
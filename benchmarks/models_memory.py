@@ -0,0 +1,90 @@
+import sys
+import tracemalloc
+from datetime import datetime
+
+from database.batches import CommentBatch
+from database.subreddit import RedditComment
+
+"""
+    Memory used by the comments of a big subreddit (350 posts with full comments), comparing:
+        - plain objects with a __dict__ and an empty replies list for each comment (the previous models),
+        - the slotted RedditComment,
+        - a CommentBatch (only the columns are kept).
+
+    Usage: python -m benchmarks.models_memory [number_comments]
+"""
+DEFAULT_NUMBER_COMMENTS = 300_000
+DATE = datetime.utcfromtimestamp(1_600_000_000.0)
+
+
+class DictComment:
+    """
+    RedditComment as it was before __slots__.
+    """
+
+    def __init__(self, comment_id, text, author, date_created, parent_id, submission_id, upvote_ratio, pinned):
+        self.id = comment_id
+        self.author = author
+        self.date_created = date_created
+        self.parent_id = parent_id
+        self.submission_id = submission_id
+        self.upvote_ratio = upvote_ratio
+        self.pinned = pinned
+        self.text = text
+        self.replies = []
+
+
+def comment_ids(number_comments: int) -> [str]:
+    """
+    :return: the ids of the comments, created before measuring (see measure).
+    """
+    return [f"c{i}" for i in range(number_comments)]
+
+
+def _arguments(comment_id: str):
+    # The strings are shared by all the variants, so only the containers are measured
+    return (comment_id, "text", "author", DATE, "t3_parent", "submission", 0.5, False)
+
+
+def measure(build, ids: [str]):
+    """
+    :param build: one of the build functions.
+    :param ids: the ids of the comments (see comment_ids).
+    :return: the memory (bytes) allocated by the build function.
+    """
+    tracemalloc.start()
+    result = build(ids)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def build_dict_comments(ids: [str]):
+    return [DictComment(*_arguments(comment_id)) for comment_id in ids]
+
+
+def build_slotted_comments(ids: [str]):
+    return [RedditComment(*_arguments(comment_id)) for comment_id in ids]
+
+
+def build_comment_batch(ids: [str]):
+    batch = CommentBatch()
+    for comment_id in ids:
+        batch.append(RedditComment(*_arguments(comment_id)))
+    return batch
+
+
+if __name__ == '__main__':
+    number_comments = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUMBER_COMMENTS
+    ids = comment_ids(number_comments)
+
+    print(f"Memory used by {number_comments} comments:")
+    baseline = None
+    for name, build in [("__dict__ objects", build_dict_comments),
+                        ("__slots__ objects", build_slotted_comments),
+                        ("CommentBatch", build_comment_batch)]:
+        size = measure(build, ids)
+        baseline = baseline or size
+        print(f"\t {name:<20} {size / 2 ** 20:8.1f} MiB  {size / number_comments:6.0f} bytes/comment  "
+              f"({100 * size / baseline:.0f}%)")
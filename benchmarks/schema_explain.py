@@ -0,0 +1,170 @@
+import argparse
+import json
+
+"""
+    EXPLAIN ANALYZE of the resume queries of the database (get_unsaved_subreddits and get_uncompleted_subreddits) and
+    of the comments of a submission, on a generated dataset, comparing:
+        - the previous queries (nested IN subqueries, LEFT OUTER JOIN) on the tables with primary keys only,
+        - the current queries (EXISTS / NOT EXISTS, loose index scan) on the same tables,
+        - the current queries with the indexes of database/schema.py,
+        - optionally, with the comments table partitioned (--partition-comments).
+
+    Everything is created in a schema of its own (BENCHMARK_SCHEMA), which is dropped at the end. It uses the
+    PostgreSQL database of the .env.
+
+    Usage: python -m benchmarks.schema_explain [--submissions 500000] [--subreddits 5000] [--partition-comments]
+"""
+BENCHMARK_SCHEMA = "recommenddit_benchmark"
+DEFAULT_SUBREDDITS = 5000
+DEFAULT_SUBMISSIONS = 500_000
+DEFAULT_CROSSPOSTS_RATIO = 0.3  # crossposts for each submission
+DEFAULT_COMMENTS_RATIO = 4  # comments for each submission
+SAVED_SUBREDDITS_RATIO = 0.8  # the rest are only known from their submissions
+MIN_SUBMISSIONS = 350
+
+"""
+    The queries before the schema was managed.
+"""
+PREVIOUS_UNSAVED_SUBREDDITS = """
+                              SELECT DISTINCT submission.subreddit FROM submission
+                              LEFT OUTER JOIN subreddit
+                              ON (submission.subreddit = subreddit.name)
+                              WHERE subreddit.name IS NULL;
+                              """
+PREVIOUS_UNCOMPLETED_SUBREDDITS = """
+                                  SELECT subreddit, max(post_id) AS last_id, count(post_id) AS number_posts
+                                  FROM    (SELECT subreddit, post_id FROM submission
+                                          WHERE (subreddit IN (SELECT name FROM subreddit))
+                                          AND (post_id IN (SELECT crosspost_parent_id FROM crosspost))) AS subquery
+                                  GROUP BY subreddit
+                                  HAVING count(post_id) < %s
+                                  ORDER BY number_posts ASC
+                                  """
+SUBMISSION_COMMENTS = "SELECT * FROM reddit_replies WHERE submission_id = %s;"
+ANALYZED_TABLES = "subreddit, submission, crosspost, reddit_replies"
+
+
+def generate_data(cursor, number_subreddits: int, number_submissions: int, crossposts_ratio: float,
+                  comments_ratio: int):
+    """
+    Fills the tables with random data. The submissions of the subreddits are skewed (a few subreddits have most of
+    them), as in the collected data.
+    """
+    number_saved = int(number_subreddits * SAVED_SUBREDDITS_RATIO)
+    cursor.execute("SELECT setseed(0.42);")
+    cursor.execute("""
+                   INSERT INTO subreddit (name, description, date_created, nsfw, subscribers)
+                   SELECT 'subreddit_' || i, 'description', now(), false, i FROM generate_series(1, %s) AS i;
+                   """, (number_saved,))
+    cursor.execute("""
+                   INSERT INTO submission (post_id, title, author, date_created, nsfw, post_type, upvote_ratio,
+                                           total_awards, num_crossposts, post_content, video_duration, category,
+                                           subreddit)
+                   SELECT to_hex(i), 'title', 'author', now(), false, 'text', 0.9, 0, 0, 'text', 0, NULL,
+                          'subreddit_' || (1 + floor(random() ^ 3 * %s))::int
+                   FROM generate_series(1, %s) AS i;
+                   """, (number_subreddits, number_submissions))
+    cursor.execute("""
+                   INSERT INTO crosspost (crosspost_parent_id, crosspost_id)
+                   SELECT to_hex(1 + floor(random() * %s)::int), to_hex(1 + floor(random() * %s)::int)
+                   FROM generate_series(1, %s)
+                   ON CONFLICT DO NOTHING;
+                   """, (number_submissions, number_submissions, int(number_submissions * crossposts_ratio)))
+    cursor.execute("""
+                   INSERT INTO reddit_replies (comment_id, comment_content, author, date_created, parent_id,
+                                               submission_id, upvote_ratio, pinned)
+                   SELECT 'c' || i, 'text', 'author', now(), NULL, to_hex(1 + i %% %s), 0.5, false
+                   FROM generate_series(1, %s) AS i;
+                   """, (number_submissions, number_submissions * comments_ratio))
+    cursor.execute(f"ANALYZE {ANALYZED_TABLES};")
+
+
+def explain(cursor, sql_statement: str, params=None):
+    """
+    :return: the execution time (ms), the shared buffers read or hit, and the nodes of the plan.
+    """
+    cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql_statement}", params)
+    result = cursor.fetchone()[0]
+    result = json.loads(result) if isinstance(result, str) else result
+    plan = result[0]["Plan"]
+
+    nodes = []
+    to_visit = [plan]
+    while to_visit:
+        node = to_visit.pop()
+        name = node["Node Type"]
+        if "Index Name" in node:
+            name += f" ({node['Index Name']})"
+        elif "Relation Name" in node:
+            name += f" ({node['Relation Name']})"
+        nodes.append(name)
+        to_visit.extend(reversed(node.get("Plans", [])))
+
+    buffers = plan.get("Shared Hit Blocks", 0) + plan.get("Shared Read Blocks", 0)
+    return result[0]["Execution Time"], buffers, nodes
+
+
+def report(cursor, title: str, queries: dict):
+    print(title)
+    for name, (sql_statement, params) in queries.items():
+        # The first run warms up the cache
+        explain(cursor, sql_statement, params)
+        elapsed, buffers, nodes = explain(cursor, sql_statement, params)
+        print(f"\t {name}: {elapsed:,.1f} ms, {buffers:,} buffers")
+        print(f"\t\t {' > '.join(dict.fromkeys(nodes))}")
+
+
+def run(number_subreddits: int, number_submissions: int, crossposts_ratio: float, comments_ratio: int,
+        partition_comments: bool):
+    from database.database import database, SQL_UNSAVED_SUBREDDITS, SQL_UNCOMPLETED_SUBREDDITS
+    from database.schema import migrate
+
+    previous = {
+        "unsaved subreddits": (PREVIOUS_UNSAVED_SUBREDDITS, None),
+        "uncompleted subreddits": (PREVIOUS_UNCOMPLETED_SUBREDDITS, (MIN_SUBMISSIONS,)),
+        "comments of a submission": (SUBMISSION_COMMENTS, ("1",)),
+    }
+    current = {
+        "unsaved subreddits": (SQL_UNSAVED_SUBREDDITS, None),
+        "uncompleted subreddits": (SQL_UNCOMPLETED_SUBREDDITS, (MIN_SUBMISSIONS,)),
+        "comments of a submission": (SUBMISSION_COMMENTS, ("1",)),
+    }
+
+    with database.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {BENCHMARK_SCHEMA} CASCADE;")
+            cursor.execute(f"CREATE SCHEMA {BENCHMARK_SCHEMA};")
+            cursor.execute(f"SET search_path TO {BENCHMARK_SCHEMA};")
+            try:
+                # Tables and primary keys
+                migrate(connection, target_version=2)
+                print(f"Generating {number_submissions:,} submissions of {number_subreddits:,} subreddits...")
+                generate_data(cursor, number_subreddits, number_submissions, crossposts_ratio, comments_ratio)
+
+                report(cursor, "Previous queries, primary keys only:", previous)
+                report(cursor, "Current queries, primary keys only:", current)
+
+                migrate(connection)
+                cursor.execute(f"ANALYZE {ANALYZED_TABLES};")
+                report(cursor, "Current queries, with the indexes:", current)
+
+                if partition_comments:
+                    migrate(connection, partition_comments=True)
+                    cursor.execute(f"ANALYZE {ANALYZED_TABLES};")
+                    report(cursor, "Current queries, with the comments partitioned:", current)
+            finally:
+                cursor.execute("RESET search_path;")
+                cursor.execute(f"DROP SCHEMA IF EXISTS {BENCHMARK_SCHEMA} CASCADE;")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="EXPLAIN ANALYZE of the resume queries on a generated dataset.")
+    parser.add_argument("--subreddits", type=int, default=DEFAULT_SUBREDDITS)
+    parser.add_argument("--submissions", type=int, default=DEFAULT_SUBMISSIONS)
+    parser.add_argument("--crossposts-ratio", type=float, default=DEFAULT_CROSSPOSTS_RATIO)
+    parser.add_argument("--comments-ratio", type=int, default=DEFAULT_COMMENTS_RATIO)
+    parser.add_argument("--partition-comments", action="store_true")
+    arguments = parser.parse_args()
+
+    run(arguments.subreddits, arguments.submissions, arguments.crossposts_ratio, arguments.comments_ratio,
+        arguments.partition_comments)
@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+"""
+    Load test of the recommendation service (see model.recommendation_service): several connections with keep-alive
+    send requests as fast as they can, choosing the subreddits with a Zipf distribution (a few popular subreddits
+    get most of the requests). It reports the throughput and the p50/p90/p99 latency.
+
+    Without --port, it starts the service over a synthetic index (--subreddits subreddits) in another process.
+
+    Usage: python -m benchmarks.service_latency [--port PORT] [--connections 32] [--requests 20000] [--batch 0]
+"""
+DEFAULT_CONNECTIONS = 32
+DEFAULT_REQUESTS = 20000
+DEFAULT_SUBREDDITS = 20000
+ZIPF_EXPONENT = 1.2
+
+
+def build_synthetic_index(folder: str, number_subreddits: int, k: int = 50, seed: int = 0):
+    from model.recommender import RecommendationIndex, publish_version
+
+    random = np.random.default_rng(seed)
+    names = [f"subreddit_{i}" for i in range(number_subreddits)]
+    neighbours = random.integers(0, number_subreddits, (number_subreddits, k), dtype=np.int32)
+    scores = np.sort(random.random((number_subreddits, k), dtype=np.float32), axis=1)[:, ::-1].copy()
+    publish_version(RecommendationIndex(names, neighbours, scores, method="cosine"), folder)
+    return names
+
+
+async def request(reader, writer, method: str, target: str, body: bytes = b""):
+    writer.write(f"{method} {target} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n"
+                 .encode("latin-1") + body)
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = next(int(line.split(b":", 1)[1]) for line in head.split(b"\r\n")
+                  if line.lower().startswith(b"content-length:"))
+    return status, await reader.readexactly(length)
+
+
+async def wait_for_service(host: str, port: int, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            await request(reader, writer, "GET", "/health")
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def client(host: str, port: int, targets, latencies: list, errors: list):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for method, target, body in targets:
+            time_start = time.perf_counter()
+            status, _ = await request(reader, writer, method, target, body)
+            latencies.append(time.perf_counter() - time_start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+def make_targets(names: [str], number_requests: int, batch: int, k: int, seed: int = 0):
+    random = np.random.default_rng(seed)
+    ranks = random.zipf(ZIPF_EXPONENT, number_requests * max(batch, 1)) - 1
+    chosen = [names[rank % len(names)] for rank in ranks]
+    if not batch:
+        return [("GET", f"/recommend?subreddit={name}&k={k}", b"") for name in chosen]
+    return [("POST", "/recommend/batch", json.dumps({"subreddits": chosen[i:i + batch], "k": k}).encode("utf-8"))
+            for i in range(0, len(chosen), batch)]
+
+
+async def run(host: str, port: int, names: [str], connections: int, number_requests: int, batch: int, k: int):
+    await wait_for_service(host, port)
+    targets = make_targets(names, number_requests, batch, k)
+    latencies, errors = [], []
+
+    time_start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, targets[i::connections], latencies, errors)
+                           for i in range(connections)))
+    elapsed = time.perf_counter() - time_start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, stats = await request(reader, writer, "GET", "/stats")
+    writer.close()
+
+    latencies = np.array(latencies) * 1000
+    kind = f"batch of {batch}" if batch else "single"
+    print(f"{len(latencies)} requests ({kind}, k={k}) over {connections} connections in {elapsed:.2f} seconds:")
+    print(f"\t throughput: {len(latencies) / elapsed:,.0f} requests/s"
+          + (f" ({len(latencies) * batch / elapsed:,.0f} subreddits/s)" if batch else ""))
+    print(f"\t latency (ms): p50 {np.percentile(latencies, 50):.2f}  p90 {np.percentile(latencies, 90):.2f}  "
+          f"p99 {np.percentile(latencies, 99):.2f}  max {latencies.max():.2f}")
+    print(f"\t errors: {len(errors)}")
+    print(f"\t cache: {json.loads(stats)['cache']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test of the recommendation service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="port of a running service (otherwise, one is started)")
+    parser.add_argument("--subreddits", type=int, default=DEFAULT_SUBREDDITS, help="subreddits of the synthetic index")
+    parser.add_argument("--names", help="with --port, names.json of the index of the running service")
+    parser.add_argument("--connections", type=int, default=DEFAULT_CONNECTIONS)
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS)
+    parser.add_argument("--batch", type=int, default=0, help="subreddits by request (0: /recommend)")
+    parser.add_argument("-k", type=int, default=10)
+    arguments = parser.parse_args()
+
+    service = None
+    if arguments.port:
+        port = arguments.port
+        with open(arguments.names, encoding="utf-8") as file:
+            subreddit_names = json.load(file)
+    else:
+        port = 18080
+        index_folder = tempfile.mkdtemp(prefix="recommendation_index_")
+        subreddit_names = build_synthetic_index(index_folder, arguments.subreddits)
+        service = subprocess.Popen([sys.executable, "-m", "model.recommendation_service", "--port", str(port),
+                                    "--index-folder", index_folder], cwd=os.getcwd())
+
+    try:
+        asyncio.run(run(arguments.host, port, subreddit_names, arguments.connections, arguments.requests,
+                        arguments.batch, arguments.k))
+    finally:
+        if service:
+            service.terminate()
+            service.wait()
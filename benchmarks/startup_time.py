@@ -0,0 +1,103 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+    Start-up time of the command line (main.py): for each command, the time of "python main.py <command> --help" and
+    of importing the modules the command needs, and which heavy libraries those imports load. Optionally (--recommend),
+    the time of a whole "recommend" over a synthetic index.
+
+    Usage: python -m benchmarks.startup_time [--runs 5] [--recommend]
+"""
+DEFAULT_RUNS = 5
+HEAVY_MODULES = ("praw", "psycopg2", "pandas", "pyarrow", "numpy", "scipy", "spacy")
+
+"""
+    Modules imported by each command of main.py (besides main itself).
+"""
+COMMAND_MODULES = {
+    "crawl --sink csv": ["information_recovery.data_collection_to_excel"],
+    "crawl --sink db": ["information_recovery.data_collection_to_db"],
+    "crawl --sink parquet": ["information_recovery.data_collection_to_parquet"],
+    "refresh": ["information_recovery.data_collection_to_db"],
+    "import-csv": ["database.schema", "information_recovery.data_collection_to_excel"],
+    "build-index": ["model.recommender", "model.crosspost_graph"],
+    "recommend": ["model.recommender"],
+}
+
+_IMPORT_SCRIPT = """
+import sys, time
+time_start = time.perf_counter()
+for module in sys.argv[2:]:
+    __import__(module)
+elapsed = time.perf_counter() - time_start
+heavy = [module for module in sys.argv[1].split(",") if module in sys.modules]
+print(elapsed, ",".join(heavy))
+"""
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run(arguments: [str]) -> float:
+    time_start = time.perf_counter()
+    subprocess.run([sys.executable, *arguments], cwd=_ROOT, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - time_start
+
+
+def time_help(command: str, runs: int) -> float:
+    """
+    :return: the median time (seconds) of "python main.py <command> --help".
+    """
+    return statistics.median(_run(["main.py", command.split()[0], "--help"]) for _ in range(runs))
+
+
+def time_imports(modules: [str], runs: int):
+    """
+    :return: the median time (seconds) of importing the modules in a new interpreter, and the heavy libraries they
+    load.
+    """
+    times, heavy = [], ""
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", _IMPORT_SCRIPT, ",".join(HEAVY_MODULES), *modules],
+                                cwd=_ROOT, check=True, capture_output=True, text=True).stdout.split()
+        times.append(float(output[0]))
+        heavy = output[1] if len(output) > 1 else ""
+    return statistics.median(times), heavy
+
+
+def time_recommend(runs: int, number_subreddits: int = 20000) -> float:
+    """
+    :return: the median time (seconds) of "python main.py recommend" over a synthetic index.
+    """
+    from benchmarks.service_latency import build_synthetic_index
+
+    with tempfile.TemporaryDirectory() as folder:
+        names = build_synthetic_index(folder, number_subreddits)
+        return statistics.median(_run(["main.py", "recommend", names[0], "--index-folder", folder])
+                                 for _ in range(runs))
+
+
+def run(runs: int, recommend: bool):
+    print(f"Interpreter: {_run(['-c', 'pass']) * 1000:,.0f} ms")
+    print(f"main.py --help: {statistics.median(_run(['main.py', '--help']) for _ in range(runs)) * 1000:,.0f} ms")
+    for command, modules in COMMAND_MODULES.items():
+        help_time = time_help(command, runs)
+        import_time, heavy = time_imports(modules, runs)
+        print(f"\t {command}: --help {help_time * 1000:,.0f} ms, imports {import_time * 1000:,.0f} ms "
+              f"({heavy.replace(',', ', ') or 'no heavy modules'})")
+
+    if recommend:
+        print(f"recommend (synthetic index): {time_recommend(runs) * 1000:,.0f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Start-up time of the command line.")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS)
+    parser.add_argument("--recommend", action="store_true", help="also time a recommend over a synthetic index")
+    arguments = parser.parse_args()
+
+    run(arguments.runs, arguments.recommend)
@@ -0,0 +1,96 @@
+from operator import attrgetter
+
+
+class RecordBatch:
+    """
+    Columnar batch of records: one list for each column, in the order of the columns of the table. The values are
+    taken from the records when they are appended, so the records themselves are not kept.
+
+    The sinks take the batches directly: rows() for the database and the csv files, columns for the parquet files.
+    """
+    # Attributes of the record, in the order of the columns of the table
+    ATTRIBUTES = ()
+    # Name of each column in the table
+    COLUMNS = ()
+
+    def __init__(self):
+        self._getter = attrgetter(*self.ATTRIBUTES)
+        self.columns = {column: [] for column in self.COLUMNS}
+        self._lists = list(self.columns.values())
+        self.size = 0
+
+    def append(self, record):
+        for values, value in zip(self._lists, self._getter(record)):
+            values.append(value)
+        self.size += 1
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def rows(self):
+        """
+        :return: a list of tuples, one for each record.
+        """
+        return list(zip(*self._lists))
+
+    def clear(self):
+        for values in self._lists:
+            values.clear()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.size > 0
+
+
+class SubredditBatch(RecordBatch):
+    ATTRIBUTES = ("name", "description", "date_created", "nsfw", "subscribers")
+    COLUMNS = ("name", "description", "date_created", "nsfw", "subscribers")
+
+
+class SubmissionBatch(RecordBatch):
+    ATTRIBUTES = ("id", "title", "author", "date_created", "nsfw", "post_type", "upvote_ratio", "total_awards",
+                  "num_crossposts", "text", "video_duration", "category", "subreddit")
+    COLUMNS = ("post_id", "title", "author", "date_created", "nsfw", "post_type", "upvote_ratio", "total_awards",
+               "num_crossposts", "post_content", "video_duration", "category", "subreddit")
+
+
+class CommentBatch(RecordBatch):
+    ATTRIBUTES = ("id", "text", "author", "date_created", "parent_id", "submission_id", "upvote_ratio", "pinned")
+    COLUMNS = ("comment_id", "comment_content", "author", "date_created", "parent_id", "submission_id",
+               "upvote_ratio", "pinned")
+
+
+class CrossPostBatch(RecordBatch):
+    ATTRIBUTES = ("crosspost_parent_id", "post_id")
+    COLUMNS = ("crosspost_parent_id", "crosspost_id")
+
+
+def to_rows(records, batch_class):
+    """
+    Rows of a list of records or of a batch, in the order of the columns of the table.
+
+    :param records: a RecordBatch, or a list of records.
+    :param batch_class: the RecordBatch subclass of the records.
+    :return: a list of tuples.
+    """
+    if isinstance(records, RecordBatch):
+        return records.rows()
+    getter = attrgetter(*batch_class.ATTRIBUTES)
+    return [getter(record) for record in records]
+
+
+def to_batch(records, batch_class):
+    """
+    :param records: a RecordBatch, or a list of records.
+    :param batch_class: the RecordBatch subclass of the records.
+    :return: a RecordBatch with the records.
+    """
+    if isinstance(records, RecordBatch):
+        return records
+    batch = batch_class()
+    batch.extend(records)
+    return batch
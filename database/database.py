@@ -1,10 +1,16 @@
+import csv
+import io
 import os
+import threading
+import time
+from contextlib import contextmanager
 from enum import Enum
 
-import psycopg2
 from dotenv import load_dotenv
-from psycopg2.extras import execute_values
 
+from database.batches import to_rows, SubredditBatch, SubmissionBatch, CrossPostBatch, CommentBatch
+from database.storage import StorageBackend
+from utils.metrics import get_logger
 from utils.singleton import Singleton
 
 """
@@ -19,6 +25,27 @@ DATABASE_USER = os.getenv("DATABASE_USER")
 DATABASE_PASSWORD = os.getenv("DATABASE_PASSWORD")
 DATABASE_PORT = os.getenv("DATABASE_PORT")
 
+logger = get_logger("database")
+
+"""
+    Connection pool: minimum and maximum number of open connections, seconds a connection can be idle before
+    checking that it's still alive, and number of times an operation is retried after losing the connection.
+"""
+DATABASE_POOL_MIN = int(os.getenv("DATABASE_POOL_MIN", 1))
+DATABASE_POOL_MAX = int(os.getenv("DATABASE_POOL_MAX", 8))
+HEALTH_CHECK_INTERVAL = 60  # seconds
+RECONNECT_ATTEMPTS = 2
+
+
+def _connection_errors():
+    """
+    :return: the exceptions of a lost connection. psycopg2 is only imported when the database is used, so the
+    modules that only need the tables (or the csv/parquet/SQLite storages) don't need it.
+    """
+    import psycopg2
+
+    return psycopg2.OperationalError, psycopg2.InterfaceError
+
 
 class RedditTables(Enum):
     SUBREDDITS = "subreddit"
@@ -27,22 +54,185 @@ class RedditTables(Enum):
     COMMENTS = "reddit_replies"
 
 
-class Database(metaclass=Singleton):
+"""
+    Columns of each table, in the same order used in the csv files.
+"""
+SUBREDDITS_COLUMNS = "name, description, date_created, nsfw, subscribers"
+SUBMISSIONS_COLUMNS = "post_id, title, author, date_created, nsfw, post_type, upvote_ratio, " \
+                      "total_awards, num_crossposts, post_content, video_duration, category, subreddit"
+CROSSPOSTS_COLUMNS = "crosspost_parent_id, crosspost_id"
+COMMENTS_COLUMNS = "comment_id, comment_content, author, date_created, parent_id, submission_id, upvote_ratio, pinned"
+
+"""
+    Queries to resume the collection, written for the indexes of schema.py:
+        - the distinct subreddits of the submissions are read with a loose index scan of submission_subreddit_idx (one
+        index lookup for each subreddit, instead of reading all the submissions),
+        - the crossposts of each submission are looked up in the primary key of the crosspost table.
+"""
+SQL_UNSAVED_SUBREDDITS = f"""
+                         WITH RECURSIVE submission_subreddit AS (
+                             (SELECT subreddit FROM {RedditTables.SUBMISSIONS.value} ORDER BY subreddit LIMIT 1)
+                             UNION ALL
+                             SELECT (SELECT submission.subreddit FROM {RedditTables.SUBMISSIONS.value} AS submission
+                                     WHERE submission.subreddit > previous.subreddit
+                                     ORDER BY submission.subreddit LIMIT 1)
+                             FROM submission_subreddit AS previous
+                             WHERE previous.subreddit IS NOT NULL
+                         )
+                         SELECT submission_subreddit.subreddit FROM submission_subreddit
+                         WHERE submission_subreddit.subreddit IS NOT NULL
+                         AND NOT EXISTS (SELECT 1 FROM {RedditTables.SUBREDDITS.value} AS subreddit
+                                         WHERE subreddit.name = submission_subreddit.subreddit);
+                         """
+SQL_UNCOMPLETED_SUBREDDITS = f"""
+                             SELECT submission.subreddit, max(submission.post_id) AS last_id,
+                                    count(submission.post_id) AS number_posts
+                             FROM {RedditTables.SUBMISSIONS.value} AS submission
+                             WHERE EXISTS (SELECT 1 FROM {RedditTables.SUBREDDITS.value} AS subreddit
+                                           WHERE subreddit.name = submission.subreddit)
+                             AND EXISTS (SELECT 1 FROM {RedditTables.CROSSPOSTS.value} AS crosspost
+                                         WHERE crosspost.crosspost_parent_id = submission.post_id)
+                             GROUP BY submission.subreddit
+                             HAVING count(submission.post_id) < %s
+                             ORDER BY number_posts ASC;
+                             """
+
+
+class Database(StorageBackend, metaclass=Singleton):
     """
         Class for database connection. This class is a Singleton.
+
+        It keeps a pool of connections, and each operation uses its own connection (and cursor), so it can be used
+        by several threads at the same time. The pool is created the first time it's needed.
     """
 
-    def __init__(self):
-        self.db_conn = psycopg2.connect(database=DATABASE_NAME,
-                                        host=DATABASE_HOST,
-                                        user=DATABASE_USER,
-                                        password=DATABASE_PASSWORD,
-                                        port=DATABASE_PORT)
-        self.db_conn.autocommit = True
-        self.cursor = self.db_conn.cursor()
+    def __init__(self, min_connections: int = DATABASE_POOL_MIN, max_connections: int = DATABASE_POOL_MAX):
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.pool = None
+        self._pool_lock = threading.Lock()
+        # ThreadedConnectionPool fails instead of waiting when all the connections are in use
+        self._available = threading.BoundedSemaphore(max_connections)
+        self._last_used = {}
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.db_conn.close()
+        self.close()
+
+    def close(self):
+        with self._pool_lock:
+            if self.pool:
+                self.pool.closeall()
+                self.pool = None
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self.pool is None:
+                from psycopg2.pool import ThreadedConnectionPool
+
+                self.pool = ThreadedConnectionPool(self.min_connections, self.max_connections,
+                                                   database=DATABASE_NAME,
+                                                   host=DATABASE_HOST,
+                                                   user=DATABASE_USER,
+                                                   password=DATABASE_PASSWORD,
+                                                   port=DATABASE_PORT)
+            return self.pool
+
+    def _is_healthy(self, connection) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(connection), 0) < HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            return True
+        except _connection_errors():
+            return False
+
+    @contextmanager
+    def connection(self):
+        """
+        Takes a healthy connection from the pool (waiting if all of them are in use), and gives it back at the end.
+        Broken connections are discarded from the pool.
+        """
+        self._available.acquire()
+        pool = self._get_pool()
+        connection = None
+        try:
+            connection = pool.getconn()
+            while not self._is_healthy(connection):
+                pool.putconn(connection, close=True)
+                connection = pool.getconn()
+            connection.autocommit = True
+
+            yield connection
+
+            self._last_used[id(connection)] = time.monotonic()
+            pool.putconn(connection)
+        except _connection_errors():
+            if connection is not None:
+                pool.putconn(connection, close=True)
+            raise
+        except Exception:
+            if connection is not None:
+                pool.putconn(connection)
+            raise
+        finally:
+            self._available.release()
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                yield cursor
+
+    def run(self, operation):
+        """
+        Runs an operation with a cursor of its own. If the connection was dropped, the operation is retried with a
+        new connection (all the operations of this class can be safely repeated).
+
+        :param operation: function that receives a cursor.
+        :return: what the operation returns.
+        """
+        for attempt in range(RECONNECT_ATTEMPTS + 1):
+            try:
+                with self.cursor() as cursor:
+                    return operation(cursor)
+            except _connection_errors():
+                if attempt == RECONNECT_ATTEMPTS:
+                    raise
+                logger.warning("Database connection lost, reconnecting (attempt %s of %s).", attempt + 1,
+                               RECONNECT_ATTEMPTS)
+
+    def fetch_all(self, sql_statement: str, params=None):
+        def operation(cursor):
+            cursor.execute(sql_statement, params)
+            return cursor.fetchall()
+
+        return self.run(operation)
+
+    def iter_rows(self, sql_statement: str, batch_size: int = 10000):
+        """
+        Goes through the results of a query, fetching them in batches with a server-side cursor, so the results are
+        never loaded in memory at once.
+
+        :param sql_statement: the SELECT query.
+        :param batch_size: number of rows fetched at a time.
+        :return: a generator of lists of rows (of at most batch_size rows).
+        """
+        with self.connection() as connection:
+            with connection.cursor(name=f"iter_{id(sql_statement)}", withhold=True) as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(sql_statement)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+
+    def submission_exists(self, post_id: str) -> bool:
+        table = RedditTables.SUBMISSIONS.value
+        return bool(self.fetch_all(f"SELECT 1 FROM {table} WHERE post_id = %s LIMIT 1;", (post_id,)))
 
     def get_info(self, select_columns, condition_from, condition_where=None):
         sql_statement = f"SELECT {select_columns} FROM {condition_from}"
@@ -50,18 +240,47 @@ class Database(metaclass=Singleton):
             sql_statement += f" WHERE {condition_where}"
         sql_statement += ";"
 
-        self.cursor.execute(sql_statement)
-
         # Retrieve query results
-        records = self.cursor.fetchall()
-        return records
+        return self.fetch_all(sql_statement)
 
     def add_info(self, table: str, columns: str, values: [str]):
         """
         Makes a INSERT query in the database.
         """
         insert_query = f"""INSERT INTO {table} ({columns}) values %s ON CONFLICT DO NOTHING;"""
-        execute_values(self.cursor, insert_query, values)
+        from psycopg2.extras import execute_values
+
+        self.run(lambda cursor: execute_values(cursor, insert_query, values))
+
+    def copy_rows(self, table: str, columns: str, rows, null_columns: [str] = ()):
+        """
+        Bulk INSERT using COPY. The rows are copied into a staging table (with only the given columns and no
+        constraints), and then merged into the table ignoring the ones already saved.
+
+        :param table: the name of the table.
+        :param columns: the columns of the rows, separated by commas.
+        :param rows: a list of tuples/lists of str.
+        :param null_columns: columns where an empty value means NULL (e.g. numbers).
+        :return: the number of rows inserted in the table.
+        """
+        staging_table = f"staging_{table}"
+        force_null = f", FORCE_NULL ({', '.join(null_columns)})" if null_columns else ""
+
+        def operation(cursor):
+            cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {staging_table} AS "
+                           f"SELECT {columns} FROM {table} WITH NO DATA;")
+            cursor.execute(f"TRUNCATE {staging_table};")
+
+            buffer = io.StringIO()
+            csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows(rows)
+            buffer.seek(0)
+
+            cursor.copy_expert(f"COPY {staging_table} ({columns}) FROM STDIN WITH (FORMAT csv{force_null});", buffer)
+            cursor.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging_table} "
+                           f"ON CONFLICT DO NOTHING;")
+            return cursor.rowcount
+
+        return self.run(operation)
 
     def get_subreddit_info(self, subreddit_name):
         table = RedditTables.SUBREDDITS.value
@@ -69,45 +288,38 @@ class Database(metaclass=Singleton):
 
     def save_subreddits(self, subreddits: ["Subreddit"]):
         """
-        Saves the subreddit information in the database.
+        Saves the subreddit information (a list of Subreddit's or a SubredditBatch) in the database.
         """
         table = RedditTables.SUBREDDITS.value
-        columns = "name, description, date_created, nsfw, subscribers"
-        values = [(subreddit.name, subreddit.description, subreddit.date_created, subreddit.nsfw,
-                   subreddit.subscribers)
-                  for subreddit in subreddits]
+        columns = SUBREDDITS_COLUMNS
+        values = to_rows(subreddits, SubredditBatch)
         return self.add_info(table=table, columns=columns, values=values)
 
     def save_submissions(self, submissions: ["RedditSubmission"]):
         """
-        Saves a list of submissions in the database.
+        Saves a list of submissions (or a SubmissionBatch) in the database.
         """
         table = RedditTables.SUBMISSIONS.value
-        columns = "post_id, title, author, date_created, nsfw, post_type, upvote_ratio, " \
-                  "total_awards, num_crossposts, post_content, video_duration, category,subreddit"
-        values = [(submission.id, submission.title, submission.author, submission.date_created, submission.nsfw,
-                   submission.post_type, submission.upvote_ratio, submission.total_awards, submission.num_crossposts,
-                   submission.text, submission.video_duration, submission.category, submission.subreddit)
-                  for submission in submissions]
+        columns = SUBMISSIONS_COLUMNS
+        values = to_rows(submissions, SubmissionBatch)
         return self.add_info(table=table, columns=columns, values=values)
 
     def save_crossposts(self, crossposts: ["CrossPost"]):
         """
-        Saves a list of crossposts in the database.
+        Saves a list of crossposts (or a CrossPostBatch) in the database.
         """
         table = RedditTables.CROSSPOSTS.value
-        columns = "crosspost_parent_id, crosspost_id"
-        values = [(crosspost.crosspost_parent_id, crosspost.post_id) for crosspost in crossposts]
+        columns = CROSSPOSTS_COLUMNS
+        values = to_rows(crossposts, CrossPostBatch)
         return self.add_info(table=table, columns=columns, values=values)
 
     def save_comments(self, comments: ["RedditComment"]):
         """
-        Saves a list of comments in the database.
+        Saves a list of comments (or a CommentBatch) in the database.
         """
         table = RedditTables.COMMENTS.value
-        columns = "comment_id, comment_content, author, date_created, parent_id, submission_id, upvote_ratio, pinned"
-        values = [(comment.id, comment.text, comment.author, comment.date_created, comment.parent_id,
-                   comment.submission_id, comment.upvote_ratio, comment.pinned) for comment in comments]
+        columns = COMMENTS_COLUMNS
+        values = to_rows(comments, CommentBatch)
         return self.add_info(table=table, columns=columns, values=values)
 
     def get_unsaved_subreddits(self):
@@ -115,33 +327,14 @@ class Database(metaclass=Singleton):
         Makes a SELECT query to get all the subreddits found in the database that do not have an entry in the subreddit
         table.
         """
-        sql_select = """
-                    SELECT DISTINCT submission.subreddit FROM submission
-                    LEFT OUTER JOIN subreddit
-                    ON (submission.subreddit = subreddit.name)
-                    WHERE subreddit.name IS NULL;
-                    """
-        self.cursor.execute(sql_select)
-
         # Retrieve query results
-        records = self.cursor.fetchall()
-        return records
+        return self.fetch_all(SQL_UNSAVED_SUBREDDITS)
 
     def get_uncompleted_subreddits(self, min_submissions):
-        sql_select = f"""
-                    SELECT subreddit, max(post_id) AS last_id, count(post_id) AS number_posts
-                    FROM    (SELECT subreddit, post_id FROM submission 
-                            WHERE (subreddit IN (SELECT name FROM subreddit)) 
-                            AND (post_id IN (SELECT crosspost_parent_id FROM crosspost))) AS subquery
-                    GROUP BY subreddit
-                    HAVING count(post_id) < {min_submissions}
-                    ORDER BY number_posts ASC
-                    """
-        self.cursor.execute(sql_select)
-
+        """
+        Makes a SELECT query to get the saved subreddits with less than min_submissions crossposted submissions.
+        """
         # Retrieve query results
-        records = self.cursor.fetchall()
-        return records
-
+        return self.fetch_all(SQL_UNCOMPLETED_SUBREDDITS, (min_submissions,))
 
 database = Database()
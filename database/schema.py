@@ -0,0 +1,256 @@
+import argparse
+from contextlib import nullcontext
+
+from database.database import RedditTables
+from utils.metrics import get_logger
+
+logger = get_logger("schema")
+
+"""
+    Versions of the schema of the PostgreSQL database. Each migration is applied once, in a transaction, and recorded
+    in the SCHEMA_TABLE table, so migrate() can be run on every start (a new database is created from scratch, and
+    an old one is only brought up to date). The migrations of several processes are serialized with an advisory
+    lock.
+"""
+SCHEMA_TABLE = "schema_migrations"
+SCHEMA_LOCK = 7236415  # any bigint, the same for all the processes
+
+"""
+    Number of partitions (by hash of submission_id) of the comments table, when it's partitioned.
+"""
+COMMENTS_PARTITIONS = 16
+
+_SUBREDDITS = RedditTables.SUBREDDITS.value
+_SUBMISSIONS = RedditTables.SUBMISSIONS.value
+_CROSSPOSTS = RedditTables.CROSSPOSTS.value
+_COMMENTS = RedditTables.COMMENTS.value
+
+_PRIMARY_KEYS = {
+    _SUBREDDITS: "name",
+    _SUBMISSIONS: "post_id",
+    _CROSSPOSTS: "crosspost_parent_id, crosspost_id",
+    _COMMENTS: "comment_id",
+}
+
+
+class Migration:
+    """
+    A version of the schema: the SQL that takes the database from the previous version to this one. The optional
+    migrations are only applied when they are asked for.
+    """
+    version: int
+    name: str
+    sql: str
+    optional: bool
+
+    def __init__(self, version: int, name: str, sql: str, optional: bool = False):
+        self.version = version
+        self.name = name
+        self.sql = sql
+        self.optional = optional
+
+
+def _add_primary_key(table: str, columns: str) -> str:
+    """
+    :return: the SQL that adds the primary key of a table created without one, removing its duplicated rows first.
+    """
+    equal_keys = " AND ".join(f"a.{column} = b.{column}" for column in columns.split(", "))
+    return f"""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = '{table}'::regclass AND contype = 'p') THEN
+                    DELETE FROM {table} a USING {table} b WHERE {equal_keys} AND a.ctid < b.ctid;
+                    ALTER TABLE {table} ADD PRIMARY KEY ({columns});
+                END IF;
+            END $$;
+            """
+
+
+MIGRATIONS = [
+    Migration(1, "tables", f"""
+              CREATE TABLE IF NOT EXISTS {_SUBREDDITS} (
+                  name text PRIMARY KEY,
+                  description text,
+                  date_created timestamp,
+                  nsfw boolean,
+                  subscribers bigint
+              );
+              CREATE TABLE IF NOT EXISTS {_SUBMISSIONS} (
+                  post_id text PRIMARY KEY,
+                  title text,
+                  author text,
+                  date_created timestamp,
+                  nsfw boolean,
+                  post_type text,
+                  upvote_ratio real,
+                  total_awards integer,
+                  num_crossposts integer,
+                  post_content text,
+                  video_duration integer,
+                  category text,
+                  subreddit text NOT NULL
+              );
+              CREATE TABLE IF NOT EXISTS {_CROSSPOSTS} (
+                  crosspost_parent_id text NOT NULL,
+                  crosspost_id text NOT NULL,
+                  PRIMARY KEY (crosspost_parent_id, crosspost_id)
+              );
+              CREATE TABLE IF NOT EXISTS {_COMMENTS} (
+                  comment_id text PRIMARY KEY,
+                  comment_content text,
+                  author text,
+                  date_created timestamp,
+                  parent_id text,
+                  submission_id text NOT NULL,
+                  upvote_ratio real,
+                  pinned boolean
+              );
+              """),
+    # The tables of the databases created by hand didn't have primary keys (so ON CONFLICT DO NOTHING didn't
+    # skip anything)
+    Migration(2, "primary keys", "".join(_add_primary_key(table, columns)
+                                         for table, columns in _PRIMARY_KEYS.items())),
+    # The crossposts of a submission (crosspost_parent_id) are found with the primary key, it's its first column.
+    # The subreddit index includes post_id, so get_uncompleted_subreddits only reads the index.
+    Migration(3, "indexes", f"""
+              CREATE INDEX IF NOT EXISTS submission_subreddit_idx ON {_SUBMISSIONS} (subreddit, post_id);
+              CREATE INDEX IF NOT EXISTS reddit_replies_submission_id_idx ON {_COMMENTS} (submission_id);
+              """),
+    # Watermark of the incremental updates of the recommendations (see model.incremental_update). The crossposts
+    # saved before get the epoch, so the first update reads them all, however soon after migrating it runs
+    Migration(4, "crosspost ingested_at", f"""
+              ALTER TABLE {_CROSSPOSTS} ADD COLUMN IF NOT EXISTS ingested_at timestamptz NOT NULL DEFAULT 'epoch';
+              ALTER TABLE {_CROSSPOSTS} ALTER COLUMN ingested_at SET DEFAULT now();
+              CREATE INDEX IF NOT EXISTS crosspost_ingested_at_idx ON {_CROSSPOSTS} (ingested_at);
+              """),
+    # The comments are only read by submission, so they are partitioned by it. The primary key of a partitioned
+    # table must include the partition key: (submission_id, comment_id) also replaces the submission_id index.
+    Migration(5, "partitioned comments", f"""
+              ALTER TABLE {_COMMENTS} RENAME TO {_COMMENTS}_unpartitioned;
+              ALTER INDEX {_COMMENTS}_pkey RENAME TO {_COMMENTS}_unpartitioned_pkey;
+              DROP INDEX IF EXISTS {_COMMENTS}_submission_id_idx;
+              CREATE TABLE {_COMMENTS} (
+                  LIKE {_COMMENTS}_unpartitioned INCLUDING DEFAULTS,
+                  PRIMARY KEY (submission_id, comment_id)
+              ) PARTITION BY HASH (submission_id);
+              DO $$
+              BEGIN
+                  FOR i IN 0..{COMMENTS_PARTITIONS - 1} LOOP
+                      EXECUTE format('CREATE TABLE {_COMMENTS}_%s PARTITION OF {_COMMENTS} '
+                                     'FOR VALUES WITH (MODULUS {COMMENTS_PARTITIONS}, REMAINDER %s);',
+                                     i, i);
+                  END LOOP;
+              END $$;
+              INSERT INTO {_COMMENTS} SELECT * FROM {_COMMENTS}_unpartitioned;
+              DROP TABLE {_COMMENTS}_unpartitioned;
+              """, optional=True),
+    # Subreddits to collect, shared by all the collectors (see information_recovery.crawl_frontier). The partial
+    # index keeps the subreddits that can be leased in order of priority.
+    Migration(6, "crawl frontier", """
+              CREATE TABLE IF NOT EXISTS crawl_frontier (
+                  subreddit text PRIMARY KEY,
+                  discovered_count integer NOT NULL DEFAULT 0,
+                  status text NOT NULL DEFAULT 'pending',
+                  attempts integer NOT NULL DEFAULT 0,
+                  available_at timestamptz NOT NULL DEFAULT now(),
+                  lease_owner text,
+                  last_error text,
+                  updated_at timestamptz NOT NULL DEFAULT now()
+              );
+              CREATE INDEX IF NOT EXISTS crawl_frontier_priority_idx
+              ON crawl_frontier (discovered_count DESC, subreddit) WHERE status IN ('pending', 'leased');
+              """),
+]
+
+
+def _get_connection(connection):
+    if connection is not None:
+        return nullcontext(connection)
+    from database.database import database
+    return database.connection()
+
+
+def applied_versions(connection=None) -> [int]:
+    """
+    :param connection: a psycopg2 connection. Can be null (one of the pool of the database).
+    :return: the versions already applied, in order.
+    """
+    with _get_connection(connection) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (SCHEMA_TABLE,))
+            if not cursor.fetchone()[0]:
+                return []
+            cursor.execute(f"SELECT version FROM {SCHEMA_TABLE} ORDER BY version;")
+            return [row[0] for row in cursor.fetchall()]
+
+
+def _apply(connection, migration: Migration) -> bool:
+    """
+    Applies a migration in a transaction, unless another process already did it.
+
+    :return: True if it was applied.
+    """
+    autocommit = connection.autocommit
+    connection.autocommit = False
+    try:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s);", (SCHEMA_LOCK,))
+                cursor.execute(f"""
+                               CREATE TABLE IF NOT EXISTS {SCHEMA_TABLE} (
+                                   version integer PRIMARY KEY,
+                                   name text NOT NULL,
+                                   applied_at timestamptz NOT NULL DEFAULT now()
+                               );
+                               """)
+                cursor.execute(f"SELECT 1 FROM {SCHEMA_TABLE} WHERE version = %s;", (migration.version,))
+                if cursor.fetchone():
+                    return False
+                cursor.execute(migration.sql)
+                cursor.execute(f"INSERT INTO {SCHEMA_TABLE} (version, name) VALUES (%s, %s);",
+                               (migration.version, migration.name))
+                return True
+    finally:
+        connection.autocommit = autocommit
+
+
+def migrate(connection=None, target_version: int = None, partition_comments: bool = False) -> [int]:
+    """
+    Brings the schema of the database up to date, applying the migrations that are missing.
+
+    :param connection: a psycopg2 connection. Can be null (one of the pool of the database).
+    :param target_version: the last version applied. Can be null (all of them).
+    :param partition_comments: if True, the comments table is partitioned (the optional migration, see
+    COMMENTS_PARTITIONS).
+    :return: the versions applied.
+    """
+    with _get_connection(connection) as connection:
+        applied = set(applied_versions(connection))
+        versions = []
+        for migration in MIGRATIONS:
+            if migration.version in applied or (target_version is not None and migration.version > target_version):
+                continue
+            if migration.optional and not partition_comments:
+                continue
+            logger.info("Applying migration %s: %s.", migration.version, migration.name)
+            if _apply(connection, migration):
+                versions.append(migration.version)
+        return versions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Creates or updates the schema of the PostgreSQL database.")
+    parser.add_argument("--status", action="store_true", help="only show the versions applied")
+    parser.add_argument("--target-version", type=int, default=None)
+    parser.add_argument("--partition-comments", action="store_true",
+                        help=f"partition the comments table ({COMMENTS_PARTITIONS} partitions by submission)")
+    arguments = parser.parse_args()
+
+    if arguments.status:
+        versions = applied_versions()
+        for migration in MIGRATIONS:
+            state = "applied" if migration.version in versions else "pending"
+            print(f"{migration.version}: {migration.name} ({state}{', optional' if migration.optional else ''})")
+    else:
+        versions = migrate(target_version=arguments.target_version, partition_comments=arguments.partition_comments)
+        print(f"Schema up to date ({len(versions)} migrations applied).")
@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from database.batches import to_rows, SubredditBatch, SubmissionBatch, CrossPostBatch, CommentBatch
+from database.database import RedditTables, SUBREDDITS_COLUMNS, SUBMISSIONS_COLUMNS, CROSSPOSTS_COLUMNS, \
+    COMMENTS_COLUMNS
+from database.storage import StorageBackend
+
+"""
+    File of the embedded database, and rows inserted by each transaction.
+"""
+SQLITE_PATH = os.getenv("SQLITE_PATH", "data/recommenddit.sqlite3")
+SQLITE_BATCH_SIZE = 50000
+
+"""
+    Tables and indexes, as in PostgreSQL: the subreddits of the submissions (resume queries), the parents of the
+    crossposts (covered by the primary key) and the submission of the comments.
+"""
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS {RedditTables.SUBREDDITS.value} (
+    name TEXT PRIMARY KEY,
+    description TEXT,
+    date_created TIMESTAMP,
+    nsfw BOOLEAN,
+    subscribers INTEGER
+);
+CREATE TABLE IF NOT EXISTS {RedditTables.SUBMISSIONS.value} (
+    post_id TEXT PRIMARY KEY,
+    title TEXT,
+    author TEXT,
+    date_created TIMESTAMP,
+    nsfw BOOLEAN,
+    post_type TEXT,
+    upvote_ratio REAL,
+    total_awards INTEGER,
+    num_crossposts INTEGER,
+    post_content TEXT,
+    video_duration INTEGER,
+    category TEXT,
+    subreddit TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS {RedditTables.CROSSPOSTS.value} (
+    crosspost_parent_id TEXT NOT NULL,
+    crosspost_id TEXT NOT NULL,
+    PRIMARY KEY (crosspost_parent_id, crosspost_id)
+);
+CREATE TABLE IF NOT EXISTS {RedditTables.COMMENTS.value} (
+    comment_id TEXT PRIMARY KEY,
+    comment_content TEXT,
+    author TEXT,
+    date_created TIMESTAMP,
+    parent_id TEXT,
+    submission_id TEXT NOT NULL,
+    upvote_ratio REAL,
+    pinned BOOLEAN
+);
+CREATE INDEX IF NOT EXISTS submission_subreddit_idx ON {RedditTables.SUBMISSIONS.value} (subreddit, post_id);
+CREATE INDEX IF NOT EXISTS reddit_replies_submission_id_idx ON {RedditTables.COMMENTS.value} (submission_id);
+"""
+
+sqlite3.register_adapter(datetime, lambda date: date.isoformat(" "))
+
+
+class SqliteDatabase(StorageBackend):
+    """
+    Embedded storage in a SQLite file, with the same tables as the PostgreSQL database. It's tuned for bulk writes:
+    WAL journal, one transaction for each batch and the same (prepared) INSERT for all the rows of a batch.
+
+    There is a single connection, shared by all the threads (SQLite only has one writer at a time anyway), which is
+    opened the first time it's needed.
+    """
+
+    def __init__(self, path: str = SQLITE_PATH, batch_size: int = SQLITE_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._connection = None
+        self._lock = threading.RLock()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._connection is None:
+                if os.path.dirname(self.path):
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None,
+                                             cached_statements=256)
+                connection.execute("PRAGMA journal_mode=WAL;")
+                connection.execute("PRAGMA synchronous=NORMAL;")
+                connection.execute("PRAGMA temp_store=MEMORY;")
+                connection.execute("PRAGMA cache_size=-65536;")  # KiB
+                connection.executescript(SCHEMA)
+                self._connection = connection
+            return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the statements of the context in a single transaction (rolled back on errors).
+        """
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute("BEGIN IMMEDIATE;")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK;")
+                raise
+            connection.execute("COMMIT;")
+
+    def fetch_all(self, sql_statement: str, params=()):
+        with self._lock:
+            return self._get_connection().execute(sql_statement, params).fetchall()
+
+    def iter_rows(self, sql_statement: str, batch_size: int = 10000):
+        with self._lock:
+            cursor = self._get_connection().execute(sql_statement)
+            rows = cursor.fetchmany(batch_size)
+        while rows:
+            yield rows
+            with self._lock:
+                rows = cursor.fetchmany(batch_size)
+
+    def add_rows(self, table: str, columns: str, rows) -> int:
+        """
+        Inserts the rows, ignoring the ones already saved, in transactions of batch_size rows.
+
+        :return: the number of rows inserted.
+        """
+        number_columns = len(columns.split(","))
+        insert_query = f"INSERT OR IGNORE INTO {table} ({columns}) VALUES ({', '.join('?' * number_columns)});"
+
+        number_inserted = 0
+        for start in range(0, len(rows), self.batch_size):
+            with self.transaction() as connection:
+                number_inserted += connection.executemany(insert_query, rows[start:start + self.batch_size]).rowcount
+        return number_inserted
+
+    def save_subreddits(self, subreddits: ["Subreddit"]):
+        return self.add_rows(RedditTables.SUBREDDITS.value, SUBREDDITS_COLUMNS, to_rows(subreddits, SubredditBatch))
+
+    def save_submissions(self, submissions: ["RedditSubmission"]):
+        return self.add_rows(RedditTables.SUBMISSIONS.value, SUBMISSIONS_COLUMNS,
+                             to_rows(submissions, SubmissionBatch))
+
+    def save_crossposts(self, crossposts: ["CrossPost"]):
+        return self.add_rows(RedditTables.CROSSPOSTS.value, CROSSPOSTS_COLUMNS, to_rows(crossposts, CrossPostBatch))
+
+    def save_comments(self, comments: ["RedditComment"]):
+        return self.add_rows(RedditTables.COMMENTS.value, COMMENTS_COLUMNS, to_rows(comments, CommentBatch))
+
+    def submission_exists(self, post_id: str) -> bool:
+        return bool(self.fetch_all(f"SELECT 1 FROM {RedditTables.SUBMISSIONS.value} WHERE post_id = ? LIMIT 1;",
+                                   (post_id,)))
+
+    def get_unsaved_subreddits(self):
+        sql_select = f"""
+                     SELECT submission.subreddit
+                     FROM (SELECT DISTINCT subreddit FROM {RedditTables.SUBMISSIONS.value}) AS submission
+                     WHERE NOT EXISTS (SELECT 1 FROM {RedditTables.SUBREDDITS.value} AS subreddit
+                                       WHERE subreddit.name = submission.subreddit);
+                     """
+        return self.fetch_all(sql_select)
+
+    def get_uncompleted_subreddits(self, min_submissions: int):
+        sql_select = f"""
+                     SELECT submission.subreddit, max(submission.post_id) AS last_id,
+                            count(submission.post_id) AS number_posts
+                     FROM {RedditTables.SUBMISSIONS.value} AS submission
+                     JOIN {RedditTables.SUBREDDITS.value} AS subreddit ON (subreddit.name = submission.subreddit)
+                     WHERE EXISTS (SELECT 1 FROM {RedditTables.CROSSPOSTS.value} AS crosspost
+                                   WHERE crosspost.crosspost_parent_id = submission.post_id)
+                     GROUP BY submission.subreddit
+                     HAVING count(submission.post_id) < ?
+                     ORDER BY number_posts ASC;
+                     """
+        return self.fetch_all(sql_select, (min_submissions,))
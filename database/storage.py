@@ -0,0 +1,100 @@
+import os
+from abc import ABC, abstractmethod
+
+"""
+    Storage of the collected data: "postgres" (database.Database, the default) or "sqlite" (an embedded database in
+    a file, see sqlite_database.SqliteDatabase). It's chosen with the environment variable STORAGE_BACKEND.
+"""
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+STORAGE_BACKENDS = ("postgres", "sqlite")
+
+_storages = {}
+
+
+class StorageBackend(ABC):
+    """
+    Operations needed by the collection (and the models) over the stored data. The save_* methods take a list of
+    records or a RecordBatch (see batches.py), and ignore the records already saved. A backend implements all the
+    abstract methods (otherwise it can't be instantiated).
+    """
+
+    @abstractmethod
+    def save_subreddits(self, subreddits: ["Subreddit"]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_submissions(self, submissions: ["RedditSubmission"]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_crossposts(self, crossposts: ["CrossPost"]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_comments(self, comments: ["RedditComment"]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_unsaved_subreddits(self):
+        """
+        :return: a list of rows (subreddit,) of the subreddits of the submissions that are not in the subreddit table.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_uncompleted_subreddits(self, min_submissions: int):
+        """
+        :return: a list of rows (subreddit, last_id, number_posts) of the saved subreddits with less than
+        min_submissions crossposted submissions, the ones with fewer first.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def submission_exists(self, post_id: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_rows(self, sql_statement: str, batch_size: int = 10000):
+        """
+        :return: a generator of lists of rows (of at most batch_size rows) of a query.
+        """
+        raise NotImplementedError
+
+    def iter_column(self, column: str, table: str, batch_size: int = 10000):
+        """
+        :return: a generator of all the values of a column of a table.
+        """
+        for rows in self.iter_rows(f"SELECT {column} FROM {table};", batch_size=batch_size):
+            for row in rows:
+                yield row[0]
+
+    def close(self):
+        pass
+
+
+def require_postgres(feature: str):
+    """
+    Fails with a clear error when a feature that only exists in PostgreSQL is used with another backend.
+
+    :param feature: the description of the feature (e.g. "The crawl frontier").
+    """
+    if STORAGE_BACKEND != "postgres":
+        raise ValueError(f"{feature} needs PostgreSQL, but STORAGE_BACKEND is '{STORAGE_BACKEND}'.")
+
+
+def get_storage(backend: str = None) -> StorageBackend:
+    """
+    :param backend: "postgres" or "sqlite". Can be null (STORAGE_BACKEND).
+    :return: the storage of the backend (the same instance each time).
+    """
+    backend = backend or STORAGE_BACKEND
+    if backend not in _storages:
+        if backend == "postgres":
+            from database.database import database
+            _storages[backend] = database
+        elif backend == "sqlite":
+            from database.sqlite_database import SqliteDatabase
+            _storages[backend] = SqliteDatabase()
+        else:
+            raise ValueError(f"Unknown storage backend '{backend}'. Options: {STORAGE_BACKENDS}.")
+    return _storages[backend]
@@ -5,6 +5,8 @@ class Subreddit:
     """
     Model for a Subreddit.
     """
+    __slots__ = ("name", "description", "date_created", "nsfw", "subscribers")
+
     name: str
     description: str
     date_created: datetime
@@ -31,6 +33,9 @@ class RedditComment:
     """
     Model for a RedditComment.
     """
+    __slots__ = ("id", "author", "date_created", "parent_id", "submission_id", "upvote_ratio", "pinned", "text",
+                 "replies")
+
     id: str
     author: str
     date_created: datetime
@@ -51,9 +56,12 @@ class RedditComment:
         self.upvote_ratio = upvote_ratio
         self.pinned = pinned
         self.text = text
-        self.replies = []
+        # Most comments don't have replies: the list is only created for the first one
+        self.replies = ()
 
     def add_reply(self, reply: "RedditComment"):
+        if not self.replies:
+            self.replies = []
         self.replies.append(reply)
 
     def __str__(self):
@@ -73,6 +81,9 @@ class RedditSubmission:
     """
     Model for a RedditSubmission.
     """
+    __slots__ = ("id", "title", "date_created", "author", "nsfw", "comments", "post_type", "total_awards",
+                 "num_crossposts", "text", "subreddit", "upvote_ratio", "category", "video_duration")
+
     id: str
     title: str
     date_created: datetime
@@ -127,6 +138,8 @@ class CrossPost:
     """
     Model for a CrossPost.
     """
+    __slots__ = ("crosspost_parent_id", "post_id")
+
     crosspost_parent_id: str
     post_id: str
 
@@ -0,0 +1,101 @@
+from database.batches import SubredditBatch, SubmissionBatch, CommentBatch, CrossPostBatch
+from database.subreddit import Subreddit, RedditSubmission, RedditComment, CrossPost
+from information_recovery.checkpoints import Checkpoint
+from utils.metrics import metrics
+
+"""
+    Number of records kept in memory before they are written.
+"""
+DEFAULT_BATCH_SIZE = 500
+
+
+class BatchWriter:
+    """
+    Buffers the records yielded by reddit_connection.stream_submissions and writes them in fixed-size batches, so the
+    memory used by a collection is bounded and the records already retrieved are written even if it fails. The records
+    are buffered in columnar batches (see database.batches), which are passed as they are to the save functions.
+
+    The Checkpoint's of the stream are not written with the records: the last one is saved after the batch that
+    contains its submissions was written, so a checkpoint never points past the saved data.
+
+    The time of each write ("write" stage) and the rows written are recorded in the metrics (see utils.metrics).
+    """
+
+    def __init__(self, save_subreddits, save_submissions, save_comments, save_crossposts,
+                 batch_size: int = DEFAULT_BATCH_SIZE, lock=None, save_checkpoint=None):
+        """
+        :param save_subreddits: function that saves a SubredditBatch.
+        :param save_submissions: function that saves a SubmissionBatch (without the comments).
+        :param save_comments: function that saves a CommentBatch.
+        :param save_crossposts: function that saves a CrossPostBatch.
+        :param batch_size: number of records buffered before writing them.
+        :param lock: optional lock taken while writing, when several writers share the same sink.
+        :param save_checkpoint: optional function that saves a Checkpoint (e.g. CheckpointStore.save).
+        """
+        self.batch_size = batch_size
+        self.lock = lock
+        self.saves = {
+            Subreddit: (SubredditBatch, save_subreddits),
+            RedditSubmission: (SubmissionBatch, save_submissions),
+            RedditComment: (CommentBatch, save_comments),
+            CrossPost: (CrossPostBatch, save_crossposts),
+        }
+        self.buffers = {record_type: batch_class() for record_type, (batch_class, _) in self.saves.items()}
+        self.buffered = 0
+        self.save_checkpoint = save_checkpoint
+        self.checkpoint = None
+
+    def add(self, record):
+        if isinstance(record, Checkpoint):
+            self.checkpoint = record
+            return
+
+        self.buffers[type(record)].append(record)
+        self.buffered += 1
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all the buffered records. Subreddits and submissions are written before the comments and crossposts
+        that reference them.
+        """
+        if self.buffered:
+            if self.lock:
+                with self.lock:
+                    self._write()
+            else:
+                self._write()
+
+        if self.checkpoint and self.save_checkpoint:
+            self.save_checkpoint(self.checkpoint)
+        self.checkpoint = None
+
+    def _write(self):
+        for record_type, (batch_class, save) in self.saves.items():
+            batch = self.buffers[record_type]
+            if batch:
+                with metrics.timer("write", record=record_type.__name__):
+                    save(batch)
+                metrics.count("rows_written_total", len(batch), record=record_type.__name__)
+                self.buffers[record_type] = batch_class()
+        self.buffered = 0
+
+
+def write_stream(records, writer: BatchWriter):
+    """
+    Writes all the records of a stream in batches. The buffered records are written also when the stream fails, and
+    then the exception is raised again.
+
+    :param records: an iterable of Subreddit, RedditSubmission, RedditComment and CrossPost instances.
+    :param writer: the BatchWriter used to write them.
+    :return: the number of records written.
+    """
+    number_records = 0
+    try:
+        for record in records:
+            writer.add(record)
+            number_records += not isinstance(record, Checkpoint)
+    finally:
+        writer.flush()
+    return number_records
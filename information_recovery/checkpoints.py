@@ -0,0 +1,213 @@
+import os
+import sqlite3
+import threading
+import time
+
+"""
+    Incremental collection (see reddit_connection.stream_new_submissions): the comments of the submissions created in
+    the last REFRESH_WINDOW seconds are collected again when their number of comments changed. It's chosen with the
+    environment variable REFRESH_WINDOW.
+"""
+REFRESH_WINDOW = int(os.getenv("REFRESH_WINDOW", 3 * 24 * 3600))  # 3 days
+
+
+class Checkpoint:
+    """
+    Progress of the collection of a subreddit: the fullname of the last submission saved (e.g. "t3_abc123"), the
+    number of submissions saved so far, and whether the collection was completed.
+    """
+    subreddit: str
+    last_fullname: str
+    count: int
+    completed: bool
+
+    def __init__(self, subreddit: str, last_fullname: str = None, count: int = 0, completed: bool = False):
+        self.subreddit = subreddit
+        self.last_fullname = last_fullname
+        self.count = count
+        self.completed = completed
+
+    def last_submission(self):
+        """
+        :return: the [str, int] expected by reddit_connection.stream_submissions to resume the collection, or None
+        if nothing was saved yet.
+        """
+        return [self.last_fullname, self.count] if self.count else None
+
+    def __str__(self):
+        return f"Checkpoint. " \
+               f"\n\tsubreddit: '{self.subreddit}'. " \
+               f"\n\tlast_fullname: '{self.last_fullname}'. " \
+               f"\n\tcount: {self.count}. " \
+               f"\n\tcompleted: {self.completed}. "
+
+
+class RefreshMark(Checkpoint):
+    """
+    Progress of an incremental collection of a subreddit: the high-water mark (created_utc of the newest submission
+    collected), and the number of comments of the submissions created since window_start, to know which ones changed
+    the next time. It's yielded once, at the end, so it only moves forward when the whole collection was saved.
+    """
+    high_water_mark: float
+    comment_counts: dict
+    window_start: float
+
+    def __init__(self, subreddit: str, last_fullname: str = None, count: int = 0, high_water_mark: float = None,
+                 comment_counts: dict = None, window_start: float = None):
+        """
+        :param count: the number of new submissions collected.
+        :param comment_counts: a dict of submission id -> (created_utc, number of comments).
+        """
+        super().__init__(subreddit=subreddit, last_fullname=last_fullname, count=count, completed=True)
+        self.high_water_mark = high_water_mark
+        self.comment_counts = comment_counts or {}
+        self.window_start = window_start
+
+
+class CheckpointStore:
+    """
+    Durable journal (a local SQLite file) with the progress of the collection of each subreddit, so a collection can
+    be resumed without reading the collected data, whatever the order of the list of subreddits.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """
+        Opens the file the first time it's needed (with the lock taken), so creating a store costs nothing.
+        """
+        if self._connection is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL;")
+            connection.execute("""
+                               CREATE TABLE IF NOT EXISTS checkpoint (
+                                  subreddit TEXT PRIMARY KEY,
+                                  last_fullname TEXT,
+                                  count INTEGER NOT NULL DEFAULT 0,
+                                  completed INTEGER NOT NULL DEFAULT 0,
+                                  updated_at REAL NOT NULL
+                               );
+                               """)
+            connection.execute("""
+                               CREATE TABLE IF NOT EXISTS high_water_mark (
+                                  subreddit TEXT PRIMARY KEY,
+                                  created_utc REAL NOT NULL,
+                                  updated_at REAL NOT NULL
+                               );
+                               """)
+            connection.execute("""
+                               CREATE TABLE IF NOT EXISTS recent_submission (
+                                  submission_id TEXT PRIMARY KEY,
+                                  subreddit TEXT NOT NULL,
+                                  created_utc REAL NOT NULL,
+                                  num_comments INTEGER NOT NULL
+                               );
+                               """)
+            connection.execute("CREATE INDEX IF NOT EXISTS recent_submission_subreddit_idx "
+                               "ON recent_submission (subreddit, created_utc);")
+            self._connection = connection
+        return self._connection
+
+    def get(self, subreddit: str):
+        """
+        :param subreddit: a str representing the name of a subreddit.
+        :return: the Checkpoint of the subreddit, or None if it was never collected.
+        """
+        with self._lock:
+            row = self._get_connection().execute("SELECT last_fullname, count, completed FROM checkpoint "
+                                                 "WHERE subreddit = ?;", (subreddit,)).fetchone()
+        if not row:
+            return None
+        return Checkpoint(subreddit=subreddit, last_fullname=row[0], count=row[1], completed=bool(row[2]))
+
+    def save(self, checkpoint: Checkpoint):
+        if isinstance(checkpoint, RefreshMark):
+            self._save_refresh(checkpoint)
+            return
+
+        with self._lock:
+            self._get_connection().execute(
+                "INSERT INTO checkpoint (subreddit, last_fullname, count, completed, updated_at) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (subreddit) DO UPDATE SET last_fullname = excluded.last_fullname, "
+                "count = excluded.count, completed = excluded.completed, updated_at = excluded.updated_at;",
+                (checkpoint.subreddit, checkpoint.last_fullname, checkpoint.count, int(checkpoint.completed),
+                 time.time()))
+
+    def _save_refresh(self, mark: RefreshMark):
+        """
+        Saves the high-water mark (it never goes back) and the comment counts of an incremental collection, and
+        forgets the submissions older than its window, in a single transaction.
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute("BEGIN;")
+            try:
+                connection.execute(
+                    "INSERT INTO high_water_mark (subreddit, created_utc, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT (subreddit) DO UPDATE SET created_utc = max(created_utc, excluded.created_utc), "
+                    "updated_at = excluded.updated_at;", (mark.subreddit, mark.high_water_mark, now))
+                connection.executemany(
+                    "INSERT INTO recent_submission (submission_id, subreddit, created_utc, num_comments) "
+                    "VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (submission_id) DO UPDATE SET num_comments = excluded.num_comments;",
+                    [(submission_id, mark.subreddit, created_utc, num_comments)
+                     for submission_id, (created_utc, num_comments) in mark.comment_counts.items()])
+                if mark.window_start is not None:
+                    connection.execute("DELETE FROM recent_submission WHERE subreddit = ? AND created_utc < ?;",
+                                       (mark.subreddit, mark.window_start))
+                connection.execute("COMMIT;")
+            except BaseException:
+                connection.execute("ROLLBACK;")
+                raise
+
+    def refresh_point(self, subreddit: str):
+        """
+        :param subreddit: a str representing the name of a subreddit.
+        :return:
+            - high_water_mark: the created_utc of the newest submission collected by the incremental collection, or
+            None if it was never collected incrementally.
+            - comment_counts: a dict of submission id -> number of comments, of the recent submissions.
+        """
+        with self._lock:
+            connection = self._get_connection()
+            row = connection.execute("SELECT created_utc FROM high_water_mark WHERE subreddit = ?;",
+                                     (subreddit,)).fetchone()
+            rows = connection.execute("SELECT submission_id, num_comments FROM recent_submission "
+                                      "WHERE subreddit = ?;", (subreddit,)).fetchall()
+        return (row[0] if row else None), dict(rows)
+
+    def complete(self, subreddit: str):
+        checkpoint = self.get(subreddit) or Checkpoint(subreddit=subreddit)
+        checkpoint.completed = True
+        self.save(checkpoint)
+
+    def resume_point(self, subreddit: str, last_submission: [str, int] = None):
+        """
+        :param subreddit: a str representing the name of a subreddit.
+        :param last_submission: optional [str, int] known from elsewhere (e.g. the database). The furthest of this
+        one and the checkpoint is used.
+        :return:
+            - completed: True if the collection of the subreddit was already completed.
+            - last_submission: the [str, int] needed to resume the collection, or None to start from the beginning.
+        """
+        checkpoint = self.get(subreddit)
+        if not checkpoint:
+            return False, last_submission
+
+        saved_submission = checkpoint.last_submission()
+        if saved_submission and (not last_submission or saved_submission[1] > last_submission[1]):
+            last_submission = saved_submission
+        return checkpoint.completed, last_submission
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
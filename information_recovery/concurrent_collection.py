@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils.metrics import get_logger
+
+logger = get_logger("concurrent_collection")
+
+"""
+    Default number of subreddits that are collected at the same time.
+"""
+DEFAULT_MAX_WORKERS = 4
+
+
+def collect_concurrently(subreddits: [str], collect, max_workers: int = DEFAULT_MAX_WORKERS):
+    """
+    Collects several subreddits at the same time using a bounded pool of threads. Almost all the time of a collection
+    is spent waiting on the Reddit API, so having several subreddits in flight shortens the crawl. The API budget is
+    shared by all the workers (see reddit_connection.api_budget).
+
+    The collect function is in charge of saving what it retrieves. Sinks that are not thread-safe (like the csv
+    files) are written with a lock (see batch_writer.BatchWriter), so the workers write one at a time. A subreddit
+    that fails is logged and doesn't stop the others.
+
+    :param subreddits: list of str representing subreddits.
+    :param collect: function that receives a subreddit name, collects its information and saves it.
+    :param max_workers: maximum number of subreddits collected at the same time.
+    :return: the subreddits that failed.
+    """
+
+    def worker(subreddit):
+        logger.info("Getting posts from subreddit: '%s'.", subreddit)
+        collect(subreddit)
+        logger.info("\t Saving information of subreddit: '%s'.", subreddit)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(worker, subreddit): subreddit for subreddit in subreddits}
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logger.exception("[%s] The collection failed, going on with the next subreddit.", futures[future])
+                failed.append(futures[future])
+
+    return failed
@@ -0,0 +1,297 @@
+import argparse
+import os
+import socket
+import threading
+import time
+
+from database.database import database, Database, RedditTables
+from utils.metrics import get_logger
+
+"""
+    Crawl frontier: the subreddits discovered through crossposts that are still to be collected, in a table of the
+    PostgreSQL database (crawl_frontier, see database/schema.py). Any number of collectors, in any number of
+    machines, lease subreddits from it: each lease takes the pending subreddit discovered more times, skipping the
+    ones leased by others (SELECT ... FOR UPDATE SKIP LOCKED), so no subreddit is collected twice at the same time.
+
+    A lease expires after LEASE_SECONDS (e.g. the collector died), and the subreddit can be leased again. A
+    subreddit that fails is retried later (RETRY_DELAY seconds, doubled after each attempt), up to MAX_ATTEMPTS
+    attempts, and then it's marked as failed. The failures of a subreddit never stop the collection of the others.
+
+    The subreddits found by the crawl itself are added (and the expired leases without attempts left are marked as
+    failed) by discover(), which each worker runs every DISCOVER_EVERY leases and whenever the frontier is empty.
+"""
+LEASE_SECONDS = 1800  # 30 minutes, twice the timeout of the stream of a subreddit (15 minutes)
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 300  # seconds
+IDLE_WAIT = 30  # seconds between leases when the frontier is empty (with wait=True)
+DISCOVER_EVERY = 20  # leases
+
+FRONTIER_TABLE = "crawl_frontier"
+FRONTIER_VERSION = 6  # version of the schema that adds the frontier table (see database.schema.MIGRATIONS)
+
+"""
+    Status of a subreddit in the frontier.
+"""
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+logger = get_logger("crawl_frontier")
+
+"""
+    Adds the subreddits of the duplicates of crossposts that are not saved yet, and updates the number of times each
+    subreddit was discovered (its priority).
+"""
+SQL_DISCOVER = f"""
+               INSERT INTO {FRONTIER_TABLE} (subreddit, discovered_count)
+               SELECT child.subreddit, count(*)
+               FROM {RedditTables.CROSSPOSTS.value} AS crosspost
+               JOIN {RedditTables.SUBMISSIONS.value} AS child ON (child.post_id = crosspost.crosspost_id)
+               WHERE NOT EXISTS (SELECT 1 FROM {RedditTables.SUBREDDITS.value} AS subreddit
+                                 WHERE subreddit.name = child.subreddit)
+               GROUP BY child.subreddit
+               ON CONFLICT (subreddit) DO UPDATE SET discovered_count = excluded.discovered_count
+               WHERE {FRONTIER_TABLE}.discovered_count < excluded.discovered_count;
+               """
+
+SQL_LEASE = f"""
+            WITH next AS (
+                SELECT subreddit FROM {FRONTIER_TABLE}
+                WHERE status IN ('{PENDING}', '{LEASED}') AND available_at <= now() AND attempts < %(max_attempts)s
+                ORDER BY discovered_count DESC, subreddit
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE {FRONTIER_TABLE} AS frontier
+            SET status = '{LEASED}', lease_owner = %(owner)s, attempts = frontier.attempts + 1,
+                available_at = now() + %(lease)s * interval '1 second', updated_at = now()
+            FROM next
+            WHERE frontier.subreddit = next.subreddit
+            RETURNING frontier.subreddit, frontier.attempts;
+            """
+
+SQL_RENEW = f"""
+            UPDATE {FRONTIER_TABLE} SET available_at = now() + %(lease)s * interval '1 second', updated_at = now()
+            WHERE subreddit = %(subreddit)s AND status = '{LEASED}' AND lease_owner = %(owner)s
+            RETURNING subreddit;
+            """
+
+SQL_COMPLETE = f"""
+               UPDATE {FRONTIER_TABLE} SET status = '{DONE}', lease_owner = NULL, last_error = NULL, updated_at = now()
+               WHERE subreddit = %(subreddit)s AND status = '{LEASED}' AND lease_owner = %(owner)s;
+               """
+
+SQL_FAIL = f"""
+           UPDATE {FRONTIER_TABLE}
+           SET status = CASE WHEN attempts >= %(max_attempts)s THEN '{FAILED}' ELSE '{PENDING}' END,
+               available_at = now() + %(retry_delay)s * power(2, attempts - 1) * interval '1 second',
+               lease_owner = NULL, last_error = %(error)s, updated_at = now()
+           WHERE subreddit = %(subreddit)s AND status = '{LEASED}' AND lease_owner = %(owner)s;
+           """
+
+# The leases that expired after the last attempt (the collector died every time)
+SQL_EXPIRE = f"""
+             UPDATE {FRONTIER_TABLE} SET status = '{FAILED}', lease_owner = NULL,
+                                         last_error = 'The lease expired', updated_at = now()
+             WHERE status = '{LEASED}' AND available_at <= now() AND attempts >= %(max_attempts)s;
+             """
+
+
+def default_owner() -> str:
+    """
+    :return: a str identifying the collector (host, process and thread).
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+
+def check_schema():
+    """
+    Fails if the schema of the database doesn't have the frontier table yet. The schema is not changed from the
+    collectors (migrating removes duplicated rows and adds keys on the live tables).
+    """
+    from database.schema import applied_versions
+
+    if FRONTIER_VERSION not in applied_versions():
+        raise RuntimeError(f"The database has no {FRONTIER_TABLE} table (migration {FRONTIER_VERSION} of the "
+                           f"schema). Update the schema first: python -m database.schema")
+
+
+class CrawlFrontier:
+    """
+    Operations over the crawl frontier table (see the description above).
+    """
+
+    def __init__(self, lease_seconds: int = LEASE_SECONDS, max_attempts: int = MAX_ATTEMPTS,
+                 retry_delay: int = RETRY_DELAY, db: Database = None):
+        """
+        :param lease_seconds: seconds a subreddit is leased (and each renewal extends it).
+        :param max_attempts: maximum number of times a subreddit is leased.
+        :param retry_delay: seconds before a failed subreddit can be leased again (doubled after each attempt).
+        :param db: the PostgreSQL database. Can be null (database.database).
+        """
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.database = db or database
+
+    def add(self, subreddits: [str]):
+        """
+        Adds subreddits to the frontier (e.g. the seeds of the crawl), with the highest priority. The subreddits
+        already in the frontier are not changed.
+        """
+        values = [(subreddit,) for subreddit in subreddits]
+        self.database.run(lambda cursor: cursor.executemany(
+            f"INSERT INTO {FRONTIER_TABLE} (subreddit, discovered_count) VALUES (%s, 2147483647) "
+            f"ON CONFLICT (subreddit) DO NOTHING;", values))
+
+    def discover(self) -> int:
+        """
+        Adds the subreddits discovered through crossposts that are not in the frontier yet, updates the priorities of
+        the others, and marks as failed the expired leases without attempts left.
+
+        :return: the number of subreddits added or updated.
+        """
+        def operation(cursor):
+            cursor.execute(SQL_DISCOVER)
+            number_subreddits = cursor.rowcount
+            cursor.execute(SQL_EXPIRE, {"max_attempts": self.max_attempts})
+            return number_subreddits
+
+        return self.database.run(operation)
+
+    def lease(self, owner: str):
+        """
+        :param owner: the collector that leases the subreddit (see default_owner).
+        :return: the subreddit with the highest priority and the attempt (1 the first time), or None if there are no
+        subreddits available.
+        """
+        rows = self.database.fetch_all(SQL_LEASE, {"owner": owner, "lease": self.lease_seconds,
+                                                   "max_attempts": self.max_attempts})
+        return (rows[0][0], rows[0][1]) if rows else None
+
+    def renew(self, subreddit: str, owner: str) -> bool:
+        """
+        Extends the lease of a subreddit that is still being collected.
+
+        :return: False if the lease was lost (it expired and another collector took it).
+        """
+        return bool(self.database.fetch_all(SQL_RENEW, {"subreddit": subreddit, "owner": owner,
+                                                        "lease": self.lease_seconds}))
+
+    def complete(self, subreddit: str, owner: str):
+        """
+        Marks a collected subreddit as done. Nothing is done if the lease was lost (another collector has it now).
+        """
+        self.database.run(lambda cursor: cursor.execute(SQL_COMPLETE, {"subreddit": subreddit, "owner": owner}))
+
+    def fail(self, subreddit: str, owner: str, error: str):
+        """
+        Gives back a subreddit that couldn't be collected: it's retried later, or marked as failed if it has no
+        attempts left.
+        """
+        self.database.run(lambda cursor: cursor.execute(SQL_FAIL, {
+            "subreddit": subreddit, "owner": owner, "error": error[:1000], "max_attempts": self.max_attempts,
+            "retry_delay": self.retry_delay}))
+
+    def stats(self) -> dict:
+        """
+        :return: the number of subreddits of each status.
+        """
+        return dict(self.database.fetch_all(f"SELECT status, count(*) FROM {FRONTIER_TABLE} GROUP BY status;"))
+
+
+def crawl_worker(frontier: CrawlFrontier, collect, max_subreddits: int = None, wait: bool = False):
+    """
+    Leases subreddits from the frontier and collects them, one after the other, until there are no subreddits
+    available (or max_subreddits were collected). The frontier is updated with the subreddits discovered every
+    DISCOVER_EVERY subreddits, and when it's empty. The failure of a subreddit is recorded in the frontier, and the
+    worker goes on with the next one.
+
+    :param frontier: the CrawlFrontier.
+    :param collect: function that receives a subreddit name and a function to call while it makes progress (to
+    renew the lease), collects its information and saves it.
+    :param max_subreddits: maximum number of subreddits collected. Can be null (no limit).
+    :param wait: if True, the worker waits for new subreddits when the frontier is empty, instead of returning.
+    :return: the number of subreddits collected and failed.
+    """
+    owner = default_owner()
+    collected, failed = 0, 0
+    while max_subreddits is None or collected + failed < max_subreddits:
+        if collected + failed and (collected + failed) % DISCOVER_EVERY == 0:
+            frontier.discover()
+        leased = frontier.lease(owner)
+        if not leased:
+            # The subreddits found since the last discovery, and the leases that expired
+            frontier.discover()
+            leased = frontier.lease(owner)
+        if not leased:
+            if not wait:
+                break
+            time.sleep(IDLE_WAIT)
+            continue
+
+        subreddit, attempt = leased
+        logger.info("Getting posts from subreddit: '%s' (attempt %s).", subreddit, attempt)
+
+        def renew():
+            if not frontier.renew(subreddit, owner):
+                logger.warning("[%s] The lease expired, another collector may be collecting it.", subreddit)
+
+        try:
+            collect(subreddit, renew)
+        except Exception as e:
+            failed += 1
+            logger.exception("[%s] The collection failed, it will be retried later.", subreddit)
+            frontier.fail(subreddit, owner, f"{type(e).__name__}: {e}")
+            continue
+
+        frontier.complete(subreddit, owner)
+        collected += 1
+        logger.info("\t Saving information of subreddit: '%s'.", subreddit)
+    return collected, failed
+
+
+def crawl(collect, workers: int = 1, max_subreddits: int = None, wait: bool = False,
+          frontier: CrawlFrontier = None):
+    """
+    Collects the subreddits of the frontier with several workers (threads) at the same time. Other processes can
+    crawl the same frontier at the same time.
+
+    :param collect: see crawl_worker.
+    :param workers: number of subreddits collected at the same time.
+    :param max_subreddits: maximum number of subreddits collected by each worker. Can be null (no limit).
+    :param wait: see crawl_worker.
+    :param frontier: the CrawlFrontier. Can be null (default parameters).
+    :return: the number of subreddits collected and failed.
+    """
+    frontier = frontier or CrawlFrontier()
+    frontier.discover()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(crawl_worker(frontier, collect, max_subreddits, wait)),
+                                name=f"crawler-{number}")
+               for number in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    collected, failed = sum(result[0] for result in results), sum(result[1] for result in results)
+    logger.info("%s subreddits collected, %s failed. Frontier: %s", collected, failed, frontier.stats())
+    return collected, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Crawl frontier shared by the collectors.")
+    parser.add_argument("command", choices=("discover", "add", "stats"))
+    parser.add_argument("subreddits", nargs="*", help="the subreddits added (add)")
+    arguments = parser.parse_args()
+
+    check_schema()
+    crawl_frontier = CrawlFrontier()
+    if arguments.command == "discover":
+        print(f"{crawl_frontier.discover()} subreddits added or updated.")
+    elif arguments.command == "add":
+        crawl_frontier.add(arguments.subreddits)
+    print(crawl_frontier.stats())
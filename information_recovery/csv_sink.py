@@ -0,0 +1,205 @@
+import csv
+import gzip
+import io
+import os
+import threading
+import time
+
+"""
+    Default thresholds to write the buffered rows: number of rows, and seconds since the last write.
+"""
+DEFAULT_FLUSH_ROWS = 5000
+DEFAULT_FLUSH_SECONDS = 30
+
+COMPRESSION_SUFFIXES = {
+    None: "",
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+
+
+def compressed_path(path: str, compression: str = None) -> str:
+    """
+    :param path: the path of the csv file.
+    :param compression: None, "gzip" or "zstd".
+    :return: the path of the file with the suffix of the compression.
+    """
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"Unknown compression '{compression}'. Options: {list(COMPRESSION_SUFFIXES)}")
+    return path + COMPRESSION_SUFFIXES[compression]
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression needs the 'zstandard' package (pip install zstandard).")
+    return zstandard
+
+
+def open_csv(path: str, compression: str = None):
+    """
+    Opens a csv file (written by CsvSink) for reading.
+
+    :param path: the path of the csv file, without the suffix of the compression.
+    :param compression: None, "gzip" or "zstd".
+    :return: a text file object.
+    """
+    path = compressed_path(path, compression)
+    if compression == "gzip":
+        return gzip.open(path, "rt", encoding="utf8", newline="")
+    if compression == "zstd":
+        # read_across_frames: each time the file is opened to append, a new frame is started
+        reader = _zstandard().ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True,
+                                                               closefd=True)
+        return io.TextIOWrapper(reader, encoding="utf8", newline="")
+    return open(path, "r", encoding="utf8", newline="")
+
+
+class _CsvOutput:
+    """
+    A csv file opened in append mode (optionally compressed), with the rows waiting to be written.
+
+    A compressed file is only readable if every gzip member / zstd frame in it is complete, so each sync() ends the
+    current one (the next write starts a new one), and the size of the file after each sync() is recorded in a
+    ".synced" file. When the file is opened again, whatever was written after the last sync() (e.g. an unfinished
+    member left by a crash) is truncated: it's not covered by any checkpoint, so it will be collected again.
+    """
+
+    def __init__(self, path: str, compression: str = None):
+        self.path = compressed_path(path, compression)
+        self.synced_path = self.path + ".synced"
+        self.compression = compression
+        self.raw = open(self.path, "ab")
+        self._truncate_unsynced()
+
+        self.stream = None
+        self.file = None
+        self.writer = None
+        self.rows = []
+
+    def _truncate_unsynced(self):
+        try:
+            with open(self.synced_path, "r") as synced_file:
+                synced_size = int(synced_file.read())
+        except (FileNotFoundError, ValueError):
+            return
+        if os.path.getsize(self.path) > synced_size:
+            self.raw.truncate(synced_size)
+            self.raw.seek(synced_size)
+
+    def _open_stream(self):
+        if self.compression == "gzip":
+            stream = gzip.GzipFile(fileobj=self.raw, mode="wb")
+        elif self.compression == "zstd":
+            stream = _zstandard().ZstdCompressor().stream_writer(self.raw, closefd=False)
+        else:
+            stream = self.raw
+
+        self.stream = stream
+        self.file = io.TextIOWrapper(stream, encoding="utf-8", newline="", write_through=stream is self.raw)
+        self.writer = csv.writer(self.file)
+
+    def _close_stream(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        self.file.detach()
+        if self.stream is not self.raw:
+            # Ends the gzip member / zstd frame
+            self.stream.close()
+        self.stream, self.file, self.writer = None, None, None
+
+    def _record_synced_size(self):
+        temporary_path = self.synced_path + ".tmp"
+        with open(temporary_path, "w") as synced_file:
+            synced_file.write(str(os.fstat(self.raw.fileno()).st_size))
+            synced_file.flush()
+            os.fsync(synced_file.fileno())
+        os.replace(temporary_path, self.synced_path)
+
+    def write(self):
+        if self.rows:
+            if self.file is None:
+                self._open_stream()
+            self.writer.writerows(self.rows)
+            self.rows.clear()
+
+    def sync(self):
+        if self.compression:
+            self._close_stream()
+        elif self.file is not None:
+            self.file.flush()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self._record_synced_size()
+
+    def close(self):
+        self.write()
+        self._close_stream()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self._record_synced_size()
+        self.raw.close()
+
+
+class CsvSink:
+    """
+    Keeps the four csv files (subreddits, submissions, comments and crossposts) open while collecting, instead of
+    opening and closing them for each batch. The rows are buffered, and written when there are flush_rows of them or
+    flush_seconds have passed since the last write. sync() writes everything and fsyncs the files: it has to be called
+    before saving a checkpoint. The files can be compressed with gzip or zstd.
+
+    It can be used by several threads at the same time.
+    """
+
+    def __init__(self, subreddits_file: str, submissions_file: str, comments_file: str, crossposts_file: str,
+                 compression: str = None, flush_rows: int = DEFAULT_FLUSH_ROWS,
+                 flush_seconds: float = DEFAULT_FLUSH_SECONDS):
+        self.compression = compression
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.outputs = {
+            "subreddits": _CsvOutput(subreddits_file, compression),
+            "submissions": _CsvOutput(submissions_file, compression),
+            "comments": _CsvOutput(comments_file, compression),
+            "crossposts": _CsvOutput(crossposts_file, compression),
+        }
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add_rows(self, output: str, rows):
+        """
+        :param output: "subreddits", "submissions", "comments" or "crossposts".
+        :param rows: a list of tuples.
+        """
+        with self._lock:
+            self.outputs[output].rows.extend(rows)
+            self.buffered += len(rows)
+            if self.buffered >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_seconds:
+                self._write()
+
+    def _write(self):
+        for output in self.outputs.values():
+            output.write()
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def sync(self):
+        """
+        Writes all the buffered rows and makes sure they are on disk.
+        """
+        with self._lock:
+            self._write()
+            for output in self.outputs.values():
+                output.sync()
+
+    def close(self):
+        with self._lock:
+            for output in self.outputs.values():
+                output.close()
@@ -1,5 +1,22 @@
-from database.database import database
-from information_recovery.reddit_connection import collect_submissions
+from database.database import RedditTables
+from database.storage import get_storage, require_postgres
+from information_recovery.batch_writer import BatchWriter, write_stream
+from information_recovery.checkpoints import CheckpointStore, REFRESH_WINDOW
+from information_recovery.concurrent_collection import collect_concurrently
+from information_recovery.seen_ids import seen_submissions
+from utils.metrics import get_logger, export_metrics, subreddit_context
+
+logger = get_logger("data_collection_to_db")
+
+"""
+    Progress of the collection of each subreddit in the database.
+"""
+checkpoints = CheckpointStore("data/db_checkpoints.sqlite3")
+
+"""
+    Storage of the collected data (PostgreSQL or SQLite, see storage.STORAGE_BACKEND).
+"""
+storage = get_storage()
 
 
 def get_subreddits_to_explore():
@@ -8,41 +25,185 @@ def get_subreddits_to_explore():
     earlier in some crossposts.
     :return: a list of str representing subreddits names
     """
-    subreddits_records = database.get_unsaved_subreddits()
+    subreddits_records = storage.get_unsaved_subreddits()
     subreddits = [subred[0] for subred in subreddits_records]
     return subreddits
 
 
-def collect_subreddits(subreddits: [str] = None):
+def preload_seen_submissions():
+    """
+    Loads the ids of the submissions already saved in the database, so the crossposts to them are saved without
+    collecting them (and their comments) again. When the Bloom filter is not sure, the database is asked.
+    """
+    seen_submissions.confirm = storage.submission_exists
+    number_ids = seen_submissions.preload(storage.iter_column(column="post_id",
+                                                              table=RedditTables.SUBMISSIONS.value))
+    logger.info("\t %s submissions already in the database.", number_ids)
+
+
+def collect_subreddit(subreddit: str, last_submission: [str, int] = None, on_progress=None):
+    """
+    Collects the submissions, crossposts and comments of a subreddit, and saves them in the database in batches
+    while they are retrieved. Each batch uses its own connection of the pool, so several subreddits can be saved
+    at the same time. The progress is recorded in the checkpoint store, so an interrupted collection is resumed
+    where it was left, and a completed one is not repeated.
+
+    :param subreddit: a str representing the name of a subreddit.
+    :param last_submission: a [str, int] with the id of the last submission retrieved and the offset. Can be null.
+    :param on_progress: optional function called after each batch saved (e.g. to renew the lease of the subreddit).
+    :return: the number of records saved.
+    """
+    completed, last_submission = checkpoints.resume_point(subreddit=subreddit, last_submission=last_submission)
+    if completed:
+        logger.info("\t Subreddit '%s' was already collected.", subreddit)
+        return 0
+
+    save_checkpoint = checkpoints.save
+    if on_progress:
+        def save_checkpoint(checkpoint):
+            checkpoints.save(checkpoint)
+            on_progress()
+
+    writer = BatchWriter(save_subreddits=storage.save_subreddits,
+                         save_submissions=storage.save_submissions,
+                         save_comments=storage.save_comments,
+                         save_crossposts=storage.save_crossposts,
+                         save_checkpoint=save_checkpoint)
+    # praw is only imported when something is collected
+    from information_recovery.reddit_connection import stream_submissions
+
+    with subreddit_context(subreddit):
+        number_records = write_stream(stream_submissions(subreddit=subreddit, last_submission=last_submission),
+                                      writer)
+    checkpoints.complete(subreddit)
+    export_metrics(subreddit)
+    return number_records
+
+
+def collect_subreddits(subreddits: [str] = None, max_workers: int = 1, preload_seen: bool = True):
     """
     Go through the list of subreddits collecting all the submissions, crossposts and comments, and them save them
-    in the database (in batch).
+    in the database (in batches, while they are retrieved).
     :param subreddits: list of str representing subreddits. Can be null.
+    :param max_workers: number of subreddits collected at the same time. Default value=1 (one after the other).
+    :param preload_seen: if True, the submissions already in the database are not collected again when they are
+    found as crossposts.
+    :return: the subreddits that failed.
     """
 
     if not subreddits:
         subreddits = get_subreddits_to_explore()
 
+    if preload_seen:
+        preload_seen_submissions()
+
+    if max_workers > 1:
+        return collect_concurrently(subreddits=subreddits, collect=collect_subreddit, max_workers=max_workers)
+
+    failed = []
     for subreddit in subreddits:
 
         try:
-            print(f"Getting posts from subreddit: '{subreddit}'.")
-
-            subreddit_info, submissions, crossposts = collect_submissions(subreddit)
-            comments = []
-            for subm in submissions:
-                comments.extend(subm.comments)
+            logger.info("Getting posts from subreddit: '%s'.", subreddit)
 
             # Update Database
-            database.save_subreddit(subreddit=[subreddit_info])
-            database.save_submissions(submissions=submissions)
-            database.save_comments(comments=comments)
-            database.save_crossposts(crossposts=crossposts)
+            collect_subreddit(subreddit)
+
+            logger.info("\t Saving information of subreddit: '%s'.", subreddit)
+        except Exception:
+            # A subreddit that fails doesn't stop the others (it's resumed from its checkpoint the next time)
+            logger.exception("[%s] The collection failed, going on with the next subreddit.", subreddit)
+            failed.append(subreddit)
+    return failed
+
+
+def refresh_subreddit(subreddit: str, refresh_window: int = REFRESH_WINDOW):
+    """
+    Incremental collection of a subreddit (see reddit_connection.stream_new_submissions): saves the submissions
+    created since the previous run, and the new comments of the recent submissions whose number of comments changed.
+    The comments already saved are skipped by the database. The high-water mark and the comment counts are kept in
+    the checkpoint store, and only move forward when everything was saved.
+
+    :param subreddit: a str representing the name of a subreddit.
+    :param refresh_window: the age (seconds) of the submissions whose comments are refreshed.
+    :return: the number of records saved.
+    """
+    high_water_mark, comment_counts = checkpoints.refresh_point(subreddit)
+
+    writer = BatchWriter(save_subreddits=storage.save_subreddits,
+                         save_submissions=storage.save_submissions,
+                         save_comments=storage.save_comments,
+                         save_crossposts=storage.save_crossposts,
+                         save_checkpoint=checkpoints.save)
+    from information_recovery.reddit_connection import stream_new_submissions
 
-            print(f"\t Saving information of subreddit: '{subreddit}'.")
+    with subreddit_context(subreddit):
+        number_records = write_stream(stream_new_submissions(subreddit=subreddit, high_water_mark=high_water_mark,
+                                                             comment_counts=comment_counts,
+                                                             refresh_window=refresh_window), writer)
+    export_metrics(subreddit)
+    return number_records
+
+
+def refresh_subreddits(subreddits: [str] = None, max_workers: int = 1, refresh_window: int = REFRESH_WINDOW,
+                       preload_seen: bool = True):
+    """
+    Keeps the subreddits up to date with the incremental collection (see refresh_subreddit), instead of collecting
+    their top submissions again.
+
+    :param subreddits: list of str representing subreddits. Can be null (all the subreddits in the database).
+    :param max_workers: number of subreddits collected at the same time. Default value=1 (one after the other).
+    :param refresh_window: the age (seconds) of the submissions whose comments are refreshed.
+    :param preload_seen: see collect_subreddits.
+    :return: the subreddits that failed.
+    """
+    if not subreddits:
+        subreddits = list(storage.iter_column(column="name", table=RedditTables.SUBREDDITS.value))
+
+    if preload_seen:
+        preload_seen_submissions()
+
+    def refresh(subreddit):
+        return refresh_subreddit(subreddit, refresh_window=refresh_window)
+
+    if max_workers > 1:
+        return collect_concurrently(subreddits=subreddits, collect=refresh, max_workers=max_workers)
+
+    failed = []
+    for subreddit in subreddits:
+        try:
+            logger.info("Getting new posts from subreddit: '%s'.", subreddit)
+            refresh(subreddit)
+            logger.info("\t Saving information of subreddit: '%s'.", subreddit)
         except Exception:
-            print("----- Ending program execution not to happily :c -----")
-            break
+            # A subreddit that fails doesn't stop the others (its high-water mark didn't move)
+            logger.exception("[%s] The collection failed, going on with the next subreddit.", subreddit)
+            failed.append(subreddit)
+    return failed
+
+
+def collect_frontier(workers: int = 1, max_subreddits: int = None, wait: bool = False, preload_seen: bool = True):
+    """
+    Collects the subreddits of the crawl frontier (see crawl_frontier.py), the ones discovered more times through
+    crossposts first, and saves them in the database. Several processes (in several machines) can collect the same
+    frontier at the same time. It needs the PostgreSQL database.
+
+    :param workers: number of subreddits collected at the same time by this process.
+    :param max_subreddits: maximum number of subreddits collected by each worker. Can be null (until the frontier is
+    empty).
+    :param wait: if True, it waits for new subreddits when the frontier is empty (it never returns).
+    :param preload_seen: see collect_subreddits.
+    :return: the number of subreddits collected and failed.
+    """
+    require_postgres("The crawl frontier")
+    from information_recovery.crawl_frontier import check_schema, crawl
+
+    check_schema()
+    if preload_seen:
+        preload_seen_submissions()
+
+    return crawl(collect=lambda subreddit, renew: collect_subreddit(subreddit, on_progress=renew),
+                 workers=workers, max_subreddits=max_subreddits, wait=wait)
 
 
 def complete_collection():
@@ -50,30 +211,23 @@ def complete_collection():
     todo
     """
 
-    subreddits_records = database.get_uncompleted_subreddits(min_submissions=350)
+    subreddits_records = storage.get_uncompleted_subreddits(min_submissions=350)
 
+    failed = []
     for row in subreddits_records:
         subreddit = row[0]
         post_id = row[1]
         offset = row[2]
 
         try:
-            print(f"Getting posts from subreddit: '{subreddit}'.")
-
-            subreddit_info, submissions, crossposts = collect_submissions(subreddit=subreddit,
-                                                                          last_submission=[post_id, offset])
-
-            comments = []
-            for subm in submissions:
-                comments.extend(subm.comments)
+            logger.info("Getting posts from subreddit: '%s'.", subreddit)
 
             # Update Database
-            database.save_subreddit(subreddit=[subreddit_info])
-            database.save_submissions(submissions=submissions)
-            database.save_comments(comments=comments)
-            database.save_crossposts(crossposts=crossposts)
+            collect_subreddit(subreddit=subreddit, last_submission=[post_id, offset])
 
-            print(f"\t Saving information of subreddit: '{subreddit}'.")
+            logger.info("\t Saving information of subreddit: '%s'.", subreddit)
         except Exception:
-            print("----- Ending program execution not to happily :c -----")
-            break
+            # A subreddit that fails doesn't stop the others (it's resumed from its checkpoint the next time)
+            logger.exception("[%s] The collection failed, going on with the next subreddit.", subreddit)
+            failed.append(subreddit)
+    return failed
@@ -1,133 +1,146 @@
+import atexit
 import csv
-
-from database.database import database
+import itertools
+import threading
+import time
+
+from database.batches import to_rows, SubredditBatch, SubmissionBatch, CommentBatch, CrossPostBatch
+from database.database import database, RedditTables, SUBREDDITS_COLUMNS, SUBMISSIONS_COLUMNS, \
+    CROSSPOSTS_COLUMNS, COMMENTS_COLUMNS
+from database.storage import get_storage, require_postgres
 from database.subreddit import Subreddit, RedditSubmission, RedditComment, CrossPost
-from information_recovery.reddit_connection import collect_submissions
+from information_recovery.batch_writer import BatchWriter, write_stream
+from information_recovery.checkpoints import CheckpointStore
+from information_recovery.concurrent_collection import collect_concurrently
+from information_recovery.csv_sink import CsvSink, open_csv
+from utils.metrics import get_logger, export_metrics, subreddit_context
 import os
 
 csv_folder = "data/"
 
+logger = get_logger("data_collection_to_excel")
+
 subreddits_file = csv_folder + "subreddits.csv"
 submissions_file = csv_folder + "submissions.csv"
 comments_file = csv_folder + "comments.csv"
 crossposts_file = csv_folder + "crossposts.csv"
 
+"""
+    Compression of the csv files: None, "gzip" or "zstd".
+"""
+CSV_COMPRESSION = os.getenv("CSV_COMPRESSION") or None
 
-def add_subreddits(subreddit):
-    with open(subreddits_file, "a", encoding="utf-8", newline="") as file:
-        writer = csv.writer(file)
-        entry = (subreddit.name, subreddit.description, subreddit.date_created, subreddit.nsfw, subreddit.subscribers)
-        writer.writerow(entry)
-
+"""
+    Progress of the collection of each subreddit in the csv files.
+"""
+checkpoints = CheckpointStore(csv_folder + "csv_checkpoints.sqlite3")
 
-def add_submissions(submissions):
-    submissions_entries = []
-    for submission in submissions:
-        entry = (submission.id, submission.title, submission.author, submission.date_created, submission.nsfw,
-                 submission.post_type, submission.upvote_ratio, submission.total_awards, submission.num_crossposts,
-                 submission.text, submission.video_duration, submission.category, submission.subreddit)
-        submissions_entries.append(entry)
-        add_comments(submission.comments)
-
-    with open(submissions_file, "a", encoding="utf-8", newline="") as file:
-        writer = csv.writer(file)
-        writer.writerows(submissions_entries)
+"""
+    Number of rows copied at a time when bulk loading the csv files in the database.
+"""
+BULK_CHUNK_SIZE = 50000
 
+_csv_sink = None
+_csv_sink_lock = threading.Lock()
 
-def add_comments(comments):
-    comments_entries = []
-    for comment in comments:
-        entry = (comment.id, comment.text, comment.author, comment.date_created, comment.parent_id,
-                 comment.submission_id, comment.upvote_ratio, comment.pinned)
-        comments_entries.append(entry)
 
-    with open(comments_file, "a", encoding="utf-8", newline="") as file:
-        writer = csv.writer(file)
-        writer.writerows(comments_entries)
-
-
-def add_crossposts(crossposts):
-    crossposts_entries = []
-    for crosspost in crossposts:
-        entry = (crosspost.crosspost_parent_id, crosspost.post_id)
-        crossposts_entries.append(entry)
+def get_csv_sink():
+    """
+    Returns the CsvSink used to write the csv files. The files are opened the first time it's needed, and closed
+    when the program ends.
 
-    with open(crossposts_file, "a", encoding="utf-8", newline="") as file:
-        writer = csv.writer(file)
-        writer.writerows(crossposts_entries)
+    :return: a CsvSink instance.
+    """
+    global _csv_sink
+    with _csv_sink_lock:
+        if _csv_sink is None:
+            _csv_sink = CsvSink(subreddits_file=subreddits_file,
+                                submissions_file=submissions_file,
+                                comments_file=comments_file,
+                                crossposts_file=crossposts_file,
+                                compression=CSV_COMPRESSION)
+            atexit.register(_csv_sink.close)
+        return _csv_sink
+
+
+def save_checkpoint(checkpoint):
+    """
+    Saves the checkpoint of a collection, once the rows it covers are on disk.
+    """
+    get_csv_sink().sync()
+    checkpoints.save(checkpoint)
 
 
-def _helper_get_index_last_subreddit_in_csv(subreddits_list):
-    if not os.path.exists(subreddits_file):
-        return -1, None
+def add_subreddits(subreddits):
+    get_csv_sink().add_rows("subreddits", to_rows(subreddits, SubredditBatch))
 
-    with open(subreddits_file, "r", encoding="utf8") as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=",")
-        rows = list(csv_reader)
-        subreddit = rows[-1][0] if rows else None  # last row, first column
 
-    if not subreddit:
-        return -1, None
+def add_submissions(submissions):
+    get_csv_sink().add_rows("submissions", to_rows(submissions, SubmissionBatch))
 
-    try:
-        idx_subreddit = subreddits_list.index(subreddit)
 
-        if not os.path.exists(submissions_file):
-            return idx_subreddit, None
+def add_comments(comments):
+    get_csv_sink().add_rows("comments", to_rows(comments, CommentBatch))
 
-        with open(submissions_file, "r", encoding="utf8") as csv_file:
-            csv_reader = csv.reader(csv_file, delimiter=",")
-            rows = list(csv_reader)
 
-            offset = 0
-            i = -1
-            last_submission = None
-            while ((i + len(rows)) > 0) and offset != 350:
-                if rows[i][-1] == subreddit:
-                    offset += 1
-                    if not last_submission:
-                        last_submission = rows[i]
-                i -= 1
+def add_crossposts(crossposts):
+    get_csv_sink().add_rows("crossposts", to_rows(crossposts, CrossPostBatch))
 
-        post_id = "t3_" + last_submission[0] if last_submission else None
-        return idx_subreddit, [post_id, offset]
-    except ValueError:
-        return -1, None
 
+def collect_subreddit(subreddit: str, last_submission: [str, int] = None):
+    """
+    Collects the submissions, crossposts and comments of a subreddit, and saves them in the csv files in batches
+    while they are retrieved. The progress is recorded in the checkpoint store, so an interrupted collection is
+    resumed where it was left, and a completed one is not repeated.
 
-def collect_subreddits(subreddits: [str]):
+    :param subreddit: a str representing the name of a subreddit.
+    :param last_submission: a [str, int] with the id of the last submission retrieved and the offset. Can be null.
+    :return: the number of records saved.
+    """
+    completed, last_submission = checkpoints.resume_point(subreddit=subreddit, last_submission=last_submission)
+    if completed:
+        logger.info("\t Subreddit '%s' was already collected.", subreddit)
+        return 0
+
+    writer = BatchWriter(save_subreddits=add_subreddits,
+                         save_submissions=add_submissions,
+                         save_comments=add_comments,
+                         save_crossposts=add_crossposts,
+                         save_checkpoint=save_checkpoint)
+    # praw is only imported when something is collected
+    from information_recovery.reddit_connection import stream_submissions
+
+    with subreddit_context(subreddit):
+        number_records = write_stream(stream_submissions(subreddit=subreddit, last_submission=last_submission),
+                                      writer)
+    checkpoints.complete(subreddit)
+    export_metrics(subreddit)
+    return number_records
+
+
+def collect_subreddits(subreddits: [str], max_workers: int = 1):
     """
     Go through the list of subreddits collecting all the submissions, crossposts and comments, and them save them
-    in an Excel (in batch).
+    in an Excel (in batches, while they are retrieved).
 
     :param subreddits: list of str representing subreddits. Can be null.
+    :param max_workers: number of subreddits collected at the same time. Default value=1 (one after the other).
     """
 
-    # Getting last subreddit analyzed, and checking if it is part of the list,
-    # If it is, we chop the list, so we don't include subreddits that we already analyzed
-    # This is only in terms of _order_ of the list passed by argument, we don't check
-    # each of the element in the list
-    idx_last_subreddit, last_submission_n_offset = _helper_get_index_last_subreddit_in_csv(subreddits_list=subreddits)
-    if idx_last_subreddit > -1:
-        subreddits = subreddits[idx_last_subreddit + 1:] if not last_submission_n_offset else subreddits[
-                                                                                              idx_last_subreddit:]
+    if max_workers > 1:
+        collect_concurrently(subreddits=subreddits, collect=collect_subreddit, max_workers=max_workers)
+        return
 
     for subreddit in subreddits:
-        print(f"Getting posts from subreddit: '{subreddit}'.")
+        logger.info("Getting posts from subreddit: '%s'.", subreddit)
 
         try:
-            subreddit_info, submissions, crossposts = collect_submissions(subreddit=subreddit,
-                                                                          last_submission=last_submission_n_offset)
-
             # Update Excel
-            add_subreddits(subreddit_info)
-            add_submissions(submissions)
-            add_crossposts(crossposts)
-
-            print(f"\t Saving information of subreddit: '{subreddit}'.")
-        except Exception as e:
-            print(e)
-            print("----- Ending program execution not to happily :c -----")
+            collect_subreddit(subreddit=subreddit)
+
+            logger.info("\t Saving information of subreddit: '%s'.", subreddit)
+        except Exception:
+            logger.exception("----- Ending program execution not to happily :c -----")
             break
 
 
@@ -149,19 +162,14 @@ def complete_collection(file: str):
             offset = int(row[2])
 
             try:
-                print(f"Getting posts from subreddit: '{subreddit}'.")
-
-                subreddit_info, submissions, crossposts = collect_submissions(subreddit=subreddit,
-                                                                              last_submission=[post_id, offset])
+                logger.info("Getting posts from subreddit: '%s'.", subreddit)
 
                 # Update Excel
-                add_subreddits(subreddit_info)
-                add_submissions(submissions)
-                add_crossposts(crossposts)
+                collect_subreddit(subreddit=subreddit, last_submission=[post_id, offset])
 
-                print(f"\t Saving information of subreddit: '{subreddit}'.")
+                logger.info("\t Saving information of subreddit: '%s'.", subreddit)
             except Exception:
-                print("----- Ending program execution not to happily :c -----")
+                logger.exception("----- Ending program execution not to happily :c -----")
                 break
 
 
@@ -170,7 +178,7 @@ def save_subreddits():
 
     print("Subreddits")
     print("\t Reading csv file")
-    with open(subreddits_file, newline="", encoding="utf8") as csv_file:
+    with open_csv(subreddits_file, compression=CSV_COMPRESSION) as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=",")
         for row in csv_reader:
             subreddits.append(Subreddit(name=row[0],
@@ -179,7 +187,7 @@ def save_subreddits():
                                         nsfw=bool(row[3]),
                                         subscribers=int(row[4])))
     print("\t Saving in db \n")
-    database.save_subreddits(subreddits=subreddits)
+    get_storage().save_subreddits(subreddits=subreddits)
 
 
 def save_submissions():
@@ -187,7 +195,7 @@ def save_submissions():
 
     print("Submissions")
     print("\t Reading csv file")
-    with open(submissions_file, newline="", encoding="utf8") as csv_file:
+    with open_csv(submissions_file, compression=CSV_COMPRESSION) as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=",")
         for row in csv_reader:
             submissions.append(RedditSubmission(post_id=row[0],
@@ -205,7 +213,7 @@ def save_submissions():
                                                 category=row[11],
                                                 subreddit=row[12]))
     print("\t Saving in db \n")
-    database.save_submissions(submissions=submissions)
+    get_storage().save_submissions(submissions=submissions)
 
 
 def save_comments():
@@ -213,7 +221,7 @@ def save_comments():
 
     print("Comments")
     print("\t Reading csv file")
-    with open(comments_file, newline="", encoding="utf8") as csv_file:
+    with open_csv(comments_file, compression=CSV_COMPRESSION) as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=",")
         for row in csv_reader:
             comments.append(RedditComment(comment_id=row[0],
@@ -226,7 +234,7 @@ def save_comments():
                                           pinned=bool(row[7])))
 
     print("\t Saving in db \n")
-    database.save_comments(comments=comments)
+    get_storage().save_comments(comments=comments)
 
 
 def save_crossposts():
@@ -234,16 +242,76 @@ def save_crossposts():
 
     print("Crossposts")
     print("\t Reading csv file")
-    with open(crossposts_file, newline="", encoding="utf8") as csv_file:
+    with open_csv(crossposts_file, compression=CSV_COMPRESSION) as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=",")
         for row in csv_reader:
             crossposts.append(CrossPost(parent_id=row[0], post_id=row[1]))
 
     print("\t Saving in db \n")
-    database.save_crossposts(crossposts=crossposts)
+    get_storage().save_crossposts(crossposts=crossposts)
+
+
+def bulk_save_csv_file(file: str, table: str, columns: str, null_columns: [str] = (),
+                       chunk_size: int = BULK_CHUNK_SIZE):
+    """
+    Saves a csv file in the database using COPY. The file is read in chunks of chunk_size rows, so the memory used
+    doesn't depend on the size of the file.
+
+    :param file: the path of the csv file (without the suffix of the compression).
+    :param table: the name of the table.
+    :param columns: the columns of the table, in the same order as in the csv file.
+    :param null_columns: columns where an empty value means NULL.
+    :param chunk_size: number of rows copied at a time.
+    :return: the number of rows read and the number of rows inserted.
+    """
+    rows_read = 0
+    rows_inserted = 0
+    time_start = time.time()
+
+    print(f"{table}")
+    with open_csv(file, compression=CSV_COMPRESSION) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=",")
+        while True:
+            chunk = list(itertools.islice(csv_reader, chunk_size))
+            if not chunk:
+                break
+
+            rows_inserted += database.copy_rows(table=table, columns=columns, rows=chunk, null_columns=null_columns)
+            rows_read += len(chunk)
+
+            elapsed = max(time.time() - time_start, 1e-6)
+            print(f"\t {rows_read} rows read, {rows_inserted} inserted ({rows_read / elapsed:.0f} rows/sec)")
 
+    elapsed = max(time.time() - time_start, 1e-6)
+    print(f"\t Done in {elapsed:.1f} seconds ({rows_read / elapsed:.0f} rows/sec) \n")
+    return rows_read, rows_inserted
+
+
+def bulk_csv_file_to_db(chunk_size: int = BULK_CHUNK_SIZE):
+    """
+    Same as csv_file_to_db, but using COPY through a staging table instead of INSERTs.
+    """
+    print(" -- Start bulk loading csv files in db -- \n")
+    bulk_save_csv_file(subreddits_file, RedditTables.SUBREDDITS.value, SUBREDDITS_COLUMNS, chunk_size=chunk_size)
+    bulk_save_csv_file(submissions_file, RedditTables.SUBMISSIONS.value, SUBMISSIONS_COLUMNS,
+                       null_columns=["video_duration"], chunk_size=chunk_size)
+    bulk_save_csv_file(comments_file, RedditTables.COMMENTS.value, COMMENTS_COLUMNS, chunk_size=chunk_size)
+    bulk_save_csv_file(crossposts_file, RedditTables.CROSSPOSTS.value, CROSSPOSTS_COLUMNS, chunk_size=chunk_size)
+    print(" -- Finish -- \n")
+
+
+def csv_file_to_db(bulk: bool = False):
+    """
+    Saves the information of the csv files in the storage (see storage.STORAGE_BACKEND).
+
+    :param bulk: if True, the files are loaded with COPY in chunks (see bulk_csv_file_to_db), which is much faster
+    and uses constant memory for big files. Only with PostgreSQL.
+    """
+    if bulk:
+        require_postgres("The bulk load of the csv files (COPY)")
+        bulk_csv_file_to_db()
+        return
 
-def csv_file_to_db():
     print(" -- Start reading csv and saving in db -- \n")
     save_subreddits()
     save_submissions()
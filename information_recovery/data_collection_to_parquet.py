@@ -0,0 +1,217 @@
+import os
+import uuid
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from database.batches import to_batch, SubredditBatch, SubmissionBatch, CommentBatch, CrossPostBatch
+from database.database import RedditTables
+from information_recovery.batch_writer import BatchWriter, write_stream
+from information_recovery.checkpoints import CheckpointStore
+from information_recovery.concurrent_collection import collect_concurrently
+from utils.metrics import get_logger, export_metrics, subreddit_context
+
+parquet_folder = "data/parquet/"
+
+logger = get_logger("data_collection_to_parquet")
+
+"""
+    Number of records written in each parquet file. Bigger than the batches of the csv files and the database, since
+    each batch is a new file.
+"""
+PARQUET_BATCH_SIZE = 50000
+
+"""
+    Schema of each table. The tables are partitioned by subreddit (folders "subreddit=<name>"), so the subreddit is not
+    a column of the files, but it's a column of the DataFrames read with read_table:
+        - subreddits: the subreddit itself (the name).
+        - submissions: the subreddit of the submission.
+        - comments: the subreddit of the submission of the comment.
+        - crossposts: the subreddit of the parent submission.
+"""
+SCHEMAS = {
+    RedditTables.SUBREDDITS.value: pa.schema([
+        ("description", pa.string()),
+        ("date_created", pa.timestamp("s")),
+        ("nsfw", pa.bool_()),
+        ("subscribers", pa.int64()),
+    ]),
+    RedditTables.SUBMISSIONS.value: pa.schema([
+        ("post_id", pa.string()),
+        ("title", pa.string()),
+        ("author", pa.string()),
+        ("date_created", pa.timestamp("s")),
+        ("nsfw", pa.bool_()),
+        ("post_type", pa.string()),
+        ("upvote_ratio", pa.float64()),
+        ("total_awards", pa.int64()),
+        ("num_crossposts", pa.int64()),
+        ("post_content", pa.string()),
+        ("video_duration", pa.int64()),
+        ("category", pa.string()),
+    ]),
+    RedditTables.COMMENTS.value: pa.schema([
+        ("comment_id", pa.string()),
+        ("comment_content", pa.string()),
+        ("author", pa.string()),
+        ("date_created", pa.timestamp("s")),
+        ("parent_id", pa.string()),
+        ("submission_id", pa.string()),
+        ("upvote_ratio", pa.float64()),
+        ("pinned", pa.bool_()),
+    ]),
+    RedditTables.CROSSPOSTS.value: pa.schema([
+        ("crosspost_parent_id", pa.string()),
+        ("crosspost_id", pa.string()),
+    ]),
+}
+
+"""
+    Progress of the collection of each subreddit in the parquet files.
+"""
+checkpoints = CheckpointStore("data/parquet_checkpoints.sqlite3")
+
+
+class ParquetSink:
+    """
+    Writes the records of the collection of a subreddit in typed parquet files, one file for each batch and
+    partition (subreddit).
+    """
+
+    def __init__(self, subreddit: str, folder: str = parquet_folder):
+        self.subreddit = subreddit
+        self.folder = folder
+        # Subreddit of each submission written, to partition its comments and crossposts
+        self.submissions_subreddit = {}
+
+    def _write(self, table: str, columns: dict, partitions: list):
+        """
+        :param table: the name of the table.
+        :param columns: the values of each column of the schema of the table.
+        :param partitions: the subreddit (partition) of each row.
+        """
+        schema = SCHEMAS[table]
+        data = pa.Table.from_pydict({name: columns[name] for name in schema.names}, schema=schema)
+        partitions = pa.array(partitions, pa.string())
+
+        for subreddit in pc.unique(partitions).to_pylist():
+            partition_folder = os.path.join(self.folder, table, f"subreddit={subreddit}")
+            os.makedirs(partition_folder, exist_ok=True)
+            pq.write_table(data.filter(pc.equal(partitions, subreddit)),
+                           os.path.join(partition_folder, f"part-{uuid.uuid4().hex}.parquet"))
+
+    def save_subreddits(self, subreddits):
+        batch = to_batch(subreddits, SubredditBatch)
+        self._write(RedditTables.SUBREDDITS.value, batch.columns, batch.columns["name"])
+
+    def save_submissions(self, submissions):
+        batch = to_batch(submissions, SubmissionBatch)
+        self.submissions_subreddit.update(zip(batch.columns["post_id"], batch.columns["subreddit"]))
+        self._write(RedditTables.SUBMISSIONS.value, batch.columns, batch.columns["subreddit"])
+
+    def save_comments(self, comments):
+        batch = to_batch(comments, CommentBatch)
+        partitions = [self.submissions_subreddit.get(submission_id, self.subreddit)
+                      for submission_id in batch.columns["submission_id"]]
+        self._write(RedditTables.COMMENTS.value, batch.columns, partitions)
+
+    def save_crossposts(self, crossposts):
+        batch = to_batch(crossposts, CrossPostBatch)
+        partitions = [self.submissions_subreddit.get(parent_id, self.subreddit)
+                      for parent_id in batch.columns["crosspost_parent_id"]]
+        self._write(RedditTables.CROSSPOSTS.value, batch.columns, partitions)
+
+
+def collect_subreddit(subreddit: str, last_submission: [str, int] = None):
+    """
+    Collects the submissions, crossposts and comments of a subreddit, and saves them in parquet files while they are
+    retrieved. As with the csv files, the progress is recorded in a checkpoint store.
+
+    :param subreddit: a str representing the name of a subreddit.
+    :param last_submission: a [str, int] with the id of the last submission retrieved and the offset. Can be null.
+    :return: the number of records saved.
+    """
+    completed, last_submission = checkpoints.resume_point(subreddit=subreddit, last_submission=last_submission)
+    if completed:
+        logger.info("\t Subreddit '%s' was already collected.", subreddit)
+        return 0
+
+    sink = ParquetSink(subreddit)
+    writer = BatchWriter(save_subreddits=sink.save_subreddits,
+                         save_submissions=sink.save_submissions,
+                         save_comments=sink.save_comments,
+                         save_crossposts=sink.save_crossposts,
+                         batch_size=PARQUET_BATCH_SIZE,
+                         save_checkpoint=checkpoints.save)
+    # praw is only imported when something is collected
+    from information_recovery.reddit_connection import stream_submissions
+
+    with subreddit_context(subreddit):
+        number_records = write_stream(stream_submissions(subreddit=subreddit, last_submission=last_submission),
+                                      writer)
+    checkpoints.complete(subreddit)
+    export_metrics(subreddit)
+    return number_records
+
+
+def collect_subreddits(subreddits: [str], max_workers: int = 1):
+    """
+    Go through the list of subreddits collecting all the submissions, crossposts and comments, and them save them
+    in parquet files (in batches, while they are retrieved).
+
+    :param subreddits: list of str representing subreddits.
+    :param max_workers: number of subreddits collected at the same time. Default value=1 (one after the other).
+    """
+
+    if max_workers > 1:
+        collect_concurrently(subreddits=subreddits, collect=collect_subreddit, max_workers=max_workers)
+        return
+
+    for subreddit in subreddits:
+        logger.info("Getting posts from subreddit: '%s'.", subreddit)
+
+        try:
+            # Update parquet files
+            collect_subreddit(subreddit=subreddit)
+
+            logger.info("\t Saving information of subreddit: '%s'.", subreddit)
+        except Exception:
+            logger.exception("----- Ending program execution not to happily :c -----")
+            break
+
+
+def read_table(table: str, columns: [str] = None, subreddits: [str] = None, folder: str = parquet_folder):
+    """
+    Reads a table of the parquet files in a DataFrame, loading only the given columns and subreddits.
+
+    :param table: the name of the table (see database.RedditTables).
+    :param columns: the columns to read (e.g. ["comment_id", "submission_id"]). Can be null (all of them).
+    :param subreddits: the subreddits (partitions) to read. Can be null (all of them).
+    :param folder: the folder of the parquet files.
+    :return: a pandas DataFrame.
+    """
+    import pandas as pd
+
+    filters = [("subreddit", "in", list(subreddits))] if subreddits else None
+    return pd.read_parquet(os.path.join(folder, table), engine="pyarrow", columns=columns, filters=filters)
+
+
+def iter_table(table: str, columns: [str] = None, subreddits: [str] = None, folder: str = parquet_folder,
+               batch_size: int = 65536):
+    """
+    Reads a table of the parquet files in chunks, so it never has to fit in memory.
+
+    :param table: the name of the table (see database.RedditTables).
+    :param columns: the columns to read (the subreddit can be one of them). Can be null (all of them).
+    :param subreddits: the subreddits (partitions) to read. Can be null (all of them).
+    :param folder: the folder of the parquet files.
+    :param batch_size: maximum number of rows of each chunk.
+    :return: a generator of pyarrow RecordBatch's.
+    """
+    # pyarrow.dataset imports pandas
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(os.path.join(folder, table), format="parquet", partitioning="hive")
+    row_filter = pc.field("subreddit").isin(list(subreddits)) if subreddits else None
+    yield from dataset.to_batches(columns=columns, filter=row_filter, batch_size=batch_size)
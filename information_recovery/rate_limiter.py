@@ -0,0 +1,162 @@
+import random
+import re
+import threading
+import time
+
+from utils.metrics import get_logger, metrics
+
+"""
+    Reddit allows 100 requests per minute for each OAuth client. The rate-limit headers of each response
+    tell us how many requests are left in the current window, so the bucket adapts to them.
+"""
+DEFAULT_REQUESTS_PER_MINUTE = 100
+DEFAULT_BURST = 10
+
+"""
+    Exponential backoff (with full jitter) used after server or connection errors.
+"""
+BACKOFF_BASE = 2  # seconds
+BACKOFF_MAX = 300  # seconds = 5 minutes
+
+logger = get_logger("rate_limiter")
+
+_ENDPOINT_PATTERNS = [
+    (re.compile(r"^/r/[^/]+"), "/r/{subreddit}"),
+    (re.compile(r"/(comments|duplicates)/[^/]+"), r"/\1/{id}"),
+    (re.compile(r"/user/[^/]+"), "/user/{name}"),
+]
+
+
+def endpoint_name(path: str) -> str:
+    """
+    Normalizes the path of a request, so all the requests to the same endpoint are grouped together
+    (e.g. /r/funny/top and /r/aww/top are both /r/{subreddit}/top).
+
+    :param path: the path (or url) of the request.
+    :return: a str representing the endpoint.
+    """
+    path = re.sub(r"^https?://[^/]+", "", path).split("?")[0].rstrip("/")
+    for pattern, replacement in _ENDPOINT_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return path or "/"
+
+
+class EndpointStats:
+    """
+    Latency and error counts of the requests made to an endpoint.
+    """
+    calls: int
+    errors: int
+    total_latency: float
+    max_latency: float
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def mean_latency(self) -> float:
+        return self.total_latency / self.calls if self.calls else 0.0
+
+    def __str__(self):
+        return f"calls: {self.calls}. errors: {self.errors}. " \
+               f"mean_latency: {self.mean_latency():.3f}s. max_latency: {self.max_latency:.3f}s."
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every request made to the Reddit API (all threads and all clients). The refill rate is
+    adjusted with the rate-limit headers sent by Reddit, so we use the whole budget without going over it.
+    """
+
+    def __init__(self, requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE, burst: int = DEFAULT_BURST):
+        self.rate = requests_per_minute / 60
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """
+        Blocks until there is a token available in the bucket, and takes it.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def update_from_headers(self, headers):
+        """
+        Adapts the bucket to the rate-limit headers of a response: the remaining requests are spread over the
+        seconds left in the current window.
+
+        :param headers: the headers of the response.
+        """
+        remaining = headers.get("x-ratelimit-remaining")
+        reset = headers.get("x-ratelimit-reset")
+        if remaining is None or reset is None:
+            return
+
+        remaining = float(remaining)
+        reset = max(float(reset), 1.0)
+
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if remaining < 1:
+                # No requests left: nobody sends anything until the window is reset
+                self.tokens = 0
+                self.blocked_until = now + reset
+            else:
+                self.rate = remaining / reset
+                self.tokens = min(self.tokens, remaining)
+
+    def record(self, endpoint: str, latency: float, error: bool = False):
+        """
+        Records the latency (and if it failed) of a request, also in the API metrics of the subreddit being
+        collected (see utils.metrics).
+
+        :param endpoint: the endpoint of the request (see endpoint_name).
+        :param latency: the seconds the request took.
+        :param error: True if the request failed.
+        """
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, EndpointStats())
+            stats.calls += 1
+            stats.errors += int(error)
+            stats.total_latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+        metrics.count("api_calls_total", endpoint=endpoint)
+        if error:
+            metrics.count("api_errors_total", endpoint=endpoint)
+
+    def backoff(self, attempt: int):
+        """
+        Waits before retrying after an error. The waiting time grows exponentially with the number of attempts,
+        with full jitter so the workers don't retry all at the same time.
+
+        :param attempt: the number of consecutive failed attempts (starting at 1).
+        """
+        wait = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        logger.info("Waiting %.1f seconds before trying again (attempt %s).", wait, attempt)
+        time.sleep(wait)
+
+    def print_stats(self):
+        with self._lock:
+            for endpoint, stats in sorted(self.endpoints.items()):
+                print(f"\t {endpoint} - {stats}")
+
+
+rate_limiter = RateLimiter()
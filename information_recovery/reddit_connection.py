@@ -1,5 +1,9 @@
+import contextvars
 import os
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import praw
 import prawcore
@@ -7,6 +11,10 @@ from dotenv import load_dotenv
 from praw.models import MoreComments
 
 from database.subreddit import Subreddit, RedditSubmission, RedditComment, CrossPost
+from information_recovery.checkpoints import Checkpoint, RefreshMark, REFRESH_WINDOW
+from information_recovery.rate_limiter import rate_limiter, endpoint_name
+from information_recovery.seen_ids import SeenIds, seen_submissions
+from utils.metrics import get_logger, metrics, subreddit_context
 
 """
     Loading environment variables
@@ -19,11 +27,133 @@ load_dotenv()
     using the environment variables defined in .env
 """
 user_agent = os.getenv("USERAGENT")
-reddit_client = praw.Reddit(
-    client_id=os.getenv("CLIENT_ID"),
-    client_secret=os.getenv("CLIENT_SECRET"),
-    user_agent=user_agent,
-)
+
+logger = get_logger("collection")
+
+"""
+    Shared API budget: maximum number of requests to the Reddit API that can be in flight at the same time,
+    across all the threads of the process (all the clients use the same credentials).
+"""
+MAX_REQUESTS_IN_FLIGHT = int(os.getenv("MAX_REQUESTS_IN_FLIGHT", 4))
+api_budget = threading.BoundedSemaphore(MAX_REQUESTS_IN_FLIGHT)
+
+_thread_data = threading.local()
+
+"""
+    Transport of the clients: the requestor class (and its arguments) used by praw, and credentials replacing the
+    ones of the environment. It's changed with set_transport (e.g. to record or replay the API, see replay.py).
+"""
+_transport = {"requestor_class": None, "requestor_kwargs": None, "credentials": None, "generation": 0}
+
+"""
+    Deep-comment mode: the MoreComments of each submission are expanded (and the replies are collected) with a budget
+    of API calls and a maximum depth. The comments of several submissions are expanded at the same time.
+    It's enabled for all the collections with the environment variable DEEP_COMMENTS=1.
+"""
+DEEP_COMMENTS_MAX_API_CALLS = 32
+DEEP_COMMENTS_MAX_DEPTH = 8
+DEEP_COMMENTS_WORKERS = 4
+
+
+class DeepComments:
+    """
+    Budget for the expansion of the comments of a submission.
+    """
+    max_api_calls: int
+    max_depth: int
+    workers: int
+
+    def __init__(self, max_api_calls: int = DEEP_COMMENTS_MAX_API_CALLS, max_depth: int = DEEP_COMMENTS_MAX_DEPTH,
+                 workers: int = DEEP_COMMENTS_WORKERS):
+        """
+        :param max_api_calls: maximum number of MoreComments expanded (one API call each) for each submission.
+        :param max_depth: maximum depth of the replies collected (0 = only top-level comments).
+        :param workers: number of submissions whose comments are expanded at the same time.
+        """
+        self.max_api_calls = max_api_calls
+        self.max_depth = max_depth
+        self.workers = workers
+
+
+DEFAULT_DEEP_COMMENTS = DeepComments() if os.getenv("DEEP_COMMENTS") == "1" else None
+
+"""
+    Maximum number of submissions of the "new" listing read by the incremental collection (the most a listing
+    returns).
+"""
+NEW_SUBMISSIONS_LIMIT = 1000
+
+_comments_executor = None
+_comments_executor_lock = threading.Lock()
+
+
+def _get_comments_executor(workers: int):
+    """
+    Pool of threads shared by all the collections to expand comments, so the total number of expansions in flight
+    is bounded.
+    """
+    global _comments_executor
+    with _comments_executor_lock:
+        if _comments_executor is None:
+            _comments_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="comments")
+        return _comments_executor
+
+
+class BudgetedRequestor(prawcore.Requestor):
+    """
+    prawcore Requestor used by every client: each request made to Reddit takes a slot of the shared API budget and
+    a token of the shared rate limiter, and its latency (and errors) is recorded per endpoint.
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = endpoint_name(url)
+        rate_limiter.acquire()
+
+        with api_budget:
+            time_start = time.monotonic()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except prawcore.exceptions.RequestException:
+                rate_limiter.record(endpoint, time.monotonic() - time_start, error=True)
+                raise
+
+        rate_limiter.record(endpoint, time.monotonic() - time_start, error=response.status_code >= 400)
+        rate_limiter.update_from_headers(response.headers)
+        return response
+
+
+def set_transport(requestor_class=None, requestor_kwargs: dict = None, credentials: dict = None):
+    """
+    Changes the requestor used by the clients created from now on (the clients of every thread are created again).
+
+    :param requestor_class: a prawcore.Requestor subclass. Can be null (BudgetedRequestor).
+    :param requestor_kwargs: the extra arguments of the requestor. Can be null.
+    :param credentials: client_id, client_secret and user_agent replacing the ones of the environment. Can be null.
+    """
+    _transport.update(requestor_class=requestor_class, requestor_kwargs=requestor_kwargs, credentials=credentials,
+                      generation=_transport["generation"] + 1)
+
+
+def get_reddit_client():
+    """
+    Returns the praw client of the current thread. praw is not thread-safe, so each thread gets its own client,
+    but all of them share the same API budget and rate limiter.
+
+    :return: a praw.Reddit instance.
+    """
+    client = getattr(_thread_data, "reddit_client", None)
+    if client is None or _thread_data.generation != _transport["generation"]:
+        credentials = _transport["credentials"] or {}
+        client = praw.Reddit(
+            client_id=credentials.get("client_id", os.getenv("CLIENT_ID")),
+            client_secret=credentials.get("client_secret", os.getenv("CLIENT_SECRET")),
+            user_agent=credentials.get("user_agent", user_agent),
+            requestor_class=_transport["requestor_class"] or BudgetedRequestor,
+            requestor_kwargs=_transport["requestor_kwargs"],
+        )
+        _thread_data.reddit_client = client
+        _thread_data.generation = _transport["generation"]
+    return client
 
 
 def post_type(submission) -> str:
@@ -46,11 +176,13 @@ def post_type(submission) -> str:
     return "link"
 
 
-def create_submission(submission):
+def create_submission(submission, comments: [RedditComment] = None, deep_comments: DeepComments = None):
     """
     Creates an instance of RedditSubmission using the information of the submission/post.
 
     :param submission: the information about the submission.
+    :param comments: the comments of the submission, if they were already collected. Can be null.
+    :param deep_comments: the budget to expand the comments (see collect_comments). Can be null.
     :return: an instance of RedditSubmission
     """
     subreddit_name = submission.subreddit.display_name
@@ -60,7 +192,8 @@ def create_submission(submission):
         return None
 
     author = submission.author.name if submission.author else "None"
-    comments = collect_comments(submission)
+    if comments is None:
+        comments = collect_comments(submission, deep_comments=deep_comments)
     p_type = post_type(submission)
     video_duration = 0
 
@@ -85,129 +218,413 @@ def create_submission(submission):
     return post
 
 
-def collect_submissions(subreddit: str, last_submission: [str, int] = None,
-                        submissions_limit: int = 350, crossposts_limit: int = 10):
+def create_subreddit(submission):
     """
-    Goes through each submission in the subreddit, obtaining also all the comments for each submission.
-    We also get the information of the subreddit.
+    :param submission: the information of a submission of the subreddit.
+    :return: an instance of Subreddit with the information of the subreddit of the submission.
+    """
+    return Subreddit(name=submission.subreddit.display_name,
+                     description=submission.subreddit.public_description,
+                     date_created=submission.subreddit.created_utc,
+                     nsfw=submission.subreddit.over18,
+                     subscribers=submission.subreddit.subscribers)
+
+
+def _stream_crossposts(subreddit: str, submission, post: RedditSubmission, crossposts_limit: int,
+                       deep_comments: DeepComments, seen_ids: SeenIds):
+    """
+    Yields the duplicated RedditSubmission (and its comments) and the CrossPost of each crosspost of a submission.
+    """
+    if not submission.num_crossposts:
+        return
+
+    for duplicate in metrics.timed("duplicates", submission.duplicates(limit=crossposts_limit)):
+        logger.debug("[%s] Collecting crosspost %s of %s.", subreddit, duplicate.id, post.id)
+
+        # Already collected: only the crosspost is missing
+        if seen_ids is not None and duplicate.id in seen_ids:
+            yield CrossPost(parent_id=post.id, post_id=duplicate.id)
+            continue
+
+        # Avoiding crossposts to profiles.
+        post_dup = create_submission(duplicate, deep_comments=deep_comments)
+        if not post_dup:
+            continue
+
+        yield post_dup
+        yield from post_dup.comments
+        yield CrossPost(parent_id=post.id, post_id=post_dup.id)
+        if seen_ids is not None:
+            seen_ids.add(post_dup.id)
+
+
+def _with_comments(listing, deep_comments: DeepComments = None):
+    """
+    Goes through a listing of submissions yielding each submission with its comments. In deep-comment mode, the
+    comments of the next deep_comments.workers submissions are expanded in parallel while the current one is
+    processed. Otherwise, the comments are collected later (None is yielded).
+
+    :param listing: an iterable of praw submissions.
+    :param deep_comments: the budget to expand the comments. Can be null.
+    :return: a generator of (submission, list of RedditComment's or None).
+    """
+    if not deep_comments:
+        for submission in listing:
+            yield submission, None
+        return
+
+    executor = _get_comments_executor(deep_comments.workers)
+    pending = deque()
+    try:
+        for submission in listing:
+            # The context is copied, so the metrics of the expansion are labelled with the subreddit
+            pending.append((submission, executor.submit(contextvars.copy_context().run, collect_comments_by_id,
+                                                        submission.id, deep_comments)))
+            if len(pending) > deep_comments.workers:
+                submission, comments = pending.popleft()
+                yield submission, comments.result()
+
+        while pending:
+            submission, comments = pending.popleft()
+            yield submission, comments.result()
+    finally:
+        for _, comments in pending:
+            comments.cancel()
+
+
+def stream_submissions(subreddit: str, last_submission: [str, int] = None,
+                       submissions_limit: int = 350, crossposts_limit: int = 10,
+                       deep_comments: DeepComments = DEFAULT_DEEP_COMMENTS,
+                       seen_ids: SeenIds = seen_submissions):
+    """
+    Goes through each submission in the subreddit, obtaining also all the comments for each submission, and yields
+    the records as soon as they are retrieved, so nothing is lost if the collection fails halfway. The time of each
+    stage (listing, comments and duplicates) and the retries are recorded in the metrics (see utils.metrics).
+
+    The first record is the Subreddit. After that, each RedditSubmission is followed by its RedditComment's and, for
+    its crossposts, by the duplicated RedditSubmission (and its comments) and the CrossPost. Once everything of a
+    submission was yielded, a Checkpoint with the progress of the collection is yielded.
 
     :param subreddit: a str representing the name of a subreddit.
     :param last_submission: a [str, int] representing the id of the last_submission retrieved for that subreddit and the offset/number of submissions already processed.
     :param submissions_limit: an integer between 1 and 1000 representing the number of submissions to be retrieved for the subreddit. Default value=350
     :param crossposts_limit: an integer between 1 and 1000 representing the number of crossposts to be retrieved for each submission. Default value=3
-    :return:
-        - subreddit_info: a Subreddit instance with the information of the subreddit.
-        - submissions: a list of RedditSubmission's with the information of each submission.
-        - crossposts: a list of CrossPost's of each found crossposts.
+    :param deep_comments: the budget to expand the comments of each submission (see collect_comments). Can be null.
+    :param seen_ids: the submissions already collected. A crosspost whose submission was already collected is
+    yielded without fetching the submission (and its comments) again. Can be null (everything is fetched).
+    :return: a generator of Subreddit, RedditSubmission, RedditComment, CrossPost and Checkpoint instances.
     """
     # todo Add related subreddits to each subreddit. This vary between subreddits
 
     if last_submission:
-        submissions_limit = submissions_limit - last_submission[1]
+        offset = last_submission[1]
+        submissions_limit = submissions_limit - offset
         last_submission = last_submission[0] if last_submission[0] else ""
     else:
+        offset = 0
         last_submission = ""
 
-    subreddit_info = None
-    submissions = []
-    crossposts = []
+    with subreddit_context(subreddit):
+        yield from _stream_submissions(subreddit, last_submission, offset, submissions_limit, crossposts_limit,
+                                       deep_comments, seen_ids)
+
 
+def _stream_submissions(subreddit: str, last_submission: str, offset: int, submissions_limit: int,
+                        crossposts_limit: int, deep_comments: DeepComments, seen_ids: SeenIds):
     last_exception = None
     timeout = 900  # seconds = 15 minutes
     time_start = int(time.time())
     number_submissions_retrieved = 0
+    subreddit_info_retrieved = False
+    failed_attempts = 0
 
     while (number_submissions_retrieved < submissions_limit) and int(time.time()) < time_start + timeout:
         try:
             params = {"after": last_submission} if last_submission else {}
 
-            for submission in reddit_client.subreddit(subreddit).top(limit=submissions_limit,
-                                                                     params=params):
+            reddit_client = get_reddit_client()
+            listing = reddit_client.subreddit(subreddit).top(limit=submissions_limit, params=params)
+            for submission, comments in _with_comments(metrics.timed("listing", listing), deep_comments):
                 # limit=None get all the possible posts
-                print(f"\t [{subreddit}] Collecting submission {submission.id}.")
+                logger.debug("[%s] Collecting submission %s.", subreddit, submission.id)
 
                 # Getting the information of the Subreddit only the first time we get a submission
-                if not number_submissions_retrieved:
-                    subreddit_info = Subreddit(name=submission.subreddit.display_name,
-                                               description=submission.subreddit.public_description,
-                                               date_created=submission.subreddit.created_utc,
-                                               nsfw=submission.subreddit.over18,
-                                               subscribers=submission.subreddit.subscribers)
+                if not subreddit_info_retrieved:
+                    subreddit_info_retrieved = True
+                    yield create_subreddit(submission)
 
                 # Obtaining the information of the submission
-                post = create_submission(submission)
+                post = create_submission(submission, comments=comments, deep_comments=deep_comments)
 
                 if not post:
                     continue
 
-                submissions.append(post)
+                yield post
+                yield from post.comments
+                if seen_ids is not None:
+                    seen_ids.add(post.id)
 
                 number_submissions_retrieved += 1
+                failed_attempts = 0
                 last_submission = "t3_" + post.id
 
-                # If the post does not have crossposts
-                if submission.num_crossposts == 0:
-                    continue
-
                 # We also get the post for each crosspost --- limit = 10
-                for duplicate in submission.duplicates(limit=crossposts_limit):
+                yield from _stream_crossposts(subreddit, submission, post, crossposts_limit, deep_comments, seen_ids)
 
-                    # Avoiding crossposts to profiles.
-                    if duplicate.subreddit.display_name.startswith(("u_", "u/")):
-                        return None
+                yield Checkpoint(subreddit=subreddit, last_fullname=last_submission,
+                                 count=offset + number_submissions_retrieved)
 
-                    print(f"\t [{subreddit}] Collecting crosspost.")
+        except prawcore.exceptions.ServerError as e:
+            # sending more requests to an overloaded server might not be helping
+            last_exception = e
+            failed_attempts += 1
+            metrics.count("retries_total", error="server")
+            logger.warning("[%s] Server error: %s", subreddit, e)
+            rate_limiter.backoff(failed_attempts)
+        except prawcore.exceptions.RequestException as e:
+            # exception is related with internet connection
+            last_exception = e
+            failed_attempts += 1
+            metrics.count("retries_total", error="connection")
+            logger.warning("[%s] Connection error: %s", subreddit, e)
+            rate_limiter.backoff(failed_attempts)
+
+    if number_submissions_retrieved != submissions_limit:
+        logger.error("We weren't able to collect all %s submissions for %s subreddit. Please try again.",
+                     submissions_limit, subreddit)
+        raise last_exception
 
-                    post_dup = create_submission(duplicate)
-                    submissions.append(post_dup)
 
-                    crosspost = CrossPost(parent_id=post.id, post_id=post_dup.id)
-                    crossposts.append(crosspost)
+def stream_new_submissions(subreddit: str, high_water_mark: float = None, comment_counts: dict = None,
+                           refresh_window: int = REFRESH_WINDOW, submissions_limit: int = NEW_SUBMISSIONS_LIMIT,
+                           crossposts_limit: int = 10, deep_comments: DeepComments = DEFAULT_DEEP_COMMENTS,
+                           seen_ids: SeenIds = seen_submissions):
+    """
+    Incremental collection of a subreddit: goes through the "new" listing (newest first) yielding only what changed
+    since the previous run, instead of the whole top listing:
+        - the submissions created after the high-water mark, with their comments and crossposts (as
+        stream_submissions),
+        - the comments of the submissions created in the last refresh_window seconds whose number of comments changed
+        (the submission itself is not yielded again).
+    The listing is read until the oldest of both dates. The last record is a RefreshMark with the new high-water mark
+    and the number of comments of the recent submissions, to be passed to the next run (see
+    CheckpointStore.refresh_point).
+
+    :param subreddit: a str representing the name of a subreddit.
+    :param high_water_mark: the created_utc of the newest submission collected by the previous run. Can be null (the
+    first run: the submissions of the refresh window are collected, with the Subreddit).
+    :param comment_counts: a dict of submission id -> number of comments, when they were collected. Can be null (the
+    comments of all the recent submissions are collected).
+    :param refresh_window: the age (seconds) of the submissions whose comments are refreshed.
+    :param submissions_limit: the maximum number of submissions of the listing read (1000 at most).
+    :param crossposts_limit: an integer between 1 and 1000 representing the number of crossposts to be retrieved for
+    each new submission.
+    :param deep_comments: the budget to expand the comments of each submission (see collect_comments). Can be null.
+    :param seen_ids: the submissions already collected (see stream_submissions). Can be null.
+    :return: a generator of Subreddit, RedditSubmission, RedditComment, CrossPost and RefreshMark instances.
+    """
+    with subreddit_context(subreddit):
+        yield from _stream_new_submissions(subreddit, high_water_mark, comment_counts or {}, refresh_window,
+                                           submissions_limit, crossposts_limit, deep_comments, seen_ids)
+
+
+def _stream_new_submissions(subreddit: str, high_water_mark: float, comment_counts: dict, refresh_window: int,
+                            submissions_limit: int, crossposts_limit: int, deep_comments: DeepComments,
+                            seen_ids: SeenIds):
+    last_exception = None
+    timeout = 900  # seconds = 15 minutes
+    time_start = int(time.time())
+    window_start = time.time() - refresh_window
+    since = high_water_mark if high_water_mark is not None else window_start
+    subreddit_info_retrieved = high_water_mark is not None
+    failed_attempts = 0
+
+    newest, newest_fullname = since, None
+    # submission id -> (created_utc, number of comments) of the submissions of the refresh window
+    counts = {}
+    number_new, number_refreshed, number_unchanged = 0, 0, 0
+    last_submission = ""
+    finished = False
+
+    while not finished and int(time.time()) < time_start + timeout:
+        try:
+            params = {"after": last_submission} if last_submission else {}
+
+            reddit_client = get_reddit_client()
+            listing = reddit_client.subreddit(subreddit).new(limit=submissions_limit - len(counts), params=params)
+            for submission in metrics.timed("listing", listing):
+                created_utc = submission.created_utc
+                if created_utc <= since and created_utc < window_start:
+                    break
+
+                if created_utc > since:
+                    logger.debug("[%s] Collecting new submission %s.", subreddit, submission.id)
+                    if not subreddit_info_retrieved:
+                        subreddit_info_retrieved = True
+                        yield create_subreddit(submission)
+
+                    post = create_submission(submission, deep_comments=deep_comments)
+                    if post:
+                        yield post
+                        yield from post.comments
+                        if seen_ids is not None:
+                            seen_ids.add(post.id)
+                        yield from _stream_crossposts(subreddit, submission, post, crossposts_limit, deep_comments,
+                                                      seen_ids)
+                        number_new += 1
+                    if created_utc > newest:
+                        newest, newest_fullname = created_utc, submission.fullname
+
+                elif comment_counts.get(submission.id) != submission.num_comments:
+                    logger.debug("[%s] Refreshing the comments of %s.", subreddit, submission.id)
+                    yield from collect_comments(submission, deep_comments=deep_comments)
+                    metrics.count("submissions_refreshed_total")
+                    number_refreshed += 1
+                else:
+                    number_unchanged += 1
+
+                if created_utc >= window_start:
+                    counts[submission.id] = (created_utc, submission.num_comments)
+                failed_attempts = 0
+                last_submission = submission.fullname
+            finished = True
 
         except prawcore.exceptions.ServerError as e:
-            # wait for 30 seconds since sending more requests to overloaded server might not be helping
+            # sending more requests to an overloaded server might not be helping
             last_exception = e
-            print("### Server error - Waiting a minute before trying again ###")
-            time.sleep(30)
+            failed_attempts += 1
+            metrics.count("retries_total", error="server")
+            logger.warning("[%s] Server error: %s", subreddit, e)
+            rate_limiter.backoff(failed_attempts)
         except prawcore.exceptions.RequestException as e:
             # exception is related with internet connection
             last_exception = e
-            print("### Connection error - Waiting two minutes before trying again ###")
-            time.sleep(120)
+            failed_attempts += 1
+            metrics.count("retries_total", error="connection")
+            logger.warning("[%s] Connection error: %s", subreddit, e)
+            rate_limiter.backoff(failed_attempts)
 
-    if number_submissions_retrieved != submissions_limit:
-        print(f"### We weren't able to collect all {submissions_limit} submissions for {subreddit} subreddit. ###")
-        print(" ### Please try again. ###")
+    if not finished:
+        logger.error("We weren't able to collect the new submissions for %s subreddit. Please try again.", subreddit)
         raise last_exception
 
+    logger.info("[%s] %s new submissions, comments of %s submissions refreshed (%s unchanged).", subreddit,
+                number_new, number_refreshed, number_unchanged)
+    yield RefreshMark(subreddit=subreddit, last_fullname=newest_fullname, count=number_new, high_water_mark=newest,
+                      comment_counts=counts, window_start=window_start)
+
+
+def collect_submissions(subreddit: str, last_submission: [str, int] = None,
+                        submissions_limit: int = 350, crossposts_limit: int = 10,
+                        deep_comments: DeepComments = DEFAULT_DEEP_COMMENTS,
+                        seen_ids: SeenIds = seen_submissions):
+    """
+    Goes through each submission in the subreddit, obtaining also all the comments for each submission.
+    We also get the information of the subreddit. Everything is kept in memory, see stream_submissions to process
+    the records as they are retrieved.
+
+    :param subreddit: a str representing the name of a subreddit.
+    :param last_submission: a [str, int] representing the id of the last_submission retrieved for that subreddit and the offset/number of submissions already processed.
+    :param submissions_limit: an integer between 1 and 1000 representing the number of submissions to be retrieved for the subreddit. Default value=350
+    :param crossposts_limit: an integer between 1 and 1000 representing the number of crossposts to be retrieved for each submission. Default value=3
+    :param deep_comments: the budget to expand the comments of each submission (see collect_comments). Can be null.
+    :param seen_ids: the submissions already collected (see stream_submissions). Can be null (everything is
+    fetched).
+    :return:
+        - subreddit_info: a Subreddit instance with the information of the subreddit.
+        - submissions: a list of RedditSubmission's with the information of each submission.
+        - crossposts: a list of CrossPost's of each found crossposts.
+    """
+    subreddit_info = None
+    submissions = []
+    crossposts = []
+
+    for record in stream_submissions(subreddit=subreddit, last_submission=last_submission,
+                                     submissions_limit=submissions_limit, crossposts_limit=crossposts_limit,
+                                     deep_comments=deep_comments, seen_ids=seen_ids):
+        if isinstance(record, Subreddit):
+            subreddit_info = record
+        elif isinstance(record, RedditSubmission):
+            submissions.append(record)
+        elif isinstance(record, CrossPost):
+            crossposts.append(record)
+
     return subreddit_info, submissions, crossposts
 
 
-def collect_comments(submission):
+def create_comment(comment, submission_id: str):
+    """
+    Creates an instance of RedditComment using the information of the comment.
+
+    :param comment: the information about the comment.
+    :param submission_id: the id of the submission of the comment.
+    :return: an instance of RedditComment
+    """
+    sum_up_down = comment.ups + comment.downs
+    score = comment.ups / sum_up_down if sum_up_down else 0
+    author = comment.author.name if comment.author else "None"
+
+    return RedditComment(comment_id=comment.id, text=comment.body, author=author,
+                         date_created=comment.created_utc, parent_id=comment.parent_id,
+                         submission_id=submission_id, upvote_ratio=score,
+                         pinned=comment.stickied)
+
+
+def collect_comments(submission, deep_comments: DeepComments = None):
     """
     Goes through each comment in the submission and creates instances of RedditComment with the comment information.
 
+    By default only the top-level comments already loaded are collected. With deep_comments, up to
+    deep_comments.max_api_calls MoreComments are expanded, and the replies (up to deep_comments.max_depth) are
+    collected too and added to their parent RedditComment.
+
     :param submission: the submission information
-    :return: a list of RedditComment's.
+    :param deep_comments: the budget to expand the comments. Can be null.
+    :return: a list of RedditComment's (including the replies). The time it takes (loading the comments is an API
+    call) is recorded in the "comments" stage of the metrics.
     """
+    with metrics.timer("comments"):
+        return _collect_comments(submission, deep_comments)
+
+
+def _collect_comments(submission, deep_comments: DeepComments = None):
     comments = []
 
-    print("\t\t Collecting comments.")
+    logger.debug("Collecting comments of %s.", submission.id)
     submission.comment_sort = "top"
 
-    for comment in submission.comments:
+    if deep_comments:
+        # Each MoreComments replaced is an API call. The ones over the limit are removed from the tree.
+        submission.comments.replace_more(limit=deep_comments.max_api_calls)
+        max_depth = deep_comments.max_depth
+    else:
+        max_depth = 0
+
+    # (praw comment, RedditComment of its parent, depth)
+    to_visit = [(comment, None, 0) for comment in reversed(submission.comments)]
+    while to_visit:
+        comment, parent, depth = to_visit.pop()
         if isinstance(comment, MoreComments):
             continue
 
-        sum_up_down = comment.ups + comment.downs
-        score = comment.ups / sum_up_down if sum_up_down else 0
-        author = comment.author.name if comment.author else "None"
-
-        submission_id = comment.parent_id if "submission_id" not in vars(comment).keys() else comment.submission_id
-        comm = RedditComment(comment_id=comment.id, text=comment.body, author=author,
-                             date_created=comment.created_utc, parent_id=comment.parent_id,
-                             submission_id=submission_id.replace("t3_", ""), upvote_ratio=score,
-                             pinned=comment.stickied)
+        comm = create_comment(comment, submission_id=submission.id)
         comments.append(comm)
+        if parent:
+            parent.add_reply(comm)
+
+        if depth < max_depth:
+            to_visit.extend((reply, comm, depth + 1) for reply in reversed(comment.replies))
 
     return comments
+
+
+def collect_comments_by_id(submission_id: str, deep_comments: DeepComments = None):
+    """
+    Same as collect_comments, but loading the submission with the client of the current thread (praw objects can't
+    be shared between threads).
+
+    :param submission_id: the id of the submission.
+    :param deep_comments: the budget to expand the comments. Can be null.
+    :return: a list of RedditComment's (including the replies).
+    """
+    return collect_comments(get_reddit_client().submission(id=submission_id), deep_comments=deep_comments)
@@ -0,0 +1,207 @@
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlencode
+
+import prawcore
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from information_recovery.rate_limiter import rate_limiter, endpoint_name
+from information_recovery.reddit_connection import BudgetedRequestor, set_transport
+
+"""
+    Record and replay of the Reddit API. The responses of the API are recorded once in a cassette (gzipped json
+    lines), and then served from it without network nor credentials, to benchmark and test the collection offline.
+
+    The requests to get an OAuth token are never recorded (a fake token is replayed), nor the headers of the
+    requests. Only these headers of the responses are kept. The rate limit headers are kept for inspection only: they
+    are not replayed, otherwise the rate limiter of praw would wait for the quota left when the cassette was recorded
+    (and a benchmark would measure that throttling instead of the collection).
+"""
+RECORDED_HEADERS = ("content-type", "x-ratelimit-remaining", "x-ratelimit-reset", "x-ratelimit-used")
+REPLAY_CREDENTIALS = {"client_id": "replay", "client_secret": "replay", "user_agent": "recommenddit replay"}
+RATE_LIMIT_HEADER_PREFIX = "x-ratelimit-"
+_FAKE_TOKEN = {"access_token": "replay", "expires_in": 86400, "scope": "*", "token_type": "bearer"}
+
+
+class CassetteMiss(Exception):
+    """
+    The request was not recorded in the cassette.
+    """
+
+
+def request_key(method: str, url: str, params=None, data=None) -> str:
+    """
+    :return: a str identifying a request: method, path (without host) and sorted parameters and data.
+    """
+    parts = urlsplit(url)
+    params = sorted((params or {}).items()) if isinstance(params, dict) else sorted(params or [])
+    data = sorted(data.items()) if isinstance(data, dict) else sorted(data or [])
+    key = f"{method.upper()} {parts.path.rstrip('/')}"
+    if parts.query or params:
+        key += "?" + "&".join(part for part in (parts.query, urlencode(params)) if part)
+    if data:
+        key += " " + urlencode(data)
+    return key
+
+
+def _is_token_request(url: str) -> bool:
+    return urlsplit(url).path.endswith("/api/v1/access_token")
+
+
+def make_response(method: str, url: str, status: int, headers: dict, body: str) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = body.encode("utf-8")
+    response.encoding = "utf-8"
+    response.url = url
+    response.request = requests.Request(method.upper(), url).prepare()
+    return response
+
+
+class Cassette:
+    """
+    Responses recorded for each request (a list, in order, since the same request can be made more than once).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.responses = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as file:
+            for line in file:
+                entry = json.loads(line)
+                self.responses.setdefault(entry["key"], []).append(entry)
+        return self
+
+    def append(self, key: str, response: requests.Response):
+        entry = {"key": key, "status": response.status_code, "body": response.text,
+                 "headers": {name: response.headers[name] for name in RECORDED_HEADERS if name in response.headers}}
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self.responses.setdefault(key, []).append(entry)
+            # Each line is a gzip member of its own, so the file is valid after each response
+            with gzip.open(self.path, "at", encoding="utf-8") as file:
+                file.write(line)
+
+    def next_response(self, key: str) -> dict:
+        """
+        :return: the next recorded response of the request. Once they were all replayed, the last one is repeated.
+        """
+        with self._lock:
+            entries = self.responses.get(key)
+            if not entries:
+                raise CassetteMiss(f"Request not recorded in '{self.path}': {key}")
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+            return entries[min(position, len(entries) - 1)]
+
+
+class RecordingRequestor(BudgetedRequestor):
+    """
+    BudgetedRequestor that also records each response in a cassette.
+    """
+
+    def __init__(self, *args, cassette: Cassette = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cassette = cassette
+
+    def request(self, method, url, *args, **kwargs):
+        response = super().request(method, url, *args, **kwargs)
+        if not _is_token_request(url):
+            self.cassette.append(request_key(method, url, kwargs.get("params"), kwargs.get("data")), response)
+        return response
+
+
+class ReplayRequestor(prawcore.Requestor):
+    """
+    Fake transport: answers the requests with the responses of a cassette, with optional latency and errors.
+    The requests are recorded in the rate limiter stats (the rate limit is not applied).
+    """
+
+    def __init__(self, *args, cassette: Cassette = None, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, connection_error_rate: float = 0.0, seed: int = None, **kwargs):
+        """
+        :param cassette: the recorded responses.
+        :param latency: seconds added to each request.
+        :param jitter: maximum random seconds added to the latency.
+        :param error_rate: probability of answering with a 503 error (a prawcore ServerError).
+        :param connection_error_rate: probability of failing as a broken connection (a prawcore RequestException).
+        :param seed: seed of the random latency and errors.
+        """
+        super().__init__(*args, **kwargs)
+        self.cassette = cassette
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.connection_error_rate = connection_error_rate
+        self.random = random.Random(seed)
+
+    def request(self, method, url, *args, **kwargs):
+        if _is_token_request(url):
+            return make_response(method, url, 200, {"content-type": "application/json"}, json.dumps(_FAKE_TOKEN))
+
+        endpoint = endpoint_name(url)
+        time_start = time.monotonic()
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        draw = self.random.random()
+        if draw < self.connection_error_rate:
+            rate_limiter.record(endpoint, time.monotonic() - time_start, error=True)
+            raise prawcore.exceptions.RequestException(ConnectionError("Injected connection error"), (method, url),
+                                                       kwargs)
+        if draw < self.connection_error_rate + self.error_rate:
+            rate_limiter.record(endpoint, time.monotonic() - time_start, error=True)
+            return make_response(method, url, 503, {}, "")
+
+        entry = self.cassette.next_response(request_key(method, url, kwargs.get("params"), kwargs.get("data")))
+        rate_limiter.record(endpoint, time.monotonic() - time_start, error=entry["status"] >= 400)
+        headers = {name: value for name, value in entry["headers"].items()
+                   if not name.lower().startswith(RATE_LIMIT_HEADER_PREFIX)}
+        return make_response(method, url, entry["status"], headers, entry["body"])
+
+
+@contextmanager
+def recording(path: str):
+    """
+    Records the responses of the API (with the real clients) in the cassette of the path, while the context is
+    active.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    set_transport(requestor_class=RecordingRequestor, requestor_kwargs={"cassette": Cassette(path)})
+    try:
+        yield
+    finally:
+        set_transport()
+
+
+@contextmanager
+def replaying(path: str, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+              connection_error_rate: float = 0.0, seed: int = None):
+    """
+    Serves the requests of the API from the cassette of the path, while the context is active (see ReplayRequestor
+    for the parameters).
+
+    :return: the Cassette.
+    """
+    cassette = Cassette(path).load()
+    set_transport(requestor_class=ReplayRequestor,
+                  requestor_kwargs={"cassette": cassette, "latency": latency, "jitter": jitter,
+                                    "error_rate": error_rate, "connection_error_rate": connection_error_rate,
+                                    "seed": seed},
+                  credentials=REPLAY_CREDENTIALS)
+    try:
+        yield cassette
+    finally:
+        set_transport()
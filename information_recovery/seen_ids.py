@@ -0,0 +1,112 @@
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+
+"""
+    Default sizes: number of ids expected in the Bloom filter (and its false positive rate), and number of ids kept
+    exactly in the LRU.
+"""
+DEFAULT_EXPECTED_IDS = 5_000_000
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+DEFAULT_LRU_SIZE = 200_000
+
+
+class BloomFilter:
+    """
+    Set of str that can answer "not in the set" for sure, and "maybe in the set" with a small false positive rate,
+    using a few bits for each element.
+    """
+
+    def __init__(self, expected_items: int = DEFAULT_EXPECTED_IDS,
+                 false_positive_rate: float = DEFAULT_FALSE_POSITIVE_RATE):
+        self.size = max(8, int(-expected_items * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.number_hashes = max(1, round(self.size / expected_items * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.number_hashes))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class SeenIds:
+    """
+    Ids (of submissions) already collected during the crawl. A Bloom filter holds all of them, and an LRU holds the
+    most recent ones exactly.
+
+    An id is considered seen only when it's sure: if the Bloom filter says "maybe" but the id is not in the LRU, the
+    optional confirm function (e.g. a lookup in the database) decides. Otherwise it's considered not seen, so at worst
+    something is collected twice, but nothing is skipped by mistake.
+    """
+
+    def __init__(self, expected_ids: int = DEFAULT_EXPECTED_IDS,
+                 false_positive_rate: float = DEFAULT_FALSE_POSITIVE_RATE,
+                 lru_size: int = DEFAULT_LRU_SIZE, confirm=None):
+        """
+        :param expected_ids: number of ids expected during the crawl.
+        :param false_positive_rate: false positive rate of the Bloom filter with expected_ids ids.
+        :param lru_size: number of ids kept exactly.
+        :param confirm: optional function that receives an id and returns True if it was already collected.
+        """
+        self.bloom = BloomFilter(expected_items=expected_ids, false_positive_rate=false_positive_rate)
+        self.lru = OrderedDict()
+        self.lru_size = lru_size
+        self.confirm = confirm
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def add(self, item_id: str):
+        with self._lock:
+            self.bloom.add(item_id)
+            self.lru[item_id] = None
+            self.lru.move_to_end(item_id)
+            if len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+
+    def preload(self, item_ids):
+        """
+        :param item_ids: an iterable of ids already collected (e.g. Database.iter_column).
+        :return: the number of ids loaded.
+        """
+        number_ids = 0
+        for item_id in item_ids:
+            self.add(item_id)
+            number_ids += 1
+        return number_ids
+
+    def seen(self, item_id: str) -> bool:
+        with self._lock:
+            if item_id not in self.bloom:
+                self.misses += 1
+                return False
+            if item_id in self.lru:
+                self.lru.move_to_end(item_id)
+                self.hits += 1
+                return True
+
+        seen = bool(self.confirm and self.confirm(item_id))
+        with self._lock:
+            if seen:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return seen
+
+    def __contains__(self, item_id: str) -> bool:
+        return self.seen(item_id)
+
+
+"""
+    Submissions collected during this run (shared by all the collections).
+"""
+seen_submissions = SeenIds()
@@ -1,12 +1,162 @@
-from information_recovery.data_collection_to_excel import collect_subreddits
+import argparse
+import sys
 
 """
-    Example: retrieve information and posts from subreddit 'funny', and save the data in 4 excels files:
-    data/subreddits.csv, data/submissions.csv, data/comments.csv and data/crossposts.csv.
+    Command line of recommenddit. Each command imports only what it needs (praw, psycopg2, pandas, numpy...), so
+    starting it is fast and the offline commands work without credentials.
+
+    Examples:
+        python main.py crawl funny aww                  # collects the subreddits in the csv files (data/*.csv)
+        python main.py crawl --sink db --workers 4      # collects the subreddits to explore in the database
+        python main.py crawl --sink db --frontier       # collects the crawl frontier (several machines at once)
+        python main.py refresh funny aww                # collects what changed since the last refresh (database)
+        python main.py resume --sink db                 # completes the subreddits with few submissions
+        python main.py import-csv --bulk                # loads the csv files in the database
+        python main.py build-index --source parquet     # builds the crosspost graph and the recommendation index
+        python main.py recommend funny -k 5
 """
-if __name__ == '__main__':
-    print("---------- Ehhh, what's up, doc? ----------")
+SINKS = ("csv", "db", "parquet")
+
+
+def crawl(arguments):
+    if arguments.frontier:
+        if arguments.sink != "db":
+            raise SystemExit("The crawl frontier needs the database (--sink db).")
+        from information_recovery.data_collection_to_db import collect_frontier
+
+        collect_frontier(workers=arguments.workers, max_subreddits=arguments.max_subreddits, wait=arguments.wait)
+    elif arguments.sink == "db":
+        from information_recovery.data_collection_to_db import collect_subreddits
+
+        collect_subreddits(subreddits=arguments.subreddits or None, max_workers=arguments.workers)
+    else:
+        if not arguments.subreddits:
+            raise SystemExit(f"The subreddits to collect are needed with --sink {arguments.sink}.")
+        if arguments.sink == "csv":
+            from information_recovery.data_collection_to_excel import collect_subreddits
+        else:
+            from information_recovery.data_collection_to_parquet import collect_subreddits
+
+        collect_subreddits(subreddits=arguments.subreddits, max_workers=arguments.workers)
+
+
+def resume(arguments):
+    if arguments.sink == "db":
+        from information_recovery.data_collection_to_db import complete_collection
+
+        complete_collection()
+    elif arguments.sink == "csv":
+        if not arguments.file:
+            raise SystemExit("The file with the subreddits to complete is needed with --sink csv (--file).")
+        from information_recovery.data_collection_to_excel import complete_collection
+
+        complete_collection(arguments.file)
+    else:
+        raise SystemExit("The parquet collections are resumed with crawl (each subreddit has a checkpoint).")
+
+
+def refresh(arguments):
+    from information_recovery.data_collection_to_db import refresh_subreddits, REFRESH_WINDOW
+
+    refresh_window = int(arguments.window_days * 24 * 3600) if arguments.window_days else REFRESH_WINDOW
+    refresh_subreddits(subreddits=arguments.subreddits or None, max_workers=arguments.workers,
+                       refresh_window=refresh_window)
+
+
+def import_csv(arguments):
+    from database.storage import STORAGE_BACKEND
+    from information_recovery.data_collection_to_excel import csv_file_to_db
+
+    if STORAGE_BACKEND == "postgres":
+        from database.schema import migrate
+
+        migrate()
+    csv_file_to_db(bulk=arguments.bulk)
+
+
+def build_index(arguments):
+    from model import recommender
 
-    collect_subreddits(subreddits=["funny"])
+    folder = arguments.index_folder or recommender.index_folder
+    if arguments.incremental:
+        from model.incremental_update import update_index
 
-    print("---------- Th-th-that's all, folks! ----------")
+        update_index(source=arguments.source, folder=folder, method=arguments.method, k=arguments.k,
+                     workers=arguments.workers)
+    else:
+        from model.crosspost_graph import build_graph
+
+        graph = build_graph(source=arguments.source)
+        recommender.build_index(graph, method=arguments.method, k=arguments.k, folder=folder,
+                                workers=arguments.workers)
+
+
+def recommend(arguments):
+    from model import recommender
+
+    recommender.index_folder = arguments.index_folder or recommender.index_folder
+    for subreddit, score in recommender.recommend(arguments.subreddit, k=arguments.k):
+        print(f"{subreddit}\t{score:.4f}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="recommenddit", description="Reddit crawler and subreddit recommender.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("crawl", help="collect subreddits (submissions, comments and crossposts)")
+    command.add_argument("subreddits", nargs="*",
+                         help="the subreddits to collect (with --sink db, the subreddits to explore by default)")
+    command.add_argument("--sink", choices=SINKS, default="csv")
+    command.add_argument("--workers", type=int, default=1, help="subreddits collected at the same time")
+    command.add_argument("--frontier", action="store_true", help="collect the crawl frontier (--sink db)")
+    command.add_argument("--max-subreddits", type=int, default=None,
+                         help="subreddits collected by each worker of the frontier")
+    command.add_argument("--wait", action="store_true", help="wait for new subreddits in the frontier")
+    command.set_defaults(run=crawl)
+
+    command = commands.add_parser("resume", help="complete the subreddits collected with few submissions")
+    command.add_argument("--sink", choices=SINKS, default="db")
+    command.add_argument("--file", help="csv file of (subreddit, last_id, offset) rows (--sink csv)")
+    command.set_defaults(run=resume)
+
+    command = commands.add_parser("refresh", help="collect the new submissions and comments since the last refresh")
+    command.add_argument("subreddits", nargs="*", help="the subreddits refreshed (all the saved ones by default)")
+    command.add_argument("--workers", type=int, default=1, help="subreddits collected at the same time")
+    command.add_argument("--window-days", type=float, default=None,
+                         help="age of the submissions whose new comments are collected (REFRESH_WINDOW by default)")
+    command.set_defaults(run=refresh)
+
+    command = commands.add_parser("import-csv", help="load the csv files in the database (see STORAGE_BACKEND)")
+    command.add_argument("--bulk", action="store_true", help="load them with COPY, in chunks (PostgreSQL)")
+    command.set_defaults(run=import_csv)
+
+    command = commands.add_parser("build-index", help="build the recommendation index")
+    command.add_argument("--source", choices=("database", "parquet"), default="database")
+    command.add_argument("--method", choices=("cosine", "jaccard", "pmi"), default="cosine")
+    command.add_argument("-k", type=int, default=50, help="recommendations kept for each subreddit")
+    command.add_argument("--workers", type=int, default=None, help="processes (all the cores by default)")
+    command.add_argument("--incremental", action="store_true",
+                         help="only add the crossposts saved since the last version")
+    command.add_argument("--index-folder", default=None, help="the folder of the index (data/index/ by default)")
+    command.set_defaults(run=build_index)
+
+    command = commands.add_parser("recommend", help="recommend the subreddits most similar to a subreddit")
+    command.add_argument("subreddit")
+    command.add_argument("-k", type=int, default=10)
+    command.add_argument("--index-folder", default=None, help="the folder of the index (data/index/ by default)")
+    command.set_defaults(run=recommend)
+
+    return parser
+
+
+def main(argv: [str] = None):
+    arguments = build_parser().parse_args(argv)
+
+    # The banner goes to stderr, so the output of the commands (e.g. recommend) can be piped
+    print("---------- Ehhh, what's up, doc? ----------", file=sys.stderr)
+    arguments.run(arguments)
+    print("---------- Th-th-that's all, folks! ----------", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,195 @@
+import json
+import os
+
+import numpy as np
+from scipy import sparse
+
+from database.database import RedditTables
+
+graph_folder = "data/graph/"
+
+"""
+    Crossposts between subreddits, aggregated in the database: one row for each (parent subreddit, crosspost
+    subreddit) with the number of crossposts.
+"""
+SQL_SUBREDDIT_EDGES = f"""
+                      SELECT parent.subreddit, child.subreddit, count(*)
+                      FROM {RedditTables.CROSSPOSTS.value} AS crosspost
+                      JOIN {RedditTables.SUBMISSIONS.value} AS parent
+                      ON (parent.post_id = crosspost.crosspost_parent_id)
+                      JOIN {RedditTables.SUBMISSIONS.value} AS child
+                      ON (child.post_id = crosspost.crosspost_id)
+                      GROUP BY parent.subreddit, child.subreddit;
+                      """
+
+
+class CrosspostGraph:
+    """
+    Weighted graph of subreddits: adjacency[i, j] is the number of submissions of subreddit i crossposted to
+    subreddit j. The adjacency is a scipy CSR matrix, and names[i] is the name of the subreddit i.
+    """
+    names: [str]
+    index: dict
+    adjacency: sparse.csr_matrix
+
+    def __init__(self, names: [str], adjacency: sparse.csr_matrix):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.adjacency = adjacency
+
+    @classmethod
+    def from_edges(cls, parents, children, weights=None, self_loops: bool = False):
+        """
+        Builds the graph from arrays of edges. Repeated edges are summed.
+
+        :param parents: array with the subreddit of the parent submission of each edge.
+        :param children: array with the subreddit of the crosspost of each edge.
+        :param weights: array with the weight of each edge. Can be null (1 for each edge).
+        :param self_loops: if False, crossposts to the same subreddit are dropped.
+        :return: a CrosspostGraph instance.
+        """
+        import pandas as pd
+
+        parents = np.asarray(parents, dtype=object)
+        children = np.asarray(children, dtype=object)
+        weights = np.ones(len(parents), dtype=np.float32) if weights is None else np.asarray(weights, np.float32)
+
+        codes, names = pd.factorize(np.concatenate([parents, children]))
+        rows, cols = codes[:len(parents)], codes[len(parents):]
+
+        if not self_loops:
+            keep = rows != cols
+            rows, cols, weights = rows[keep], cols[keep], weights[keep]
+
+        adjacency = sparse.coo_matrix((weights, (rows, cols)), shape=(len(names), len(names))).tocsr()
+        adjacency.sum_duplicates()
+        return cls(names=names, adjacency=adjacency)
+
+    def __len__(self):
+        return len(self.names)
+
+    def number_edges(self) -> int:
+        return self.adjacency.nnz
+
+    def symmetric(self) -> sparse.csr_matrix:
+        """
+        :return: the adjacency without direction (crossposts in both directions are summed).
+        """
+        return (self.adjacency + self.adjacency.T).tocsr()
+
+    def neighbours(self, subreddit: str):
+        """
+        :param subreddit: a str representing the name of a subreddit.
+        :return: a list of (subreddit, weight) of the subreddits where it was crossposted, heaviest first.
+        """
+        i = self.index[subreddit]
+        start, end = self.adjacency.indptr[i], self.adjacency.indptr[i + 1]
+        order = np.argsort(-self.adjacency.data[start:end], kind="stable")
+        return [(self.names[self.adjacency.indices[start + j]], float(self.adjacency.data[start + j]))
+                for j in order]
+
+    def save(self, folder: str = graph_folder):
+        """
+        Saves the graph as .npy arrays (that can be memory-mapped when loading) and the names as json.
+        """
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, "indptr.npy"), self.adjacency.indptr)
+        np.save(os.path.join(folder, "indices.npy"), self.adjacency.indices)
+        np.save(os.path.join(folder, "data.npy"), self.adjacency.data)
+        with open(os.path.join(folder, "names.json"), "w", encoding="utf-8") as file:
+            json.dump(self.names, file)
+
+    @classmethod
+    def load(cls, folder: str = graph_folder, mmap: bool = True):
+        """
+        :param folder: the folder where the graph was saved.
+        :param mmap: if True, the arrays are memory-mapped instead of read.
+        :return: a CrosspostGraph instance.
+        """
+        mmap_mode = "r" if mmap else None
+        indptr = np.load(os.path.join(folder, "indptr.npy"), mmap_mode=mmap_mode)
+        indices = np.load(os.path.join(folder, "indices.npy"), mmap_mode=mmap_mode)
+        data = np.load(os.path.join(folder, "data.npy"), mmap_mode=mmap_mode)
+        with open(os.path.join(folder, "names.json"), encoding="utf-8") as file:
+            names = json.load(file)
+
+        adjacency = sparse.csr_matrix((data, indices, indptr), shape=(len(names), len(names)), copy=False)
+        return cls(names=names, adjacency=adjacency)
+
+
+def edges_from_database(batch_size: int = 100000):
+    """
+    Reads the crossposts between subreddits from the database. The aggregation is made by the database, and the
+    results are streamed in batches.
+
+    :param batch_size: number of rows fetched at a time.
+    :return: arrays of parents, children and weights.
+    """
+    from database.storage import get_storage
+
+    parents, children, weights = [], [], []
+    for rows in get_storage().iter_rows(SQL_SUBREDDIT_EDGES, batch_size=batch_size):
+        parent, child, weight = zip(*rows)
+        parents.append(np.array(parent, dtype=object))
+        children.append(np.array(child, dtype=object))
+        weights.append(np.array(weight, dtype=np.float32))
+
+    if not parents:
+        return np.array([], dtype=object), np.array([], dtype=object), np.array([], dtype=np.float32)
+    return np.concatenate(parents), np.concatenate(children), np.concatenate(weights)
+
+
+def edges_from_parquet(folder: str = None, files: [str] = None):
+    """
+    Reads the crossposts between subreddits from the parquet files (see data_collection_to_parquet), loading only
+    the needed columns.
+
+    :param folder: the folder of the parquet files. Can be null (default folder).
+    :param files: the files of the crossposts to read. Can be null (all of them).
+    :return: arrays of parents, children and weights.
+    """
+    import pandas as pd
+
+    from information_recovery.data_collection_to_parquet import read_table, parquet_folder
+
+    folder = folder or parquet_folder
+    columns = ["crosspost_parent_id", "crosspost_id"]
+    if files is None:
+        crossposts = read_table(RedditTables.CROSSPOSTS.value, columns=columns, folder=folder)
+    elif files:
+        crossposts = pd.concat([pd.read_parquet(file, engine="pyarrow", columns=columns) for file in files])
+    else:
+        return np.array([], dtype=object), np.array([], dtype=object), np.array([], dtype=np.float32)
+    submissions = read_table(RedditTables.SUBMISSIONS.value, columns=["post_id", "subreddit"], folder=folder)
+
+    # A submission can be saved more than once (e.g. as crosspost of several submissions)
+    subreddit_of = submissions.drop_duplicates("post_id").set_index("post_id")["subreddit"].astype(object)
+    parents = crossposts["crosspost_parent_id"].map(subreddit_of)
+    children = crossposts["crosspost_id"].map(subreddit_of)
+
+    known = parents.notna() & children.notna()
+    edges = pd.DataFrame({"parent": parents[known], "child": children[known]})
+    edges = edges.groupby(["parent", "child"], sort=False).size().reset_index(name="weight")
+    return edges["parent"].to_numpy(object), edges["child"].to_numpy(object), edges["weight"].to_numpy(np.float32)
+
+
+def build_graph(source: str = "database", folder: str = graph_folder):
+    """
+    Builds the crosspost graph of the subreddits and saves it.
+
+    :param source: "database" or "parquet".
+    :param folder: the folder where the graph is saved.
+    :return: a CrosspostGraph instance.
+    """
+    print(f"Building crosspost graph from {source}.")
+    if source == "database":
+        parents, children, weights = edges_from_database()
+    elif source == "parquet":
+        parents, children, weights = edges_from_parquet()
+    else:
+        raise ValueError(f"Unknown source '{source}'. Options: 'database', 'parquet'.")
+
+    graph = CrosspostGraph.from_edges(parents, children, weights)
+    graph.save(folder)
+    print(f"\t {len(graph)} subreddits and {graph.number_edges()} edges saved in '{folder}'.")
+    return graph
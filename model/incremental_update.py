@@ -0,0 +1,248 @@
+import glob
+import json
+import os
+import time
+
+import numpy as np
+from scipy import sparse
+
+from database.database import RedditTables
+from model.crosspost_graph import CrosspostGraph
+from model.recommender import RecommendationIndex, DEFAULT_K, DEFAULT_BLOCK_SIZE, index_folder, current_version, \
+    publish_version, compute_top_k, _prepare, _score_block
+
+"""
+    Watermark of the database: each crosspost has the time it was saved (ingested_at), and each update takes the
+    crossposts saved after the previous watermark. The newest INGESTION_LAG seconds are left for the next update, so
+    the rows of transactions that were still running are not skipped.
+"""
+INGESTION_LAG = 300  # seconds
+INGESTED_AT_VERSION = 4  # version of the schema that adds ingested_at (see database.schema.MIGRATIONS)
+
+SQL_NEW_SUBREDDIT_EDGES = f"""
+                          SELECT parent.subreddit, child.subreddit, count(*)
+                          FROM {RedditTables.CROSSPOSTS.value} AS crosspost
+                          JOIN {RedditTables.SUBMISSIONS.value} AS parent
+                          ON (parent.post_id = crosspost.crosspost_parent_id)
+                          JOIN {RedditTables.SUBMISSIONS.value} AS child
+                          ON (child.post_id = crosspost.crosspost_id)
+                          WHERE crosspost.ingested_at > %s AND crosspost.ingested_at <= %s
+                          GROUP BY parent.subreddit, child.subreddit;
+                          """
+
+
+def new_edges_from_database(state: dict = None):
+    """
+    :param state: the state of the previous update. Can be null (all the crossposts are new).
+    :return: arrays of parents, children and weights of the new crossposts, and the new state.
+    """
+    from database.database import database
+    from database.schema import applied_versions
+    from database.storage import require_postgres
+
+    require_postgres("The incremental update from the database (the ingested_at watermark of the crossposts)")
+    # The ingested_at column of the crossposts. The schema is not changed from here (migrating removes duplicated
+    # rows and adds keys on the live tables).
+    if INGESTED_AT_VERSION not in applied_versions():
+        raise RuntimeError(f"The crossposts have no ingested_at column (migration {INGESTED_AT_VERSION} of the "
+                           f"schema). Update the schema first: python -m database.schema")
+    watermark = state["watermark"] if state else "-infinity"
+    new_watermark = database.fetch_all("SELECT (now() - %s::interval)::text;", (f"{INGESTION_LAG} seconds",))[0][0]
+
+    rows = database.fetch_all(SQL_NEW_SUBREDDIT_EDGES, (watermark, new_watermark))
+    parents, children, weights = zip(*rows) if rows else ((), (), ())
+    return (np.array(parents, dtype=object), np.array(children, dtype=object), np.array(weights, dtype=np.float32),
+            {"source": "database", "watermark": new_watermark})
+
+
+def new_edges_from_parquet(state: dict = None, folder: str = None):
+    """
+    The parquet files are never modified (each batch is a new file), so the watermark is the list of files of
+    crossposts already read.
+
+    :param state: the state of the previous update. Can be null (all the crossposts are new).
+    :param folder: the folder of the parquet files. Can be null (default folder).
+    :return: arrays of parents, children and weights of the new crossposts, and the new state.
+    """
+    from information_recovery.data_collection_to_parquet import parquet_folder
+    from model.crosspost_graph import edges_from_parquet
+
+    folder = folder or parquet_folder
+    files = sorted(os.path.relpath(file, folder)
+                   for file in glob.glob(os.path.join(folder, RedditTables.CROSSPOSTS.value, "*", "*.parquet")))
+    read_files = set(state["files"]) if state else set()
+    new_files = [file for file in files if file not in read_files]
+
+    parents, children, weights = edges_from_parquet(folder, files=[os.path.join(folder, file) for file in new_files])
+    return parents, children, weights, {"source": "parquet", "files": files}
+
+
+NEW_EDGES_SOURCES = {
+    "database": new_edges_from_database,
+    "parquet": new_edges_from_parquet,
+}
+
+
+def load_current(folder: str = index_folder):
+    """
+    :return: the current index, its graph and its state. (None, None, None) if there is no version with them.
+    """
+    version = current_version(folder)
+    if not version:
+        return None, None, None
+
+    version_folder = os.path.join(folder, version)
+    state_file = os.path.join(version_folder, "state.json")
+    if not os.path.exists(state_file) or not os.path.exists(os.path.join(version_folder, "graph")):
+        return None, None, None
+
+    with open(state_file, encoding="utf-8") as file:
+        state = json.load(file)
+    index = RecommendationIndex.load(folder, mmap=False)
+    graph = CrosspostGraph.load(os.path.join(version_folder, "graph"), mmap=False)
+    return index, graph, state
+
+
+def add_edges(graph: CrosspostGraph, parents, children, weights):
+    """
+    :return: a new graph with the edges added (new subreddits go at the end), and the ids of the subreddits whose
+    rows (or columns) changed.
+    """
+    names = list(graph.names) if graph else []
+    index = dict(graph.index) if graph else {}
+    for name in np.concatenate([parents, children]):
+        if name not in index:
+            index[name] = len(names)
+            names.append(name)
+
+    rows = np.fromiter((index[name] for name in parents), dtype=np.int64, count=len(parents))
+    cols = np.fromiter((index[name] for name in children), dtype=np.int64, count=len(children))
+    keep = rows != cols
+    rows, cols, weights = rows[keep], cols[keep], np.asarray(weights, dtype=np.float32)[keep]
+
+    shape = (len(names), len(names))
+    adjacency = sparse.coo_matrix((weights, (rows, cols)), shape=shape).tocsr()
+    if graph:
+        old = graph.adjacency.tocoo()
+        adjacency = adjacency + sparse.coo_matrix((old.data, (old.row, old.col)), shape=shape).tocsr()
+    adjacency.sum_duplicates()
+
+    changed = np.unique(np.concatenate([rows, cols]))
+    return CrosspostGraph(names=names, adjacency=adjacency), changed
+
+
+def _merge_neighbours(neighbours: np.ndarray, scores: np.ndarray, candidates: np.ndarray,
+                      candidate_scores: np.ndarray, k: int):
+    """
+    Merges the current neighbours (-1 when there are no more) with new candidates, keeping the k best of each row.
+    Unrelated candidates are -inf.
+    """
+    scores = np.where(neighbours >= 0, scores, -np.inf)
+    neighbours = np.concatenate([neighbours, candidates], axis=1)
+    scores = np.concatenate([scores, candidate_scores], axis=1)
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    neighbours = np.take_along_axis(neighbours, best, axis=1)
+    scores = np.take_along_axis(scores, best, axis=1)
+
+    order = np.argsort(-scores, axis=1, kind="stable")
+    neighbours = np.take_along_axis(neighbours, order, axis=1).astype(np.int32)
+    scores = np.take_along_axis(scores, order, axis=1)
+    unrelated = ~np.isfinite(scores)
+    neighbours[unrelated] = -1
+    scores[unrelated] = 0
+    return neighbours, scores.astype(np.float32)
+
+
+def update_neighbours(index: RecommendationIndex, old_graph: CrosspostGraph, graph: CrosspostGraph,
+                      changed: np.ndarray, block_size: int = DEFAULT_BLOCK_SIZE, workers: int = None):
+    """
+    Updates the neighbours of the index after the rows "changed" of the graph changed. The similarities between two
+    subreddits that did not change are the same (or, with pmi, all of them move by the same amount), so:
+        - the subreddits that changed, and the ones that had one of them as neighbour, are computed again.
+        - the rest only compare their neighbours with the subreddits that changed.
+
+    :return: the neighbours and scores of every subreddit of the new graph.
+    """
+    number_subreddits, k = len(graph), index.k
+    neighbours = np.full((number_subreddits, k), -1, dtype=np.int32)
+    scores = np.zeros((number_subreddits, k), dtype=np.float32)
+    neighbours[:len(index.names)] = index.neighbours
+    scores[:len(index.names)] = index.scores
+
+    cooccurrences = graph.symmetric()
+    data = _prepare(cooccurrences, index.method)
+
+    is_changed = np.zeros(number_subreddits, dtype=bool)
+    is_changed[changed] = True
+    recompute = is_changed | (is_changed[neighbours] & (neighbours >= 0)).any(axis=1)
+    unchanged = np.flatnonzero(~recompute)
+
+    if index.method == "pmi" and len(unchanged):
+        old_total = old_graph.symmetric().sum()
+        shift = np.log(data["total"] / old_total)
+        valid = neighbours[unchanged] >= 0
+        scores[unchanged] = np.where(valid, scores[unchanged] + shift, 0)
+
+    # The similarities are symmetric: the scores of the changed rows are also their scores as candidates
+    for start in range(0, len(changed), block_size):
+        block = changed[start:start + block_size]
+        block_scores = _score_block(data, block)[:, unchanged].T
+        candidates = np.broadcast_to(block.astype(np.int32), block_scores.shape)
+        neighbours[unchanged], scores[unchanged] = _merge_neighbours(neighbours[unchanged], scores[unchanged],
+                                                                     candidates, block_scores, k)
+
+    rows = np.flatnonzero(recompute)
+    if len(rows):
+        new_neighbours, new_scores = compute_top_k(cooccurrences, method=index.method, k=k, block_size=block_size,
+                                                   workers=workers, rows=rows, data=data)
+        neighbours[rows, :new_neighbours.shape[1]] = new_neighbours
+        scores[rows, :new_scores.shape[1]] = new_scores
+    return neighbours, scores, len(rows)
+
+
+def update_index(source: str = "database", folder: str = index_folder, method: str = "cosine", k: int = DEFAULT_K,
+                 workers: int = None):
+    """
+    Updates the recommendation index with the crossposts saved since the previous update, and publishes it as a new
+    version (see recommender.publish_version). The whole index is built if there is no previous version, it was
+    built from another source or with another k, or its rows are shorter than k (it was built when the graph had
+    fewer subreddits) and the graph has grown.
+
+    :param source: "database" or "parquet".
+    :param folder: the folder of the index.
+    :param method: the similarity method, when the whole index is built (otherwise, the one of the index).
+    :param k: the number of recommendations of each subreddit.
+    :param workers: number of processes. Can be null (all the cores).
+    :return: a RecommendationIndex instance.
+    """
+    if source not in NEW_EDGES_SOURCES:
+        raise ValueError(f"Unknown source '{source}'. Options: {list(NEW_EDGES_SOURCES)}.")
+
+    index, old_graph, state = load_current(folder)
+    if state and state.get("source") != source:
+        index, old_graph, state = None, None, None
+
+    print(f"Updating recommendation index from {source}.")
+    time_start = time.time()
+    parents, children, weights, new_state = NEW_EDGES_SOURCES[source](state)
+    if index and not len(parents) and index.requested_k == k:
+        print("\t No new crossposts.")
+        return index
+
+    graph, changed = add_edges(old_graph, parents, children, weights)
+    # The rows of an index built when the graph had k subreddits or less are shorter than k: it's built again
+    if index and (index.requested_k != k or index.k < min(k, max(len(graph) - 1, 1))):
+        index, method = None, index.method
+    if index:
+        neighbours, scores, number_computed = update_neighbours(index, old_graph, graph, changed, workers=workers)
+        method = index.method
+    else:
+        neighbours, scores = compute_top_k(graph.symmetric(), method=method, k=k, workers=workers)
+        number_computed = len(graph)
+
+    new_index = RecommendationIndex(names=graph.names, neighbours=neighbours, scores=scores, method=method,
+                                    requested_k=k)
+    version = publish_version(new_index, folder, graph=graph, state=new_state)
+    print(f"\t {len(parents)} new edges, {len(changed)} subreddits changed and {number_computed} recomputed. "
+          f"Saved as {version} ({time.time() - time_start:.1f} seconds).")
+    return new_index
@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+"""
+    Maximum number of results kept, and seconds a result is valid.
+"""
+DEFAULT_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 4096))
+DEFAULT_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", 600))  # seconds
+
+
+class QueryCache:
+    """
+    Cache of the results of the queries, with LRU and TTL eviction. Each result belongs to a version of the index:
+    when a query comes with another version, the whole cache is dropped. It counts hits, misses, evictions (because
+    of size or TTL) and invalidations (new versions).
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE, ttl: float = DEFAULT_CACHE_TTL, clock=time.monotonic):
+        """
+        :param max_size: maximum number of results. With 0, nothing is cached.
+        :param ttl: seconds a result is valid. Can be null (no expiration).
+        :param clock: function returning the current time in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.version = None
+        self.entries = OrderedDict()  # key -> (expiration, result), the least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self.version:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.version = version
+
+    def get(self, key, version=None):
+        """
+        :return: the result of the key, or None if it's not cached (or it expired).
+        """
+        with self._lock:
+            self._check_version(version)
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and entry[0] <= self.clock():
+                del self.entries[key]
+                self.evictions += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, result, version=None):
+        with self._lock:
+            self._check_version(version)
+            if self.max_size <= 0:
+                return
+            expiration = self.clock() + self.ttl if self.ttl is not None else None
+            self.entries[key] = (expiration, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute, version=None):
+        """
+        :param key: the key of the query, e.g. ("recommend", subreddit, k, method).
+        :param compute: function without parameters that computes the result when it's not cached.
+        :param version: the version of the index used by compute.
+        :return: the result. Lists are cached as tuples, so the callers can't modify the cached results.
+        """
+        result = self.get(key, version)
+        if result is None:
+            result = compute()
+            self.put(key, tuple(result) if isinstance(result, list) else result, version)
+            return result
+        return list(result) if isinstance(result, tuple) else result
+
+    def invalidate(self):
+        with self._lock:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        """
+        :return: a dict with the size of the cache and its counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0, "evictions": self.evictions,
+                    "invalidations": self.invalidations}
@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import json
+from urllib.parse import urlsplit, parse_qs
+
+from model import recommender
+
+"""
+    Local HTTP service of recommendations (asyncio, HTTP/1.1 with keep-alive). The index is loaded when the service
+    starts, and again when a new version is published (see recommender.get_default_index).
+
+        GET  /recommend?subreddit=<name>&k=<k>
+        GET  /recommend/batch?subreddit=<name>&subreddit=<name>&k=<k>
+        POST /recommend/batch    {"subreddits": [<name>, ...], "k": <k>}
+        GET  /stats              cache counters and version of the index
+        GET  /health
+
+    Usage: python -m model.recommendation_service [--host HOST] [--port PORT] [--index-folder FOLDER]
+"""
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_RECOMMENDATIONS = 10
+
+"""
+    Limits of the requests: size of the headers and body (bytes), and subreddits of a batch.
+"""
+MAX_HEADER_SIZE = 16 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+MAX_BATCH_SUBREDDITS = 1000
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+           500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _get_k(value) -> int:
+    try:
+        k = int(value) if value is not None else DEFAULT_RECOMMENDATIONS
+    except (TypeError, ValueError):
+        raise HttpError(400, f"Invalid k '{value}'.")
+    if k < 1:
+        raise HttpError(400, "k must be positive.")
+    return min(k, recommender.get_default_index().k)
+
+
+def _recommendations(subreddit: str, k: int):
+    return [{"subreddit": name, "score": score} for name, score in recommender.recommend(subreddit, k)]
+
+
+def recommend(query: dict, body: bytes):
+    subreddit = query.get("subreddit", [None])[0]
+    if not subreddit:
+        raise HttpError(400, "Missing parameter 'subreddit'.")
+    k = _get_k(query.get("k", [None])[0])
+    if subreddit not in recommender.get_default_index().index:
+        raise HttpError(404, f"Unknown subreddit '{subreddit}'.")
+    return {"subreddit": subreddit, "recommendations": _recommendations(subreddit, k)}
+
+
+def recommend_batch(query: dict, body: bytes):
+    subreddits = query.get("subreddit", [])
+    k = query.get("k", [None])[0]
+    if body:
+        try:
+            request = json.loads(body)
+            subreddits = request["subreddits"]
+            k = request.get("k", k)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise HttpError(400, 'The body must be a json like {"subreddits": [...], "k": 10}.')
+    if not subreddits or not isinstance(subreddits, list):
+        raise HttpError(400, "Missing subreddits.")
+    if len(subreddits) > MAX_BATCH_SUBREDDITS:
+        raise HttpError(413, f"At most {MAX_BATCH_SUBREDDITS} subreddits by request.")
+
+    k = _get_k(k)
+    # Unknown subreddits have an empty list
+    return {"results": {str(subreddit): _recommendations(str(subreddit), k) for subreddit in subreddits}}
+
+
+def stats(query: dict, body: bytes):
+    index = recommender.get_default_index()
+    return {"version": index.version, "method": index.method, "subreddits": len(index.names), "k": index.k,
+            "cache": recommender.recommendation_cache.stats()}
+
+
+def health(query: dict, body: bytes):
+    return {"status": "ok"}
+
+
+ROUTES = {
+    ("GET", "/recommend"): recommend,
+    ("GET", "/recommend/batch"): recommend_batch,
+    ("POST", "/recommend/batch"): recommend_batch,
+    ("GET", "/stats"): stats,
+    ("GET", "/health"): health,
+}
+
+
+def dispatch(method: str, target: str, body: bytes):
+    """
+    :return: the status and the json response of a request.
+    """
+    url = urlsplit(target)
+    route = ROUTES.get((method, url.path))
+    if route is None:
+        if any(path == url.path for _, path in ROUTES):
+            return 405, {"error": f"Method {method} not allowed."}
+        return 404, {"error": f"Unknown path '{url.path}'."}
+
+    try:
+        return 200, route(parse_qs(url.query), body)
+    except HttpError as e:
+        return e.status, {"error": str(e)}
+    except Exception as e:
+        print(f"### Error answering {method} {target}: {e} ###")
+        return 500, {"error": "Internal error."}
+
+
+async def read_request(reader: asyncio.StreamReader):
+    """
+    :return: the method, target, headers (lowercase names) and body of the next request. None if the connection
+    was closed.
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise HttpError(413, "Headers too big.")
+
+    request_line, *header_lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, _ = request_line.split(" ", 2)
+    except ValueError:
+        raise HttpError(400, "Invalid request line.")
+
+    headers = {}
+    for line in header_lines:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0) or 0)
+    except ValueError:
+        raise HttpError(400, "Invalid Content-Length.")
+    if length < 0:
+        raise HttpError(400, "Invalid Content-Length.")
+    if length > MAX_BODY_SIZE:
+        raise HttpError(413, "Body too big.")
+    body = await reader.readexactly(length) if length else b""
+    return method, target, headers, body
+
+
+def write_response(writer: asyncio.StreamWriter, status: int, response: dict, keep_alive: bool):
+    body = json.dumps(response).encode("utf-8")
+    writer.write(f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                 f"Content-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n"
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body)
+
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            try:
+                request = await read_request(reader)
+            except HttpError as e:
+                write_response(writer, e.status, {"error": str(e)}, keep_alive=False)
+                break
+            if request is None:
+                break
+
+            method, target, headers, body = request
+            keep_alive = headers.get("connection", "").lower() != "close"
+            status, response = dispatch(method, target, body)
+            write_response(writer, status, response, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+    """
+    Loads the index and answers requests until it's cancelled.
+    """
+    index = recommender.get_default_index()
+    server = await asyncio.start_server(handle_connection, host, port, limit=MAX_HEADER_SIZE)
+    print(f"Serving {len(index.names)} subreddits ({index.method}, version {index.version}) on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local HTTP service of subreddit recommendations.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--index-folder", default=recommender.index_folder)
+    arguments = parser.parse_args()
+
+    recommender.index_folder = arguments.index_folder
+    try:
+        asyncio.run(serve(arguments.host, arguments.port))
+    except KeyboardInterrupt:
+        print("---------- Th-th-that's all, folks! ----------")
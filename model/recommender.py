@@ -0,0 +1,321 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+from model.crosspost_graph import CrosspostGraph, graph_folder
+from model.query_cache import QueryCache
+from model import versions
+from model.versions import current_version
+
+index_folder = "data/index/"
+
+"""
+    Similarities between subreddits, computed from the crosspost co-occurrence matrix C (crossposts in both
+    directions between each pair of subreddits):
+        - cosine: cosine between the rows of C (subreddits crossposted with the same subreddits).
+        - jaccard: Jaccard index between the sets of subreddits each one was crossposted with.
+        - pmi: pointwise mutual information of the crossposts between the two subreddits.
+"""
+SIMILARITY_METHODS = ("cosine", "jaccard", "pmi")
+
+"""
+    Number of neighbours kept for each subreddit, and number of subreddits (rows) scored at a time.
+"""
+DEFAULT_K = 50
+DEFAULT_BLOCK_SIZE = 256
+
+"""
+    Versions of the index (see model.versions): the default index checks for a new version at most every
+    VERSION_CHECK_INTERVAL seconds.
+"""
+VERSION_CHECK_INTERVAL = 5  # seconds
+
+# Matrices used by the worker processes (set once for each process)
+_worker_data = {}
+
+
+def _prepare(cooccurrences: sparse.csr_matrix, method: str) -> dict:
+    """
+    :return: the matrices needed to score blocks of rows with the method.
+    """
+    cooccurrences = cooccurrences.astype(np.float32).tocsr()
+    if method == "cosine":
+        norms = np.sqrt(np.asarray(cooccurrences.multiply(cooccurrences).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        rows = sparse.diags(1 / norms).dot(cooccurrences).tocsr()
+        return {"method": method, "rows": rows, "columns": rows.T.tocsc()}
+    if method == "jaccard":
+        binary = (cooccurrences > 0).astype(np.float32).tocsr()
+        degrees = np.asarray(binary.sum(axis=1)).ravel()
+        return {"method": method, "rows": binary, "columns": binary.T.tocsc(), "degrees": degrees}
+    if method == "pmi":
+        totals = np.asarray(cooccurrences.sum(axis=1)).ravel()
+        return {"method": method, "rows": cooccurrences, "totals": totals, "total": totals.sum()}
+    raise ValueError(f"Unknown similarity method '{method}'. Options: {SIMILARITY_METHODS}")
+
+
+def _score_block(data: dict, rows: np.ndarray) -> np.ndarray:
+    """
+    Similarity between the subreddits of the rows and all the subreddits. The pairs without any relation are -inf.
+
+    :param rows: array with the ids of the subreddits.
+    :return: a dense float32 array of shape (len(rows), number of subreddits).
+    """
+    method = data["method"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if method == "cosine":
+            scores = (data["rows"][rows] @ data["columns"]).toarray()
+            scores[scores <= 0] = -np.inf
+        elif method == "jaccard":
+            intersections = (data["rows"][rows] @ data["columns"]).toarray()
+            unions = data["degrees"][rows, None] + data["degrees"][None, :] - intersections
+            scores = intersections / unions
+            scores[intersections <= 0] = -np.inf
+        else:
+            counts = data["rows"][rows].toarray()
+            expected = data["totals"][rows, None] * data["totals"][None, :] / data["total"]
+            scores = np.log(counts / expected)
+            scores[counts <= 0] = -np.inf
+    return scores.astype(np.float32, copy=False)
+
+
+def _top_k_block(data: dict, start: int, rows: np.ndarray, k: int):
+    """
+    :param start: position of the block in the results.
+    :param rows: array with the ids of the subreddits of the block.
+    :return: the k most similar subreddits (and their similarity) of each subreddit of the rows. When there are less
+    than k related subreddits, the rest are -1 (and 0).
+    """
+    scores = _score_block(data, rows)
+    number_rows, number_subreddits = scores.shape
+    scores[np.arange(number_rows), rows] = -np.inf  # a subreddit is not its own neighbour
+
+    k = min(k, number_subreddits)
+    if k < number_subreddits:
+        neighbours = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        neighbours = np.tile(np.arange(number_subreddits), (number_rows, 1))
+    top_scores = np.take_along_axis(scores, neighbours, axis=1)
+
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    neighbours = np.take_along_axis(neighbours, order, axis=1).astype(np.int32)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    unrelated = ~np.isfinite(top_scores)
+    neighbours[unrelated] = -1
+    top_scores[unrelated] = 0
+    return start, neighbours, top_scores
+
+
+def _init_worker(data: dict):
+    _worker_data.update(data)
+
+
+def _top_k_block_worker(start: int, rows: np.ndarray, k: int):
+    return _top_k_block(_worker_data, start, rows, k)
+
+
+class RecommendationIndex:
+    """
+    Precomputed top-k most similar subreddits of each subreddit. neighbours[i] are the ids of the subreddits most
+    similar to the subreddit i (-1 when there are no more), and scores[i] their similarity.
+    """
+    names: [str]
+    index: dict
+    neighbours: np.ndarray
+    scores: np.ndarray
+    method: str
+    requested_k: int
+    version: str
+
+    def __init__(self, names: [str], neighbours: np.ndarray, scores: np.ndarray, method: str,
+                 requested_k: int = None, version: str = None):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.neighbours = neighbours
+        self.scores = scores
+        self.method = method
+        # The k asked for when it was built (k is smaller while the graph has fewer subreddits than that)
+        self.requested_k = requested_k or neighbours.shape[1]
+        self.version = version
+
+    @property
+    def k(self) -> int:
+        return self.neighbours.shape[1]
+
+    def recommend(self, subreddit: str, k: int = 10):
+        """
+        :param subreddit: a str representing the name of a subreddit.
+        :param k: the number of recommendations (at most the k of the index).
+        :return: a list of (subreddit, similarity), most similar first. Empty if the subreddit is unknown.
+        """
+        i = self.index.get(subreddit)
+        if i is None:
+            return []
+        neighbours = self.neighbours[i, :k]
+        scores = self.scores[i, :k]
+        return [(self.names[j], float(score)) for j, score in zip(neighbours, scores) if j >= 0]
+
+    def save(self, folder: str = index_folder):
+        """
+        Saves the index as .npy arrays (memory-mapped when loading), the names and the metadata as json.
+        """
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, "neighbours.npy"), self.neighbours)
+        np.save(os.path.join(folder, "scores.npy"), self.scores)
+        with open(os.path.join(folder, "names.json"), "w", encoding="utf-8") as file:
+            json.dump(self.names, file)
+        with open(os.path.join(folder, "metadata.json"), "w", encoding="utf-8") as file:
+            json.dump({"method": self.method, "k": self.k, "requested_k": self.requested_k}, file)
+
+    @classmethod
+    def load(cls, folder: str = index_folder, mmap: bool = True):
+        """
+        :param folder: the folder of the index. If it has versions, the current one is loaded.
+        :param mmap: if True, the arrays are memory-mapped instead of read.
+        :return: a RecommendationIndex instance.
+        """
+        version = current_version(folder)
+        if version:
+            folder = os.path.join(folder, version)
+
+        mmap_mode = "r" if mmap else None
+        neighbours = np.load(os.path.join(folder, "neighbours.npy"), mmap_mode=mmap_mode)
+        scores = np.load(os.path.join(folder, "scores.npy"), mmap_mode=mmap_mode)
+        with open(os.path.join(folder, "names.json"), encoding="utf-8") as file:
+            names = json.load(file)
+        with open(os.path.join(folder, "metadata.json"), encoding="utf-8") as file:
+            metadata = json.load(file)
+        return cls(names=names, neighbours=neighbours, scores=scores, method=metadata["method"],
+                   requested_k=metadata.get("requested_k", metadata["k"]), version=version)
+
+
+def publish_version(index: RecommendationIndex, folder: str = index_folder, graph: CrosspostGraph = None,
+                    state: dict = None) -> str:
+    """
+    Saves the index (and the graph and state it was built from) as a new version, and makes it the current one.
+    The version is completely written before CURRENT is replaced, so the readers see either the previous version
+    or the new one.
+
+    :param index: the RecommendationIndex.
+    :param folder: the folder of the index.
+    :param graph: the crosspost graph of the index. Can be null.
+    :param state: json-serializable state of the updates (e.g. the watermark). Can be null.
+    :return: the name of the new version.
+    """
+    def save(version_folder: str):
+        index.save(version_folder)
+        if graph is not None:
+            graph.save(os.path.join(version_folder, "graph"))
+        if state is not None:
+            with open(os.path.join(version_folder, "state.json"), "w", encoding="utf-8") as file:
+                json.dump(state, file)
+
+    index.version = versions.publish_version(folder, save)
+    return index.version
+
+
+def compute_top_k(cooccurrences: sparse.csr_matrix, method: str = "cosine", k: int = DEFAULT_K,
+                  block_size: int = DEFAULT_BLOCK_SIZE, workers: int = None, rows: np.ndarray = None, data=None):
+    """
+    Computes the k most similar subreddits of each subreddit, scoring blocks of block_size subreddits at a time
+    (vectorized) in several processes.
+
+    :param cooccurrences: the symmetric co-occurrence matrix of the subreddits.
+    :param method: "cosine", "jaccard" or "pmi".
+    :param k: the number of neighbours of each subreddit.
+    :param block_size: number of subreddits scored at a time by each process.
+    :param workers: number of processes. Can be null (all the cores). With 1, everything runs in this process.
+    :param rows: the ids of the subreddits to compute. Can be null (all of them).
+    :param data: the matrices of the method, if they were already prepared. Can be null.
+    :return: the neighbours (int32) and scores (float32) arrays, of shape (number of rows, k).
+    """
+    data = data or _prepare(cooccurrences, method)
+    number_subreddits = cooccurrences.shape[0]
+    rows = np.arange(number_subreddits) if rows is None else np.asarray(rows, dtype=np.int64)
+    k = min(k, max(number_subreddits - 1, 1))
+    neighbours = np.full((len(rows), k), -1, dtype=np.int32)
+    scores = np.zeros((len(rows), k), dtype=np.float32)
+
+    blocks = [(start, rows[start:start + block_size]) for start in range(0, len(rows), block_size)]
+    workers = workers or os.cpu_count() or 1
+
+    if workers == 1 or len(blocks) <= 1:
+        results = (_top_k_block(data, start, block_rows, k) for start, block_rows in blocks)
+        for start, block_neighbours, block_scores in results:
+            neighbours[start:start + len(block_neighbours), :block_neighbours.shape[1]] = block_neighbours
+            scores[start:start + len(block_scores), :block_scores.shape[1]] = block_scores
+        return neighbours, scores
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(data,)) as executor:
+        futures = [executor.submit(_top_k_block_worker, start, block_rows, k) for start, block_rows in blocks]
+        for future in futures:
+            start, block_neighbours, block_scores = future.result()
+            neighbours[start:start + len(block_neighbours), :block_neighbours.shape[1]] = block_neighbours
+            scores[start:start + len(block_scores), :block_scores.shape[1]] = block_scores
+    return neighbours, scores
+
+
+def build_index(graph: CrosspostGraph = None, method: str = "cosine", k: int = DEFAULT_K,
+                folder: str = index_folder, workers: int = None):
+    """
+    Precomputes the recommendations of every subreddit and saves them.
+
+    :param graph: the crosspost graph. Can be null (the one saved in the graph folder is loaded).
+    :param method: "cosine", "jaccard" or "pmi".
+    :param k: the number of recommendations kept for each subreddit.
+    :param folder: the folder where the index is saved.
+    :param workers: number of processes. Can be null (all the cores).
+    :return: a RecommendationIndex instance.
+    """
+    if graph is None:
+        graph = CrosspostGraph.load(graph_folder)
+
+    print(f"Building {method} recommendation index of {len(graph)} subreddits.")
+    time_start = time.time()
+    neighbours, scores = compute_top_k(graph.symmetric(), method=method, k=k, workers=workers)
+    index = RecommendationIndex(names=graph.names, neighbours=neighbours, scores=scores, method=method,
+                                requested_k=k)
+    version = publish_version(index, folder, graph=graph)
+    print(f"\t Saved in '{folder}' as {version} ({time.time() - time_start:.1f} seconds).")
+    return index
+
+
+_default_index = None
+_default_index_checked = 0
+
+"""
+    Cache of the recommendations of the default index. It's dropped when a new version of the index is loaded.
+"""
+recommendation_cache = QueryCache()
+
+
+def get_default_index() -> RecommendationIndex:
+    """
+    :return: the index saved in the index folder. It's loaded the first time, and again when a new version is
+    published.
+    """
+    global _default_index, _default_index_checked
+    now = time.monotonic()
+    if _default_index is None or now - _default_index_checked > VERSION_CHECK_INTERVAL:
+        _default_index_checked = now
+        if _default_index is None or current_version(index_folder) != _default_index.version:
+            _default_index = RecommendationIndex.load(index_folder)
+    return _default_index
+
+
+def recommend(subreddit: str, k: int = 10):
+    """
+    Recommends the subreddits most similar to a subreddit, using the index saved in the index folder.
+
+    :param subreddit: a str representing the name of a subreddit.
+    :param k: the number of recommendations.
+    :return: a list of (subreddit, similarity), most similar first.
+    """
+    index = get_default_index()
+    return recommendation_cache.get_or_compute(("recommend", subreddit, k, index.method),
+                                               lambda: index.recommend(subreddit, k), version=index.version)
@@ -0,0 +1,312 @@
+import json
+import os
+
+import numpy as np
+from scipy import sparse
+
+from database.database import RedditTables
+
+embeddings_folder = "data/embeddings/"
+
+"""
+    spaCy model used to embed the texts (it needs word vectors, e.g. en_core_web_md or en_core_web_lg). Only the
+    tokenizer and the vectors are used, the rest of the components are not loaded.
+"""
+SPACY_MODEL = os.getenv("SPACY_MODEL", "en_core_web_md")
+UNUSED_COMPONENTS = ["tok2vec", "tagger", "morphologizer", "parser", "senter", "attribute_ruler", "lemmatizer", "ner"]
+
+"""
+    Texts read (and embedded) at a time, texts sent to each process by nlp.pipe, and number of processes.
+"""
+CHUNK_SIZE = 20000
+PIPE_BATCH_SIZE = 256
+PIPE_PROCESSES = max(1, (os.cpu_count() or 1) - 1)
+
+
+class EmbeddingStore:
+    """
+    Append-only store of float32 vectors keyed by id (of submissions or comments), with the subreddit of each one.
+    The vectors are in a raw binary file that is memory-mapped when reading, and the ids in a tsv file with the
+    same order.
+    """
+
+    def __init__(self, folder: str, dim: int = None):
+        self.folder = folder
+        self.vectors_file = os.path.join(folder, "vectors.f32")
+        self.ids_file = os.path.join(folder, "ids.tsv")
+        self.metadata_file = os.path.join(folder, "metadata.json")
+        os.makedirs(folder, exist_ok=True)
+
+        if os.path.exists(self.metadata_file):
+            with open(self.metadata_file, encoding="utf-8") as file:
+                self.dim = json.load(file)["dim"]
+        else:
+            self.dim = dim
+            if dim:
+                with open(self.metadata_file, "w", encoding="utf-8") as file:
+                    json.dump({"dim": dim}, file)
+
+        self.ids = []
+        self.subreddits = []
+        if os.path.exists(self.ids_file):
+            self._truncate_partial_line()
+            with open(self.ids_file, encoding="utf-8") as file:
+                for line in file:
+                    item_id, subreddit = line.rstrip("\n").split("\t")
+                    self.ids.append(item_id)
+                    self.subreddits.append(subreddit)
+
+        # The vectors are written before the ids: after a crash, only the rows with both are valid
+        self.ids = self.ids[:self._number_vectors()]
+        self.subreddits = self.subreddits[:len(self.ids)]
+        self.known_ids = set(self.ids)
+
+    def _truncate_partial_line(self):
+        """
+        Drops the last line of the ids file if it was not completely written (a crash while appending).
+        """
+        with open(self.ids_file, "rb+") as file:
+            size = file.seek(0, os.SEEK_END)
+            if not size:
+                return
+            file.seek(size - 1)
+            if file.read(1) == b"\n":
+                return
+
+            # Looks for the end of the last complete line, from the end of the file
+            position = size
+            while position > 0:
+                start = max(0, position - 65536)
+                file.seek(start)
+                end_of_line = file.read(position - start).rfind(b"\n")
+                if end_of_line >= 0:
+                    file.truncate(start + end_of_line + 1)
+                    return
+                position = start
+            file.truncate(0)
+
+    def _number_vectors(self) -> int:
+        if not self.dim or not os.path.exists(self.vectors_file):
+            return 0
+        return os.path.getsize(self.vectors_file) // (4 * self.dim)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, item_id: str) -> bool:
+        return item_id in self.known_ids
+
+    def append(self, ids: [str], subreddits: [str], vectors: np.ndarray):
+        """
+        :param ids: the ids of the vectors.
+        :param subreddits: the subreddit of each vector.
+        :param vectors: float32 array of shape (len(ids), dim).
+        """
+        if not ids:
+            return
+
+        # Drops the rows of a previous run that were not completely written
+        valid_size = len(self.ids) * 4 * self.dim
+        with open(self.vectors_file, "ab") as file:
+            if file.tell() != valid_size:
+                file.truncate(valid_size)
+            file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+
+        with open(self.ids_file, "w" if not self.ids else "a", encoding="utf-8") as file:
+            file.writelines(f"{item_id}\t{subreddit}\n" for item_id, subreddit in zip(ids, subreddits))
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.ids.extend(ids)
+        self.subreddits.extend(subreddits)
+        self.known_ids.update(ids)
+
+    def vectors(self) -> np.ndarray:
+        """
+        :return: a read-only memory-mapped float32 array of shape (len(self), dim).
+        """
+        if not self.ids:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self.vectors_file, dtype=np.float32, mode="r", shape=(len(self.ids), self.dim))
+
+
+def load_nlp(model: str = SPACY_MODEL):
+    import spacy
+
+    return spacy.load(model, exclude=UNUSED_COMPONENTS)
+
+
+def _skip_known(ids: [str], subreddits: [str], texts: [str], skip_ids):
+    """
+    :return: the chunk (ids, subreddits, texts) without the ids in skip_ids (e.g. an EmbeddingStore).
+    """
+    if not skip_ids:
+        return ids, subreddits, texts
+    keep = [i for i, item_id in enumerate(ids) if item_id not in skip_ids]
+    return [ids[i] for i in keep], [subreddits[i] for i in keep], [texts[i] for i in keep]
+
+
+def submission_texts_from_parquet(folder: str = None, chunk_size: int = CHUNK_SIZE, skip_ids=None):
+    """
+    :param skip_ids: the ids that are not yielded (e.g. the EmbeddingStore). Can be null.
+    :return: a generator of chunks (ids, subreddits, texts) of the submissions (title and content).
+    """
+    from information_recovery.data_collection_to_parquet import read_table, parquet_folder
+
+    submissions = read_table(RedditTables.SUBMISSIONS.value, columns=["post_id", "title", "post_content", "subreddit"],
+                             folder=folder or parquet_folder).drop_duplicates("post_id")
+    texts = submissions["title"].fillna("") + "\n" + submissions["post_content"].fillna("")
+    for start in range(0, len(submissions), chunk_size):
+        end = start + chunk_size
+        yield _skip_known(submissions["post_id"].iloc[start:end].tolist(),
+                          submissions["subreddit"].iloc[start:end].astype(str).tolist(),
+                          texts.iloc[start:end].tolist(), skip_ids)
+
+
+def comment_texts_from_parquet(folder: str = None, chunk_size: int = CHUNK_SIZE, skip_ids=None):
+    """
+    Reads the comments in chunks (the comments table can be much bigger than the memory), skipping the ones in
+    skip_ids before their texts are converted.
+
+    :param skip_ids: the ids that are not yielded (e.g. the EmbeddingStore). Can be null.
+    :return: a generator of chunks (ids, subreddits, texts) of the comments.
+    """
+    from information_recovery.data_collection_to_parquet import iter_table, parquet_folder
+
+    for batch in iter_table(RedditTables.COMMENTS.value, columns=["comment_id", "comment_content", "subreddit"],
+                            folder=folder or parquet_folder, batch_size=chunk_size):
+        ids = batch.column("comment_id").to_pylist()
+        keep = [i for i, item_id in enumerate(ids) if item_id not in skip_ids] if skip_ids else range(len(ids))
+        if not keep:
+            continue
+        if len(keep) < len(ids):
+            batch = batch.take(keep)
+            ids = [ids[i] for i in keep]
+        yield (ids,
+               [str(subreddit) for subreddit in batch.column("subreddit").to_pylist()],
+               [text or "" for text in batch.column("comment_content").to_pylist()])
+
+
+def submission_texts_from_database(chunk_size: int = CHUNK_SIZE, skip_ids=None):
+    from database.storage import get_storage
+
+    sql_select = f"SELECT post_id, subreddit, title, post_content FROM {RedditTables.SUBMISSIONS.value};"
+    for rows in get_storage().iter_rows(sql_select, batch_size=chunk_size):
+        ids = [row[0] for row in rows]
+        subreddits = [row[1] for row in rows]
+        texts = [f"{row[2] or ''}\n{row[3] or ''}" for row in rows]
+        yield _skip_known(ids, subreddits, texts, skip_ids)
+
+
+def comment_texts_from_database(chunk_size: int = CHUNK_SIZE, skip_ids=None):
+    from database.storage import get_storage
+
+    sql_select = f"SELECT comment.comment_id, submission.subreddit, comment.comment_content " \
+                 f"FROM {RedditTables.COMMENTS.value} AS comment " \
+                 f"JOIN {RedditTables.SUBMISSIONS.value} AS submission " \
+                 f"ON (submission.post_id = comment.submission_id);"
+    for rows in get_storage().iter_rows(sql_select, batch_size=chunk_size):
+        ids, subreddits, texts = zip(*rows)
+        yield _skip_known(list(ids), list(subreddits), list(texts), skip_ids)
+
+
+TEXT_SOURCES = {
+    ("submissions", "parquet"): submission_texts_from_parquet,
+    ("comments", "parquet"): comment_texts_from_parquet,
+    ("submissions", "database"): submission_texts_from_database,
+    ("comments", "database"): comment_texts_from_database,
+}
+
+
+def embed_texts(nlp, texts: [str], batch_size: int = PIPE_BATCH_SIZE, n_process: int = PIPE_PROCESSES):
+    """
+    :return: float32 array with the vector of each text (the average of the vectors of its words).
+    """
+    vectors = np.zeros((len(texts), nlp.vocab.vectors_length), dtype=np.float32)
+    for i, doc in enumerate(nlp.pipe(texts, batch_size=batch_size, n_process=n_process)):
+        vectors[i] = doc.vector
+    return vectors
+
+
+def embed(kind: str = "submissions", source: str = "parquet", nlp=None, folder: str = embeddings_folder):
+    """
+    Embeds the submissions or comments that are not in the store yet.
+
+    :param kind: "submissions" or "comments".
+    :param source: "parquet" or "database".
+    :param nlp: the spaCy pipeline. Can be null (SPACY_MODEL is loaded).
+    :param folder: the folder of the stores.
+    :return: the EmbeddingStore.
+    """
+    nlp = nlp or load_nlp()
+    store = EmbeddingStore(os.path.join(folder, kind), dim=nlp.vocab.vectors_length)
+
+    print(f"Embedding {kind} from {source} ({len(store)} already embedded).")
+    number_embedded = 0
+    for ids, subreddits, texts in TEXT_SOURCES[(kind, source)](skip_ids=store):
+        # The chunks can still repeat ids (duplicated rows)
+        new = [i for i, item_id in enumerate(ids) if item_id not in store]
+        if not new:
+            continue
+
+        vectors = embed_texts(nlp, [texts[i] for i in new])
+        store.append([ids[i] for i in new], [subreddits[i] for i in new], vectors)
+        number_embedded += len(new)
+        print(f"\t {number_embedded} {kind} embedded.")
+
+    return store
+
+
+def subreddit_centroids(stores: [EmbeddingStore], chunk_size: int = 100000):
+    """
+    Average vector of each subreddit, over all the vectors of the stores.
+
+    :param stores: the EmbeddingStore's (e.g. submissions and comments).
+    :param chunk_size: number of vectors read at a time from each store.
+    :return: the names of the subreddits, and a float32 array with the centroid of each one.
+    """
+    import pandas as pd
+
+    subreddits = pd.Index(sorted({subreddit for store in stores for subreddit in set(store.subreddits)}))
+    dim = next(store.dim for store in stores if store.dim)
+    sums = np.zeros((len(subreddits), dim), dtype=np.float64)
+    counts = np.zeros(len(subreddits), dtype=np.int64)
+
+    for store in stores:
+        codes = subreddits.get_indexer(store.subreddits)
+        vectors = store.vectors()
+        for start in range(0, len(store), chunk_size):
+            end = min(start + chunk_size, len(store))
+            chunk_codes = codes[start:end]
+            # Indicator matrix (subreddit x vector): the sum of the vectors of each subreddit in one product
+            indicator = sparse.csr_matrix((np.ones(end - start), (chunk_codes, np.arange(end - start))),
+                                          shape=(len(subreddits), end - start))
+            sums += indicator @ np.asarray(vectors[start:end], dtype=np.float64)
+            counts += np.bincount(chunk_codes, minlength=len(subreddits))
+
+    centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+    return list(subreddits), centroids
+
+
+def build_subreddit_embeddings(source: str = "parquet", folder: str = embeddings_folder):
+    """
+    Embeds the new submissions and comments, and saves the centroid of each subreddit in
+    <folder>/subreddits/ (centroids.npy and names.json).
+
+    :param source: "parquet" or "database".
+    :param folder: the folder of the stores.
+    :return: the names of the subreddits, and the centroids.
+    """
+    nlp = load_nlp()
+    stores = [embed(kind, source=source, nlp=nlp, folder=folder) for kind in ("submissions", "comments")]
+    names, centroids = subreddit_centroids(stores)
+
+    subreddits_folder = os.path.join(folder, "subreddits")
+    os.makedirs(subreddits_folder, exist_ok=True)
+    np.save(os.path.join(subreddits_folder, "centroids.npy"), centroids)
+    with open(os.path.join(subreddits_folder, "names.json"), "w", encoding="utf-8") as file:
+        json.dump(names, file)
+    print(f"\t Centroids of {len(names)} subreddits saved in '{subreddits_folder}'.")
+    return names, centroids
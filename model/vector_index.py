@@ -0,0 +1,382 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from model.query_cache import QueryCache
+from model.text_embeddings import embeddings_folder
+from model.versions import current_version, publish_version
+
+vector_index_folder = "data/vector_index/"
+
+"""
+    Number of vectors scored at a time by the exact search, and parameters of the approximate search (IVF): number
+    of lists (clusters) probed for each query, and number of iterations of k-means when training the lists.
+"""
+DEFAULT_BLOCK_SIZE = 65536
+DEFAULT_NPROBE = 8
+KMEANS_ITERATIONS = 10
+
+"""
+    Seconds between the checks of a new version of the default index (see model.versions).
+"""
+VERSION_CHECK_INTERVAL = 5  # seconds
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    :return: float32 copy of the vectors with norm 1 (vectors of zeros are kept as they are).
+    """
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _merge_top_k(ids: np.ndarray, scores: np.ndarray, new_ids: np.ndarray, new_scores: np.ndarray, k: int):
+    """
+    Merges two sets of candidates (of shape (queries, n)) keeping the k best of each query, best first.
+    """
+    ids = np.concatenate([ids, new_ids], axis=1)
+    scores = np.concatenate([scores, new_scores], axis=1)
+    if scores.shape[1] > k:
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        ids = np.take_along_axis(ids, best, axis=1)
+        scores = np.take_along_axis(scores, best, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+class VectorIndex:
+    """
+    Cosine similarity search over the content vectors of the subreddits (see text_embeddings). The exact search
+    scores blocks of vectors with a matrix product; the approximate one (IVF) groups the vectors in lists with
+    k-means and only scores the lists closest to each query.
+    """
+    names: [str]
+    index: dict
+    vectors: np.ndarray
+    centroids: np.ndarray
+    assignments: np.ndarray
+    version: str
+
+    def __init__(self, names: [str], vectors: np.ndarray, centroids: np.ndarray = None,
+                 assignments: np.ndarray = None, version: str = None):
+        """
+        :param names: the name of the subreddit of each vector.
+        :param vectors: the vectors, with norm 1 (can be memory-mapped).
+        :param centroids: the centroids of the lists of the approximate search. Can be null (only exact search).
+        :param assignments: the list of each vector. Can be null.
+        :param version: the version of the saved index (see saved_version). Can be null.
+        """
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.vectors = vectors
+        self.centroids = centroids
+        self.assignments = assignments
+        self.version = version
+        self._lists = None
+
+    @classmethod
+    def from_vectors(cls, names: [str], vectors: np.ndarray):
+        return cls(names=names, vectors=_normalize(vectors))
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def approximate(self) -> bool:
+        return self.centroids is not None
+
+    def add(self, names: [str], vectors: np.ndarray):
+        """
+        Adds (or replaces) vectors. If the approximate search is trained, the new vectors are added to their closest
+        list (the lists are not trained again).
+
+        :param names: the names of the subreddits.
+        :param vectors: their vectors (they are normalized).
+        """
+        vectors = _normalize(vectors)
+        replaced = [(i, self.index[name]) for i, name in enumerate(names) if name in self.index]
+        added = [i for i, name in enumerate(names) if name not in self.index]
+
+        self.vectors = np.concatenate([np.asarray(self.vectors), vectors[added]]) if added else np.array(self.vectors)
+        for i, position in replaced:
+            self.vectors[position] = vectors[i]
+        for i in added:
+            self.index[names[i]] = len(self.names)
+            self.names.append(names[i])
+
+        if self.approximate:
+            self.assignments = np.concatenate([self.assignments, np.zeros(len(added), dtype=np.int32)])
+            positions = np.array([position for _, position in replaced] + list(range(len(self) - len(added),
+                                                                                       len(self))), dtype=np.int64)
+            if len(positions):
+                self.assignments[positions] = self._closest_lists(self.vectors[positions], 1)[:, 0]
+            self._lists = None
+
+    def train(self, number_lists: int = None, iterations: int = KMEANS_ITERATIONS, sample_size: int = 100000,
+              seed: int = 0):
+        """
+        Trains the lists of the approximate search with spherical k-means over a sample of the vectors.
+
+        :param number_lists: number of lists. Can be null (square root of the number of vectors).
+        :param iterations: iterations of k-means.
+        :param sample_size: maximum number of vectors used to train.
+        :param seed: seed of the random sample and initial centroids.
+        """
+        random = np.random.default_rng(seed)
+        number_lists = min(number_lists or max(1, int(np.sqrt(len(self)))), len(self))
+        sample = np.asarray(self.vectors[np.sort(random.choice(len(self), min(sample_size, len(self)),
+                                                               replace=False))])
+
+        centroids = sample[random.choice(len(sample), number_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            empty = np.bincount(assignments, minlength=number_lists) == 0
+            # The empty lists keep their centroid
+            sums[empty] = centroids[empty]
+            centroids = _normalize(sums)
+
+        self.centroids = centroids
+        self.assignments = np.concatenate([self._closest_lists(self.vectors[start:start + DEFAULT_BLOCK_SIZE], 1)[:, 0]
+                                           for start in range(0, len(self), DEFAULT_BLOCK_SIZE)]).astype(np.int32)
+        self._lists = None
+
+    def _closest_lists(self, queries: np.ndarray, nprobe: int) -> np.ndarray:
+        scores = queries @ self.centroids.T
+        nprobe = min(nprobe, len(self.centroids))
+        if nprobe < len(self.centroids):
+            return np.argpartition(-scores, nprobe - 1, axis=1)[:, :nprobe]
+        return np.tile(np.arange(nprobe), (len(queries), 1))
+
+    def _get_lists(self):
+        """
+        :return: the ids of the vectors sorted by list, and where each list starts in them.
+        """
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind="stable")
+            starts = np.concatenate([[0], np.cumsum(np.bincount(self.assignments, minlength=len(self.centroids)))])
+            self._lists = (order, starts)
+        return self._lists
+
+    def search_exact(self, queries: np.ndarray, k: int = 10, block_size: int = DEFAULT_BLOCK_SIZE):
+        """
+        :param queries: array of shape (number of queries, dim), with norm 1.
+        :param k: the number of results of each query.
+        :param block_size: number of vectors scored at a time.
+        :return: the ids and the similarities of the k closest vectors of each query, closest first (ids -1 when
+        there are less than k vectors).
+        """
+        queries = np.array(queries, dtype=np.float32, ndmin=2)
+        ids = np.zeros((len(queries), 0), dtype=np.int64)
+        scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self), block_size):
+            block = np.asarray(self.vectors[start:start + block_size])
+            block_scores = queries @ block.T
+            block_ids = np.broadcast_to(np.arange(start, start + len(block)), block_scores.shape)
+            ids, scores = _merge_top_k(ids, scores, block_ids, block_scores, k)
+        return self._pad(ids, scores, k)
+
+    def search_approximate(self, queries: np.ndarray, k: int = 10, nprobe: int = DEFAULT_NPROBE):
+        """
+        Same as search_exact, but only scoring the vectors of the nprobe lists closest to each query.
+        """
+        if not self.approximate:
+            raise ValueError("The approximate search is not trained (see VectorIndex.train).")
+
+        queries = np.array(queries, dtype=np.float32, ndmin=2)
+        order, starts = self._get_lists()
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.zeros((len(queries), k), dtype=np.float32)
+        for i, lists in enumerate(self._closest_lists(queries, nprobe)):
+            candidates = np.concatenate([order[starts[j]:starts[j + 1]] for j in lists])
+            if not len(candidates):
+                continue
+            candidates.sort()  # sequential reads when memory-mapped
+            candidate_scores = np.asarray(self.vectors[candidates]) @ queries[i]
+            best_ids, best_scores = _merge_top_k(np.zeros((1, 0), np.int64), np.zeros((1, 0), np.float32),
+                                                 candidates[None, :], candidate_scores[None, :], k)
+            ids[i, :best_ids.shape[1]] = best_ids[0]
+            scores[i, :best_scores.shape[1]] = best_scores[0]
+        return ids, scores
+
+    @staticmethod
+    def _pad(ids: np.ndarray, scores: np.ndarray, k: int):
+        if ids.shape[1] == k:
+            return ids, scores
+        missing = k - ids.shape[1]
+        return (np.pad(ids, ((0, 0), (0, missing)), constant_values=-1),
+                np.pad(scores, ((0, 0), (0, missing))))
+
+    def search(self, queries: np.ndarray, k: int = 10, exact: bool = None, nprobe: int = DEFAULT_NPROBE):
+        """
+        :param exact: if True, exact search. Can be null (approximate if it's trained).
+        """
+        if exact or (exact is None and not self.approximate):
+            return self.search_exact(queries, k)
+        return self.search_approximate(queries, k, nprobe)
+
+    def _results(self, ids: np.ndarray, scores: np.ndarray, exclude: int = None, k: int = None):
+        return [(self.names[i], float(score)) for i, score in zip(ids, scores) if i >= 0 and i != exclude][:k]
+
+    def similar(self, subreddit: str, k: int = 10, exact: bool = None, nprobe: int = DEFAULT_NPROBE):
+        """
+        :param subreddit: a str representing the name of a subreddit.
+        :param k: the number of results.
+        :return: a list of (subreddit, similarity) of the subreddits most similar in content, most similar first.
+        Empty if the subreddit is unknown.
+        """
+        i = self.index.get(subreddit)
+        if i is None:
+            return []
+        ids, scores = self.search(np.asarray(self.vectors[i])[None, :], k + 1, exact=exact, nprobe=nprobe)
+        return self._results(ids[0], scores[0], exclude=i, k=k)
+
+    def query(self, text: str, k: int = 10, nlp=None, exact: bool = None, nprobe: int = DEFAULT_NPROBE):
+        """
+        :param text: a free text.
+        :param k: the number of results.
+        :param nlp: the spaCy pipeline used to embed the text. Can be null (the default model is loaded).
+        :return: a list of (subreddit, similarity) of the subreddits closest to the text, closest first.
+        """
+        from model.text_embeddings import embed_texts, load_nlp
+
+        vector = _normalize(embed_texts(nlp or load_nlp(), [text], n_process=1))
+        ids, scores = self.search(vector, k, exact=exact, nprobe=nprobe)
+        return self._results(ids[0], scores[0])
+
+    def recall(self, k: int = 10, nprobe: int = DEFAULT_NPROBE, sample_size: int = 200, seed: int = 0) -> dict:
+        """
+        Compares the approximate search with the exact one, using a sample of the vectors as queries.
+
+        :return: a dict with the recall at k (fraction of the exact results also returned by the approximate search)
+        and the average latency (seconds per query) of each search.
+        """
+        random = np.random.default_rng(seed)
+        sample = np.sort(random.choice(len(self), min(sample_size, len(self)), replace=False))
+        queries = np.asarray(self.vectors[sample])
+
+        time_start = time.perf_counter()
+        exact_ids, _ = self.search_exact(queries, k)
+        exact_latency = (time.perf_counter() - time_start) / len(queries)
+
+        time_start = time.perf_counter()
+        approximate_ids, _ = self.search_approximate(queries, k, nprobe)
+        approximate_latency = (time.perf_counter() - time_start) / len(queries)
+
+        found = sum(len(set(exact[exact >= 0]) & set(approximate[approximate >= 0]))
+                    for exact, approximate in zip(exact_ids, approximate_ids))
+        return {"recall": found / max(int((exact_ids >= 0).sum()), 1), "nprobe": nprobe,
+                "exact_latency": exact_latency, "approximate_latency": approximate_latency}
+
+    def save(self, folder: str = vector_index_folder) -> str:
+        """
+        Saves the index as a new version of the folder (see model.versions): .npy arrays (memory-mapped when loading)
+        and the names as json. An index loaded from the same folder sees either the previous version or this one.
+
+        :return: the name of the new version.
+        """
+        def save_files(version_folder: str):
+            os.makedirs(version_folder, exist_ok=True)
+            np.save(os.path.join(version_folder, "vectors.npy"), self.vectors)
+            if self.approximate:
+                np.save(os.path.join(version_folder, "centroids.npy"), self.centroids)
+                np.save(os.path.join(version_folder, "assignments.npy"), self.assignments)
+            with open(os.path.join(version_folder, "names.json"), "w", encoding="utf-8") as file:
+                json.dump(self.names, file)
+
+        self.version = publish_version(folder, save_files)
+        return self.version
+
+    @classmethod
+    def load(cls, folder: str = vector_index_folder, mmap: bool = True):
+        version = saved_version(folder)
+        # Indexes saved before the versions are read from the folder itself
+        if version:
+            folder = os.path.join(folder, version)
+        mmap_mode = "r" if mmap else None
+        vectors = np.load(os.path.join(folder, "vectors.npy"), mmap_mode=mmap_mode)
+        with open(os.path.join(folder, "names.json"), encoding="utf-8") as file:
+            names = json.load(file)
+
+        centroids, assignments = None, None
+        if os.path.exists(os.path.join(folder, "centroids.npy")):
+            centroids = np.load(os.path.join(folder, "centroids.npy"))
+            assignments = np.load(os.path.join(folder, "assignments.npy"))
+        return cls(names=names, vectors=vectors, centroids=centroids, assignments=assignments, version=version)
+
+
+def saved_version(folder: str = vector_index_folder):
+    """
+    :return: the current version of the index saved in the folder. None if there's none.
+    """
+    return current_version(folder)
+
+
+def build_vector_index(approximate: bool = False, number_lists: int = None, source_folder: str = embeddings_folder,
+                       folder: str = vector_index_folder):
+    """
+    Builds the content index of the subreddits from their centroids (see text_embeddings.build_subreddit_embeddings)
+    and saves it.
+
+    :param approximate: if True, the lists of the approximate search are trained, and its recall is reported.
+    :param number_lists: number of lists of the approximate search. Can be null (square root of the subreddits).
+    :param source_folder: the folder of the embeddings.
+    :param folder: the folder where the index is saved.
+    :return: a VectorIndex instance.
+    """
+    subreddits_folder = os.path.join(source_folder, "subreddits")
+    with open(os.path.join(subreddits_folder, "names.json"), encoding="utf-8") as file:
+        names = json.load(file)
+    vector_index = VectorIndex.from_vectors(names, np.load(os.path.join(subreddits_folder, "centroids.npy")))
+
+    print(f"Building content index of {len(vector_index)} subreddits.")
+    if approximate:
+        vector_index.train(number_lists)
+        recall = vector_index.recall()
+        print(f"\t Recall@10 of the approximate search: {recall['recall']:.3f} "
+              f"({recall['approximate_latency'] * 1000:.2f} ms vs {recall['exact_latency'] * 1000:.2f} ms per query).")
+
+    vector_index.save(folder)
+    print(f"\t Saved in '{folder}'.")
+    return vector_index
+
+
+_default_vector_index = None
+_default_vector_index_checked = 0
+
+"""
+    Cache of the results of the default index. It's dropped when a new index is loaded.
+"""
+similarity_cache = QueryCache()
+
+
+def get_default_vector_index() -> VectorIndex:
+    """
+    :return: the index saved in the vector index folder. It's loaded the first time, and again when it's saved again.
+    """
+    global _default_vector_index, _default_vector_index_checked
+    now = time.monotonic()
+    if _default_vector_index is None or now - _default_vector_index_checked > VERSION_CHECK_INTERVAL:
+        _default_vector_index_checked = now
+        if _default_vector_index is None or saved_version(vector_index_folder) != _default_vector_index.version:
+            _default_vector_index = VectorIndex.load(vector_index_folder)
+    return _default_vector_index
+
+
+def similar(subreddit: str, k: int = 10):
+    """
+    Subreddits most similar in content to a subreddit, using the index saved in the vector index folder.
+
+    :param subreddit: a str representing the name of a subreddit.
+    :param k: the number of results.
+    :return: a list of (subreddit, similarity), most similar first.
+    """
+    vector_index = get_default_vector_index()
+    method = "approximate" if vector_index.approximate else "exact"
+    return similarity_cache.get_or_compute(("similar", subreddit, k, method),
+                                           lambda: vector_index.similar(subreddit, k), version=vector_index.version)
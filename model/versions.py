@@ -0,0 +1,48 @@
+import os
+import shutil
+
+"""
+    Versioned folders: each version of an index is saved in its own folder ("v000001", ...) and the file CURRENT
+    names the one in use. A version is completely written before CURRENT is replaced (atomically), so the readers
+    see either the previous version or the new one, never a mix of both. The last KEEP_VERSIONS versions are kept.
+"""
+CURRENT_FILE = "CURRENT"
+KEEP_VERSIONS = 3
+
+
+def current_version(folder: str):
+    """
+    :return: the name of the current version in the folder. None if it has no versions.
+    """
+    try:
+        with open(os.path.join(folder, CURRENT_FILE), encoding="utf-8") as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def publish_version(folder: str, save, keep_versions: int = KEEP_VERSIONS) -> str:
+    """
+    Saves a new version in the folder and makes it the current one.
+
+    :param folder: the folder of the versions.
+    :param save: function that receives the folder of the new version and writes everything in it.
+    :param keep_versions: number of versions kept (the current one included).
+    :return: the name of the new version.
+    """
+    os.makedirs(folder, exist_ok=True)
+    versions = sorted(name for name in os.listdir(folder) if name.startswith("v") and name[1:].isdigit())
+    version = f"v{int(versions[-1][1:]) + 1 if versions else 1:06d}"
+    save(os.path.join(folder, version))
+
+    temporary_file = os.path.join(folder, f"{CURRENT_FILE}.tmp")
+    with open(temporary_file, "w", encoding="utf-8") as file:
+        file.write(version)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_file, os.path.join(folder, CURRENT_FILE))
+
+    # Readers of the removed versions keep working on Linux (the memory-mapped files stay until they are closed)
+    for old_version in versions[:-(keep_versions - 1)] if keep_versions > 1 else versions:
+        shutil.rmtree(os.path.join(folder, old_version), ignore_errors=True)
+    return version
@@ -0,0 +1,102 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from model import incremental_update
+from model.crosspost_graph import CrosspostGraph
+from model.recommender import build_index
+
+
+def random_edges(random: np.random.Generator, number_subreddits: int, number_edges: int):
+    """
+    :return: arrays of parents, children and weights of random crossposts between the subreddits.
+    """
+    names = np.array([f"subreddit_{i}" for i in range(number_subreddits)], dtype=object)
+    parents = names[random.integers(number_subreddits, size=number_edges)]
+    children = names[random.integers(number_subreddits, size=number_edges)]
+    return parents, children, random.uniform(1, 10, size=number_edges).astype(np.float32)
+
+
+class IncrementalUpdateTest(unittest.TestCase):
+    """
+    The index updated with several batches of crossposts must recommend the same as the index built from scratch
+    with all of them.
+    """
+
+    def update_in_batches(self, folder: str, batches, method: str, k: int):
+        batches = iter(batches)
+
+        def new_edges(state: dict = None):
+            return (*next(batches), {"source": "test"})
+
+        with mock.patch.dict(incremental_update.NEW_EDGES_SOURCES, {"test": new_edges}):
+            index = None
+            for _ in range(3):
+                index = incremental_update.update_index(source="test", folder=folder, method=method, k=k, workers=1)
+        return index
+
+    def assert_same_recommendations(self, index, expected_index, k: int):
+        self.assertEqual(sorted(index.names), sorted(expected_index.names))
+        self.assertEqual(index.k, expected_index.k)
+        for name in expected_index.names:
+            recommendations = index.recommend(name, k=k)
+            expected = expected_index.recommend(name, k=k)
+            np.testing.assert_allclose([score for _, score in recommendations],
+                                       [score for _, score in expected], rtol=1e-4, atol=1e-6, err_msg=name)
+            # Subreddits with the same score can come in any order, and the ones tied with the last can be others
+            self.assertEqual(self.tied_groups(recommendations), self.tied_groups(expected), name)
+
+    @staticmethod
+    def tied_groups(recommendations) -> dict:
+        """
+        :return: the subreddits of each score (rounded), without the ones of the last score.
+        """
+        groups = {}
+        for subreddit, score in recommendations:
+            groups.setdefault(round(score, 4), set()).add(subreddit)
+        if recommendations:
+            groups.pop(round(recommendations[-1][1], 4))
+        return groups
+
+    def check_method(self, method: str):
+        random = np.random.default_rng(7)
+        k = 5
+        # The first batch has fewer subreddits than k, so the first version has shorter rows
+        batches = [random_edges(random, 3, 4), random_edges(random, 40, 300), random_edges(random, 60, 200)]
+
+        with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as expected_folder:
+            index = self.update_in_batches(folder, batches, method, k)
+            parents, children, weights = (np.concatenate(arrays) for arrays in zip(*batches))
+            graph = CrosspostGraph.from_edges(parents, children, weights)
+            expected_index = build_index(graph, method=method, k=k, folder=expected_folder, workers=1)
+
+        self.assertEqual(index.requested_k, k)
+        self.assert_same_recommendations(index, expected_index, k)
+
+    def test_cosine(self):
+        self.check_method("cosine")
+
+    def test_jaccard(self):
+        self.check_method("jaccard")
+
+    def test_pmi(self):
+        self.check_method("pmi")
+
+    def test_empty_first_version(self):
+        random = np.random.default_rng(11)
+        empty = (np.array([], dtype=object), np.array([], dtype=object), np.array([], dtype=np.float32))
+        batches = [empty, random_edges(random, 30, 200), random_edges(random, 30, 100)]
+
+        with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as expected_folder:
+            index = self.update_in_batches(folder, batches, "cosine", 10)
+            parents, children, weights = (np.concatenate(arrays) for arrays in zip(*batches))
+            graph = CrosspostGraph.from_edges(parents, children, weights)
+            expected_index = build_index(graph, method="cosine", k=10, folder=expected_folder, workers=1)
+
+        self.assert_same_recommendations(index, expected_index, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+import contextvars
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+    Level of the log messages of the collection (DEBUG shows each submission, crosspost and comment fetch). It's
+    chosen with the environment variable LOG_LEVEL.
+"""
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(threadName)s] %(name)s: %(message)s"
+
+"""
+    Export of the metrics in the Prometheus text format: a file (e.g. for the textfile collector of node_exporter)
+    written at the end of each subreddit, and optionally an HTTP endpoint (/metrics) on a local port.
+"""
+METRICS_FILE = os.getenv("METRICS_FILE", "data/metrics.prom")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+METRICS_PREFIX = "recommenddit"
+
+"""
+    Description and type of each metric (the "# HELP" and "# TYPE" lines).
+"""
+METRICS = {
+    "api_calls_total": ("counter", "Requests made to the Reddit API."),
+    "api_errors_total": ("counter", "Requests to the Reddit API that failed."),
+    "retries_total": ("counter", "Retries of a listing after a server or connection error."),
+    "rows_written_total": ("counter", "Records written to the storage."),
+    "submissions_refreshed_total": ("counter", "Recent submissions whose comments were collected again."),
+    "stage_seconds": ("summary", "Time spent in each stage of the collection."),
+    "stage_seconds_max": ("gauge", "Longest time spent in a single run of each stage of the collection."),
+}
+
+"""
+    Subreddit being collected in the current thread (the label of the metrics recorded without one).
+"""
+current_subreddit = contextvars.ContextVar("current_subreddit", default=None)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    :return: the logger of a module, configured the first time (level LOG_LEVEL, to stderr).
+    """
+    root = logging.getLogger(METRICS_PREFIX)
+    if not root.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+    return root.getChild(name)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class Metrics:
+    """
+    Counters and timers of the collection, with labels (always the subreddit, when there is one). They are
+    thread-safe and cheap (a lock and a dict update), so they can be used in the hot path.
+    """
+
+    def __init__(self, prefix: str = METRICS_PREFIX):
+        self.prefix = prefix
+        self.counters = {}
+        # (name, labels) -> [count, sum, max]
+        self.timers = {}
+        self._lock = threading.Lock()
+        # Serializes the writes of the file and the start of the server (several collection threads export them)
+        self._export_lock = threading.Lock()
+        self._server = None
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        if "subreddit" not in labels and current_subreddit.get() is not None:
+            labels["subreddit"] = current_subreddit.get()
+        return name, tuple(sorted(labels.items()))
+
+    def count(self, name: str, value: int = 1, **labels):
+        """
+        Adds value to the counter of the labels.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """
+        Records a duration in the timer of the labels.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        """
+        Times the statements of the context as a stage of the collection (also when they fail).
+        """
+        time_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - time_start, stage=stage, **labels)
+
+    def timed(self, stage: str, iterable, **labels):
+        """
+        Times each item of a lazy iterable (e.g. a praw listing, which makes an API call every 100 items), without
+        the time spent by the consumer.
+
+        :return: a generator of the items of the iterable.
+        """
+        iterator = iter(iterable)
+        while True:
+            time_start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.observe("stage_seconds", time.perf_counter() - time_start, stage=stage, **labels)
+            yield item
+
+    def value(self, name: str, **labels):
+        """
+        :return: the sum of the counter (or of the seconds of the timer) over the series matching the labels.
+        """
+        labels = set(labels.items())
+        with self._lock:
+            total = sum(value for (metric, key), value in self.counters.items()
+                        if metric == name and labels <= set(key))
+            total += sum(timer[1] for (metric, key), timer in self.timers.items()
+                         if metric == name and labels <= set(key))
+        return total
+
+    def to_prometheus(self) -> str:
+        """
+        :return: all the metrics in the Prometheus text format.
+        """
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timers = sorted((key, list(timer)) for key, timer in self.timers.items())
+
+        series = {}
+        for (name, labels), value in counters:
+            series.setdefault(name, []).append(f"{self.prefix}_{name}{_format_labels(labels)} {value}")
+        for (name, labels), (count, total, maximum) in timers:
+            lines = series.setdefault(name, [])
+            lines.append(f"{self.prefix}_{name}_count{_format_labels(labels)} {count}")
+            lines.append(f"{self.prefix}_{name}_sum{_format_labels(labels)} {total:.6f}")
+            series.setdefault(f"{name}_max", []).append(
+                f"{self.prefix}_{name}_max{_format_labels(labels)} {maximum:.6f}")
+
+        text = []
+        for name, lines in series.items():
+            metric_type, description = METRICS.get(name, ("untyped", name))
+            text.append(f"# HELP {self.prefix}_{name} {description}")
+            text.append(f"# TYPE {self.prefix}_{name} {metric_type}")
+            text.extend(lines)
+        return "\n".join(text) + "\n"
+
+    def write(self, path: str = METRICS_FILE):
+        """
+        Writes the metrics in a file (atomically, so a scraper never reads half a file).
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with self._export_lock:
+            descriptor, temporary_path = tempfile.mkstemp(dir=folder or ".", prefix=f".{os.path.basename(path)}.")
+            try:
+                with os.fdopen(descriptor, "w", encoding="utf-8") as file:
+                    file.write(self.to_prometheus())
+                os.replace(temporary_path, path)
+            except BaseException:
+                os.remove(temporary_path)
+                raise
+
+    def serve(self, port: int = METRICS_PORT, host: str = "127.0.0.1"):
+        """
+        Serves the metrics in http://host:port/metrics from a daemon thread. Nothing is done if the port is 0 or the
+        server was already started.
+        """
+        with self._export_lock:
+            if port and self._server is None:
+                self._server = self._start_server(port, host)
+        return self._server
+
+    def _start_server(self, port: int, host: str) -> ThreadingHTTPServer:
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+    def summary(self, subreddit: str) -> str:
+        """
+        :return: a one-line summary of the metrics of a subreddit (for the logs).
+        """
+        stages = sorted({dict(labels)["stage"] for (name, labels) in list(self.timers)
+                         if name == "stage_seconds" and dict(labels).get("subreddit") == subreddit})
+        times = ", ".join(f"{stage} {self.value('stage_seconds', stage=stage, subreddit=subreddit):.1f}s"
+                          for stage in stages)
+        return f"{self.value('api_calls_total', subreddit=subreddit):.0f} API calls, " \
+               f"{self.value('rows_written_total', subreddit=subreddit):.0f} rows written, " \
+               f"{self.value('retries_total', subreddit=subreddit):.0f} retries. {times}"
+
+
+metrics = Metrics()
+logger = get_logger("metrics")
+
+
+@contextmanager
+def subreddit_context(subreddit: str):
+    """
+    Labels the metrics recorded in the context (in the current thread) with the subreddit.
+    """
+    token = current_subreddit.set(subreddit)
+    try:
+        yield
+    finally:
+        current_subreddit.reset(token)
+
+
+def export_metrics(subreddit: str = None, path: str = METRICS_FILE):
+    """
+    Writes the metrics file (and starts the endpoint, if METRICS_PORT is set), and logs the summary of the subreddit.
+
+    :param subreddit: the subreddit just collected. Can be null.
+    :param path: the file of the metrics. Can be null (not written).
+    """
+    metrics.serve()
+    if path:
+        metrics.write(path)
+    if subreddit:
+        logger.info("[%s] %s", subreddit, metrics.summary(subreddit))
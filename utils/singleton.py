@@ -1,5 +1,9 @@
-# Implementation of a Singleton class.
-class Singleton(type):
+from abc import ABCMeta
+
+
+# Implementation of a Singleton class. It's an ABCMeta, so a singleton can implement an abstract class (e.g.
+# database.storage.StorageBackend).
+class Singleton(ABCMeta):
     def __init__(cls, name, bases, attrs, **kwargs):
         super().__init__(name, bases, attrs)
 